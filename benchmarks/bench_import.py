@@ -0,0 +1,52 @@
+"""Measure how long ``import nbclean`` takes, and what it pulls in.
+
+Run with ``python benchmarks/bench_import.py``. Each measurement imports
+in a fresh interpreter. The time for nbformat, which nbclean always needs,
+is shown separately.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Modules that should only be imported once they are used
+HEAVY = ['nbgrader', 'nbconvert', 'nbclient', 'jupyter_client', 'zmq',
+         'tqdm', 'PIL', 'numpy']
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import nbformat
+middle = time.perf_counter()
+import nbclean
+end = time.perf_counter()
+print(middle - start, end - middle)
+print(' '.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure():
+    out = subprocess.run([sys.executable, '-c', SCRIPT.format(heavy=HEAVY)],
+                         check=True, capture_output=True, text=True).stdout
+    times, loaded = (out.splitlines() + [''])[:2]
+    t_nbformat, t_nbclean = map(float, times.split())
+    return t_nbformat, t_nbclean, loaded.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.repeat)]
+    print('{:<30}{:>10}'.format('nbformat', '{:.3f}s'.format(
+        statistics.median(result[0] for result in results))))
+    print('{:<30}{:>10}'.format('nbclean (after nbformat)', '{:.3f}s'.format(
+        statistics.median(result[1] for result in results))))
+    loaded = results[0][2]
+    print('Heavy modules imported: {}'.format(', '.join(loaded) or 'none'))
+    return 1 if len(loaded) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Compare the speed of reading and saving notebooks.
+
+Run with ``python benchmarks/bench_io.py``.
+"""
+import os
+import os.path as op
+import tempfile
+import timeit
+
+import nbformat as nbf
+
+import nbclean as nbc
+from synthesize import make_notebook
+
+
+def bench(func, number=5):
+    return min(timeit.repeat(func, number=1, repeat=number))
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    path = op.join(tmp, 'bench.ipynb')
+    nbf.write(make_notebook(n_cells=2000, image_bytes=2000), path)
+    print('Notebook size: {:.1f} MB'.format(op.getsize(path) / 1e6))
+
+    print('\nReading')
+    print('{:<30}{:>10}'.format('nbformat.read', '{:.3f}s'.format(
+        bench(lambda: nbf.read(path, nbf.NO_CONVERT)))))
+    for validate in ['full', 'sample', 'off']:
+        for backend in ['json', 'orjson']:
+            try:
+                time = bench(lambda: nbc.NotebookCleaner(
+                    path, validate=validate, json_backend=backend))
+            except ImportError:
+                continue
+            print('{:<30}{:>10}'.format('{} / {}'.format(validate, backend),
+                                        '{:.3f}s'.format(time)))
+
+    print('\nSaving')
+    ntbk = nbc.NotebookCleaner(path)
+    path_out = op.join(tmp, 'out.ipynb')
+    print('{:<30}{:>10}'.format('nbformat.write', '{:.3f}s'.format(
+        bench(lambda: nbf.write(ntbk.ntbk, path_out)))))
+    for validate in ['full', 'sample', 'off']:
+        for backend in ['json', 'orjson']:
+            try:
+                time = bench(lambda: ntbk.save(path_out, validate=validate,
+                                               json_backend=backend))
+            except ImportError:
+                continue
+            print('{:<30}{:>10}'.format('{} / {}'.format(validate, backend),
+                                        '{:.3f}s'.format(time)))
+    os.remove(path)
+    os.remove(path_out)
+
+
+if __name__ == '__main__':
+    main()
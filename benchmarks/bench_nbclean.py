@@ -0,0 +1,151 @@
+"""Measure the speed and peak memory of nbclean's main operations.
+
+Run with ``python benchmarks/bench_nbclean.py``. Use ``--save`` to store the
+results as JSON, and ``--compare`` to flag operations that got slower than
+a previous run.
+"""
+import argparse
+import json
+import os.path as op
+import shutil
+import tempfile
+import time
+import tracemalloc
+from copy import deepcopy
+
+import nbclean as nbc
+from synthesize import make_notebook
+
+SIZES = {
+    'small': dict(n_cells=20, image_bytes=0),
+    'medium': dict(n_cells=500, image_bytes=5000),
+    'large': dict(n_cells=2000, image_bytes=20000),
+}
+
+
+def measure(func, repeat=3):
+    """Return the best time and peak traced memory (in MB) of `func`."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 1e6
+
+
+def operations(ntbk, tmp):
+    """Return the benchmarked operations for a notebook."""
+    cleaner = nbc.NotebookCleaner(ntbk)
+    path_out = op.join(tmp, 'out.ipynb')
+    return {
+        'clear': lambda: nbc.NotebookCleaner(ntbk).clear(
+            kind=['output', 'stderr'], tag='hide_output'),
+        'clear_output_image': lambda: nbc.NotebookCleaner(ntbk).clear(
+            kind='output_image'),
+        'remove_cells': lambda: nbc.NotebookCleaner(ntbk).remove_cells(
+            tag='remove'),
+        'remove_cells_search_text': lambda: nbc.NotebookCleaner(
+            ntbk).remove_cells(search_text='x_1'),
+        'replace_text': lambda: nbc.NotebookCleaner(ntbk).replace_text(),
+        'create_tests': lambda: nbc.NotebookCleaner(ntbk).create_tests(
+            'test', 'tests', tmp),
+        'recipe_eager': lambda: _recipe(nbc.NotebookCleaner(ntbk), tmp),
+        'recipe_lazy': lambda: _recipe(
+            nbc.NotebookCleaner(ntbk, lazy=True), tmp).apply(),
+        'save': lambda: cleaner.save(path_out),
+    }
+
+
+def _recipe(cleaner, tmp):
+    cleaner.clear(kind='output', tag='hide_output')
+    cleaner.clear(kind='content', tag='hide_content')
+    cleaner.clear(kind='stderr', tag='hide_stderr')
+    cleaner.remove_cells(tag='remove')
+    cleaner.replace_text()
+    cleaner.create_tests('test', 'tests', tmp)
+    return cleaner
+
+
+def run_benchmarks(sizes, execute=False, repeat=3):
+    results = {}
+    tmp = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            ntbk = make_notebook(**SIZES[size])
+            n_cells = len(ntbk.cells)
+            for name, func in operations(ntbk, tmp).items():
+                seconds, peak = measure(func, repeat=repeat)
+                results['{}/{}'.format(name, size)] = dict(
+                    seconds=seconds, peak_mb=peak,
+                    cells_per_second=n_cells / seconds)
+
+        if execute:
+            # Kernel start-up dominates, so use a single small notebook
+            ntbk = make_notebook(n_cells=10, solution_density=0)
+            for cell in ntbk.cells:
+                if cell.cell_type == 'code':
+                    cell.outputs = []
+            seconds, peak = measure(
+                lambda: nbc.run_notebook(deepcopy(ntbk)), repeat=1)
+            results['run_notebook/small'] = dict(
+                seconds=seconds, peak_mb=peak,
+                cells_per_second=len(ntbk.cells) / seconds)
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def report(results, baseline=None, threshold=1.2):
+    """Print a table of results, flagging regressions against a baseline."""
+    print('{:<36}{:>10}{:>12}{:>14}'.format('operation', 'time (s)',
+                                           'peak (MB)', 'cells / s'))
+    regressions = []
+    for name, result in results.items():
+        line = '{:<36}{:>10.4f}{:>12.2f}{:>14.0f}'.format(
+            name, result['seconds'], result['peak_mb'],
+            result['cells_per_second'])
+        if baseline is not None and name in baseline:
+            ratio = result['seconds'] / baseline[name]['seconds']
+            line += '{:>8.2f}x'.format(ratio)
+            if ratio > threshold:
+                line += ' REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'],
+                        choices=list(SIZES))
+    parser.add_argument('--execute', action='store_true',
+                        help='Also benchmark run_notebook (starts a kernel).')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='Save results to this JSON file.')
+    parser.add_argument('--compare', help='Compare with results saved in '
+                                          'this JSON file.')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slow-down ratio that counts as a regression.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, execute=args.execute,
+                             repeat=args.repeat)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as ff:
+            baseline = json.load(ff)
+    regressions = report(results, baseline, threshold=args.threshold)
+    if args.save is not None:
+        with open(args.save, 'w') as ff:
+            json.dump(results, ff, indent=1, sort_keys=True)
+    if len(regressions) > 0:
+        raise SystemExit('Regressions found in: {}'.format(
+            ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Create synthetic notebooks of a controlled size for benchmarking."""
+import base64
+import random
+
+import nbformat as nbf
+
+# Tags used by the synthetic notebooks, matching examples/test_notebooks
+TAGS = ['hide_output', 'hide_content', 'hide_stderr', 'remove', 'test']
+
+
+def make_notebook(n_cells=200, output_lines=20, image_bytes=0,
+                  tag_density=0.2, solution_density=0.1, seed=0):
+    """Create a notebook with code cells, text outputs and images.
+
+    Parameters
+    ----------
+    n_cells : int
+        The number of code cells. A markdown cell is added after each one.
+    output_lines : int
+        The number of lines of stdout in each code cell's output. Each code
+        cell also has a one-line stderr output.
+    image_bytes : int
+        The size of a PNG-like image payload in each code cell's output. If
+        0, no images are added.
+    tag_density : float
+        The fraction of code cells that are given one of `TAGS`.
+    solution_density : float
+        The fraction of code cells that contain a solution region delimited
+        by ``### SOLUTION BEGIN`` and ``### SOLUTION END``.
+    seed : int
+        The seed for the random number generator.
+    """
+    rng = random.Random(seed)
+    image = base64.b64encode(
+        bytes(rng.getrandbits(8) for _ in range(image_bytes))).decode()
+    nb = nbf.v4.new_notebook()
+    nb.metadata['kernelspec'] = dict(name='python3', language='python',
+                                     display_name='Python 3')
+    for ii in range(n_cells):
+        source = 'x_{0} = {0}\nprint(x_{0})'.format(ii)
+        if rng.random() < solution_density:
+            source += '\n### SOLUTION BEGIN\ny_{0} = x_{0} * 2\n' \
+                      '### SOLUTION END'.format(ii)
+        cell = nbf.v4.new_code_cell(source)
+        if rng.random() < tag_density:
+            cell.metadata['tags'] = [rng.choice(TAGS)]
+        cell.outputs.append(nbf.v4.new_output(
+            'stream', name='stdout',
+            text=''.join('line {}\n'.format(jj)
+                         for jj in range(output_lines))))
+        cell.outputs.append(nbf.v4.new_output(
+            'stream', name='stderr', text='A warning\n'))
+        if image_bytes > 0:
+            cell.outputs.append(nbf.v4.new_output(
+                'display_data', data={'image/png': image,
+                                      'text/plain': '<Figure>'}))
+        nb.cells.append(cell)
+        nb.cells.append(nbf.v4.new_markdown_cell('Cell {}'.format(ii)))
+    return nb
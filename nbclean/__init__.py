@@ -2,5 +2,18 @@
 
 __version__ = "0.3.2"
 
-from .clean import NotebookCleaner
-from .run import run_notebook_directory, run_notebook
+from .clean import NotebookCleaner, clean_notebook_directory, clean_variants
+from .run import (run_notebook_directory, run_notebook,
+                  run_notebook_directory_async, run_notebook_async)
+from .cache import NotebookCache, CellCache
+from .store import OutputStore
+from .watch import NotebookWatcher, watch_notebook_directory
+
+
+def __getattr__(name):
+    # The corpus needs numpy, so it's only imported once it is used
+    if name in ['NotebookCorpus', 'build_corpus']:
+        from . import corpus
+        return getattr(corpus, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
@@ -0,0 +1,224 @@
+"""On-disk caches of processed notebooks and cell outputs."""
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import sys
+import weakref
+
+import nbformat as nbf
+
+from .utils import _atomic_write
+
+
+class NotebookCache(object):
+    """Store processed notebooks on disk so unchanged inputs can be skipped.
+
+    Each entry is keyed on a hash of the input notebook file plus anything
+    else that changes how it is processed (e.g. a cleaning recipe). When
+    `max_size` is exceeded, the least-recently used entries are removed.
+
+    Parameters
+    ----------
+    path : str
+        The folder in which to store cached notebooks. It is created if it
+        doesn't exist.
+    max_size : int | None
+        The maximum total size of the cache, in bytes. If None, the cache
+        is never pruned.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        stats = self.stats()
+        s = "<NotebookCache> {}\n---".format(self.path)
+        s += "\nEntries: {entries} | Size: {size} bytes".format(**stats)
+        if self.max_size is not None:
+            s += " (max {})".format(self.max_size)
+        s += "\nHits: {hits} | Misses: {misses} | Evictions: {evictions}".format(
+            **stats)
+        return s
+
+    def key(self, filename, *parts):
+        """Return the cache key for a notebook file.
+
+        Parameters
+        ----------
+        filename : str
+            The path to the input notebook.
+        *parts
+            Anything else that affects the output, e.g. a cleaning recipe.
+            These must be JSON-serializable.
+        """
+        hasher = hashlib.sha256()
+        with open(filename, 'rb') as ff:
+            for chunk in iter(lambda: ff.read(1 << 20), b''):
+                hasher.update(chunk)
+        for part in parts:
+            hasher.update(json.dumps(part, sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _entry(self, key):
+        return op.join(self.path, key + '.ipynb')
+
+    def get(self, key):
+        """Return the path to the cached notebook for `key`, or None."""
+        path_entry = self._entry(key)
+        if not op.exists(path_entry):
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        os.utime(path_entry)
+        self.hits += 1
+        return path_entry
+
+    def put(self, key, ntbk):
+        """Add a notebook to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `NotebookCache.key`.
+        ntbk : str | instance of NotebookNode
+            The processed notebook, or a path to it.
+        """
+        # Write to a temporary file first so readers never see partial entries
+        with _atomic_write(self._entry(key)) as ff:
+            if isinstance(ntbk, str):
+                with open(ntbk, 'r', encoding='utf-8') as fin:
+                    shutil.copyfileobj(fin, ff)
+            else:
+                nbf.write(ntbk, ff)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.ipynb'):
+                stat = os.stat(op.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in entries:
+            if size <= self.max_size:
+                break
+            os.remove(op.join(self.path, name))
+            size -= entry_size
+            self.evictions += 1
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        entries = self._entries()
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(entries),
+                    size=sum(entry[1] for entry in entries),
+                    max_size=self.max_size)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for _, _, name in self._entries():
+            os.remove(op.join(self.path, name))
+
+
+class CellCache(object):
+    """Store the outputs of executed code cells so they can be reused.
+
+    Each code cell is keyed on a chained hash of its source, the sources of
+    all the code cells before it, and the kernel and Python environment.
+    Changing a cell therefore invalidates it and every code cell after it,
+    while edits to markdown cells invalidate nothing.
+
+    Parameters
+    ----------
+    path : str
+        The folder in which to store outputs. It is created if it doesn't
+        exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # The keys of the cells that each live kernel has run, in order
+        self._kernels = weakref.WeakKeyDictionary()
+        os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        # Kernels can't be sent to worker processes
+        state = dict(self.__dict__)
+        del state['_kernels']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._kernels = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        s = "<CellCache> {}\n---".format(self.path)
+        s += "\nHits: {} | Misses: {}".format(self.hits, self.misses)
+        return s
+
+    def keys(self, ntbk):
+        """Return the key of each code cell in a notebook."""
+        env = json.dumps(dict(
+            _kernel_environment(),
+            kernelspec=ntbk['metadata'].get('kernelspec', {})),
+            sort_keys=True)
+        key = hashlib.sha256(env.encode('utf-8')).hexdigest()
+        keys = []
+        for cell in ntbk['cells']:
+            if cell['cell_type'] != 'code':
+                continue
+            key = hashlib.sha256(
+                (key + cell['source']).encode('utf-8')).hexdigest()
+            keys.append(key)
+        return keys
+
+    def _entry(self, key):
+        return op.join(self.path, key[:2], key[2:] + '.json')
+
+    def get(self, key):
+        """Return the stored ``outputs``, ``execution_count`` and
+        ``language_info`` of a cell, or None."""
+        try:
+            with open(self._entry(key), 'r', encoding='utf-8') as ff:
+                entry = json.load(ff)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, cell, language_info=None):
+        """Store the outputs of an executed cell."""
+        path_entry = self._entry(key)
+        os.makedirs(op.dirname(path_entry), exist_ok=True)
+        with _atomic_write(path_entry) as ff:
+            json.dump(dict(outputs=cell['outputs'],
+                           execution_count=cell['execution_count'],
+                           language_info=language_info), ff)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for name in os.listdir(self.path):
+            if op.isdir(op.join(self.path, name)):
+                shutil.rmtree(op.join(self.path, name))
+        self._kernels.clear()
+
+
+def _kernel_environment():
+    """Describe the environment that notebooks are executed in."""
+    from jupyter_client.kernelspec import KernelSpecManager
+    return dict(python=sys.version, executable=sys.executable,
+                kernels=KernelSpecManager().find_kernel_specs())
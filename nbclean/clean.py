@@ -1,9 +1,20 @@
 """Functions to assist with grading."""
-import nbformat as nbf
+import asyncio
 import os
-from nbgrader.preprocessors import ClearSolutions
-from .preprocessors import RemoveCells, ClearCells, ConvertCells
-from .utils import _check_nb_file
+import os.path as op
+import time
+from functools import partial
+from .preprocessors import (RemoveCells, ClearCells, ClearSolutions,
+                            ConvertCells, CompactOutputs, preprocess_cells,
+                            _test_cells)
+from .index import CellIndex, CellMatcher
+from .profiling import _new_stats
+from .stream import preprocess_file
+from .utils import (_check_nb_file, _copy_file, _copy_nb_shallow,
+                    _file_version, _find_notebooks, _parallel_map, _write_nb)
+
+RECIPE_STEPS = ['clear', 'remove_cells', 'replace_text', 'create_tests',
+                'compact']
 
 
 class NotebookCleaner(object):
@@ -13,20 +24,194 @@ class NotebookCleaner(object):
     ----------
     ntbk : string | instance of NotebookNode
         The input notebook.
+    verbose : bool
+        Whether to print progress messages.
+    lazy : bool
+        If True, cleaning methods only record their preprocessors instead of
+        running them right away. All recorded steps are then applied in a
+        single pass over the cells when `apply` or `save` is called.
+    copy : bool
+        Whether to leave a `NotebookNode` input untouched. If True, cells
+        are only copied once a step modifies them. If False, the input
+        notebook is modified in place. Notebooks read from a path are never
+        copied.
+    stream : bool
+        If True, `ntbk` must be a path and the notebook is never loaded into
+        memory. Cleaning steps are recorded (as with ``lazy=True``) and then
+        applied one cell at a time while the file is copied to the path
+        given to `save`. Each `save` reads the file again and applies all
+        of the steps. Only `clear`, `remove_cells`, `create_tests` and
+        `compact` without `max_bytes` may be used, and `ntbk` is None.
+    validate : 'full' | 'sample' | 'off'
+        How thoroughly to check a notebook read from a path against the
+        nbformat schema. 'sample' only checks the notebook structure and a
+        few of its cells. Problems are logged, not raised.
+    json_backend : 'json' | 'orjson' | 'auto'
+        The library used to parse a notebook read from a path. 'orjson' is
+        faster, but fails on notebooks with ``NaN`` or ``Infinity`` values,
+        or integers wider than 64 bits, which the standard library reads.
+        'auto' uses orjson if it is installed.
+    profile : bool
+        Whether to record statistics about each cleaning step in `stats`.
+        These are also shown by ``repr``. Steps applied while streaming are
+        not recorded.
+    callback : callable | None
+        A function that is called with the statistics of each step once it
+        has been applied, e.g. to export them to a metrics system. Implies
+        ``profile=True``.
+
+    Attributes
+    ----------
+    stats : list of dict
+        If `profile` is True, one dictionary per applied step with its
+        ``name`` (e.g. ``'clear'``), the wall ``time`` it took in seconds,
+        the number of ``cells_visited``, ``cells_modified`` and
+        ``cells_removed``, the ``output_bytes_removed`` and the
+        ``memory_delta`` in bytes. The memory delta is None unless
+        `tracemalloc` is tracing.
     """
-    def __init__(self, ntbk, verbose=False):
+    def __init__(self, ntbk, verbose=False, lazy=False, copy=True,
+                 stream=False, validate='full', json_backend='json',
+                 profile=False, callback=None):
         self._verbose = verbose
-        self.ntbk = _check_nb_file(ntbk)
+        self._profile = profile or callback is not None
+        self._callback = callback
+        self.stats = []
+        self._lazy = lazy or stream
+        self._stream = stream
+        self._shared_cells = {}
+        if stream is True:
+            if not isinstance(ntbk, str):
+                raise TypeError('`ntbk` must be a path when stream is True')
+            self._path = ntbk
+            self.ntbk = None
+        else:
+            self.ntbk = _check_nb_file(ntbk, copy=False, validate=validate,
+                                       json_backend=json_backend)
+        if copy is True and self.ntbk is ntbk:
+            self.ntbk = _copy_nb_shallow(ntbk)
+            self._shared_cells = {id(cell): cell for cell in ntbk['cells']}
         self.preprocessors = []
+        self.recipe = []
+        self._pending = []
+        self._cell_index = None
 
     def __repr__(self):
         s = "Number of preprocessors: {}\n---".format(
             len(self.preprocessors))
-        for pre in self.preprocessors:
+        for ii, pre in enumerate(self.preprocessors):
             s += '\n' + str(pre)
+            if ii < len(self.stats):
+                s += (' | {time:.4f}s, {cells_visited} visited, '
+                      '{cells_modified} modified, {cells_removed} removed, '
+                      '{output_bytes_removed} output bytes removed').format(
+                          **self.stats[ii])
+        if len(self._pending) > 0:
+            s += '\n---\nNot yet applied: {}'.format(len(self._pending))
         return s
 
-    def clear(self, kind, tag=None, search_text=None, clear=None):
+    def _add_preprocessor(self, pre, step):
+        if self._stream is True and not pre.streamable:
+            raise ValueError('{} cannot be used when stream is True'.format(
+                step[0]))
+        if self._lazy is True:
+            self._pending.append(pre)
+        else:
+            # The index of cells is built once and reused by later steps
+            # until a step changes the cells' sources or removes cells, or
+            # `ntbk` is edited directly
+            if (self._cell_index is None or
+                    not self._cell_index.is_current(self.ntbk['cells'])):
+                self._cell_index = CellIndex(self.ntbk['cells'])
+            stats = self._new_stats([step])
+            self.ntbk = preprocess_cells(self.ntbk, [pre], {},
+                                         self._shared_cells,
+                                         self._cell_index, stats)[0]
+            self._record_stats(stats)
+            if pre.changes_index:
+                self._cell_index = None
+        # A step is only recorded once it has run, so a failed step is not
+        # left in the recipe
+        self.preprocessors.append(pre)
+        self.recipe.append(step)
+        return self
+
+    def _new_stats(self, steps):
+        if self._profile is False:
+            return None
+        return [_new_stats(name) for name, _ in steps]
+
+    def _record_stats(self, stats):
+        if stats is None:
+            return
+        self.stats.extend(stats)
+        if self._callback is not None:
+            for step_stats in stats:
+                self._callback(step_stats)
+
+    def apply(self):
+        """Apply any preprocessors that have not been run yet.
+
+        This only does something if the cleaner was created with
+        ``lazy=True``. All pending steps are run in one pass over the cells.
+        """
+        if self._stream is True:
+            raise ValueError('Steps are applied by `save` when stream is True')
+        if len(self._pending) > 0:
+            stats = self._new_stats(self.recipe[-len(self._pending):])
+            self.ntbk = preprocess_cells(self.ntbk, self._pending, {},
+                                         self._shared_cells, stats=stats)[0]
+            self._record_stats(stats)
+            self._pending = []
+            self._cell_index = None
+        return self
+
+    def apply_recipe(self, recipe):
+        """Run a list of cleaning steps on this notebook.
+
+        Parameters
+        ----------
+        recipe : list of (str, dict) | instance of NotebookCleaner
+            Each step is the name of a cleaning method (e.g. ``'clear'``)
+            and the keyword arguments to call it with. This is the format of
+            the `recipe` attribute, so the steps applied by another
+            `NotebookCleaner` may be passed directly.
+        """
+        recipe = _check_recipe(recipe)
+        for name, kwargs in recipe:
+            getattr(self, name)(**kwargs)
+        return self
+
+    def fork(self):
+        """Start a new cleaner from the current state of this notebook.
+
+        Any pending steps are applied first. The new cleaner shares its cells
+        with this one, and from then on either of them copies a shared cell
+        right before changing it. Each fork only pays for the cells that it
+        changes, so this is a cheap way to make several variants of one
+        notebook (see `clean_variants`).
+
+        Returns
+        -------
+        cleaner : instance of NotebookCleaner
+            The new cleaner. It has the same options, and starts with the
+            `recipe`, `preprocessors` and `stats` of this one.
+        """
+        if self._stream is True:
+            raise ValueError('Notebooks cannot be forked when stream is True')
+        self.apply()
+        other = NotebookCleaner(self.ntbk, verbose=self._verbose,
+                                lazy=self._lazy, profile=self._profile,
+                                callback=self._callback)
+        # Cells now belong to both notebooks, so neither may change them
+        self._shared_cells.update(other._shared_cells)
+        other.preprocessors = list(self.preprocessors)
+        other.recipe = list(self.recipe)
+        other.stats = list(self.stats)
+        return other
+
+    def clear(self, kind, tag=None, search_text=None, clear=None,
+              regex=None):
         """Clear the components of a notebook cell.
 
         Parameters
@@ -39,12 +224,17 @@ class NotebookCleaner(object):
                 "output_image": the image output of cells.
                 "stderr": the stderr of cells.
             If a list, must contain one or more of the above strings.
-        tag : string | None
-            Only apply clearing to cells with a certain tag. If
-            None, apply clearing to all cells.
-        search_text : str | None
-            A string to search for within cells. Any cells with this string
-            inside will be removed.
+        tag : string | list of strings | None
+            Only apply clearing to cells with a certain tag, or with any of
+            a list of tags. If None, apply clearing to all cells.
+        search_text : str | list of str | None
+            A string, or list of strings, to search for within cells. Only
+            cells with any of these strings inside will be cleared. Ignored
+            if `tag` is given.
+        regex : str | list of str | None
+            A regular expression, or list of them, to search for within
+            cells. Only cells matching any of these (or `search_text`) will
+            be cleared. Ignored if `tag` is given.
         """
         ALLOWED_KINDS = ['content', 'output', 'output_text',
                          'output_image', 'stderr']
@@ -58,42 +248,61 @@ class NotebookCleaner(object):
         kwargs = {key: key in kind for key in ALLOWED_KINDS}
 
         # See if the cell matches the string
-        pre = ClearCells(tag=str(tag), search_text=str(search_text), **kwargs)
-        self.ntbk = pre.preprocess(self.ntbk, {})[0]
-        self.preprocessors.append(pre)
-        return self
+        step = ('clear', dict(kind=kind, tag=tag, search_text=search_text,
+                              regex=regex))
+        tag = 'None' if tag is None else tag
+        search_text = 'None' if search_text is None else search_text
+        regex = 'None' if regex is None else regex
+        pre = ClearCells(tag=tag, search_text=search_text, regex=regex,
+                         **kwargs)
+        return self._add_preprocessor(pre, step)
 
-    def remove_cells(self, tag=None, empty=False, search_text=None):
+    def remove_cells(self, tag=None, empty=False, search_text=None,
+                     regex=None):
         """Remove cells that match a given tag.
 
         Parameters
         ----------
-        tag : str | None
+        tag : str | list of str | None
             A string to search for in cell tags cells. Any cells with the
-            tag inside will be removed.
+            tag (or any of a list of tags) will be removed.
         empty : bool
             Whether to remove any cell that is empty.
-        search_text : str | None
-            A string to search for within cells. Any cells with this string
-            inside will be removed.
+        search_text : str | list of str | None
+            A string, or list of strings, to search for within cells. Any
+            cells with any of these strings inside will be removed. Ignored
+            if `tag` is given.
+        regex : str | list of str | None
+            A regular expression, or list of them, to search for within
+            cells. Any cells matching any of these (or `search_text`) will
+            be removed. Ignored if `tag` is given.
         """
+        if not CellMatcher(tag, search_text, regex).active and not empty:
+            raise ValueError("One of `tag`, `empty`, `search_text`, or "
+                             "`regex` must be used.")
+        step = ('remove_cells', dict(tag=tag, empty=empty,
+                                     search_text=search_text, regex=regex))
         # See if the cell matches the string
         tag = 'None' if tag is None else tag
         search_text = 'None' if search_text is None else search_text
+        regex = 'None' if regex is None else regex
 
-        pre = RemoveCells(tag=tag, empty=empty, search_text=search_text)
-        self.ntbk = pre.preprocess(self.ntbk, {})[0]
-        self.preprocessors.append(pre)
-        return self
+        pre = RemoveCells(tag=tag, empty=empty, search_text=search_text,
+                          regex=regex)
+        return self._add_preprocessor(pre, step)
 
-    def create_tests(self, tag, oktest_path, base_dir):
+    def create_tests(self, tag, oktest_path, base_dir, output='files'):
         """Create tests for code cells that are tagged with `tag`.
 
         The cell source will be used as the code for the doctest that is
         created. This function assumes that `test_path` is a directory
         relative to the final notebook directory specified in `base_dir`.
 
-        Tests are created using the oktest format.
+        Tests are created using the oktest format. Cells with the same
+        source share a test, and all tests are written once the cells have
+        been processed. Test files that already exist with the same contents
+        are left untouched. The tests that were created are listed in
+        `test_manifest`.
 
         Parameters
         ----------
@@ -104,13 +313,49 @@ class NotebookCleaner(object):
             path relative to where the processed notebook will be stored.
         base_dir : str
             Path at which the processed notebook will be stored.
+        output : 'files' | 'bundle' | 'memory'
+            Where to put the tests. 'files' writes one file per test.
+            'bundle' writes all of them to a single JSON file,
+            ``<test_path>/tests.json``, that maps the path of each test to
+            its contents. 'memory' doesn't write anything, and the tests are
+            only available from `tests`.
         """
         pre = ConvertCells(tag=tag,
                            oktest_path=oktest_path,
-                           base_dir=base_dir)
-        self.ntbk = pre.preprocess(self.ntbk, {})[0]
-        self.preprocessors.append(pre)
-        return self
+                           base_dir=base_dir,
+                           output=output)
+        return self._add_preprocessor(
+            pre, ('create_tests', dict(tag=tag, oktest_path=oktest_path,
+                                       base_dir=base_dir, output=output)))
+
+    @property
+    def tests(self):
+        """The contents of the oktests created so far, keyed by their path."""
+        tests = {}
+        for pre in self.preprocessors:
+            if isinstance(pre, ConvertCells):
+                tests.update(pre.tests)
+        return tests
+
+    @property
+    def test_manifest(self):
+        """The oktests created so far.
+
+        Each test is described by a dictionary with its ``path``, the
+        positions in `ntbk` of the ``cells`` that now run it (None if the
+        notebook was streamed), and whether it was ``written`` to disk, i.e.
+        whether its contents changed.
+        """
+        manifest = [dict(test) for pre in self.preprocessors
+                    if isinstance(pre, ConvertCells) for test in pre.manifest]
+        if self._stream is True:
+            return manifest
+        # Later steps may have moved the cells
+        cells = _test_cells(self.ntbk['cells'],
+                            [test['path'] for test in manifest])
+        for test in manifest:
+            test['cells'] = cells[test['path']]
+        return manifest
 
     def replace_text(self, text_replace_begin=u'### SOLUTION BEGIN',
                      text_replace_end=u'### SOLUTION END',
@@ -123,10 +368,13 @@ class NotebookCleaner(object):
 
         Parameters
         ----------
-        text_replace_begin : str
+        text_replace_begin : str | list of str
             A string to search for in input cells. If the string is
             found, then anything between it and `text_replace_end` is removed.
-        text_replace_end : str
+            If a list, each string starts a region that is ended by the
+            string at the same position in `text_replace_end`, so several
+            styles of delimiters can be removed in one pass.
+        text_replace_end : str | list of str
             The ending delimiter for solution cells.
         replace_code : str | None
             Text to add to code solution cells. If None, `nbgrader`
@@ -135,6 +383,10 @@ class NotebookCleaner(object):
             Text to add to markdown solution cells. If None, a default template
             will be used.
         """
+        step = ('replace_text',
+                dict(text_replace_begin=text_replace_begin,
+                     text_replace_end=text_replace_end,
+                     replace_code=replace_code, replace_md=replace_md))
         kwargs = dict(begin_solution_delimeter=text_replace_begin,
                       end_solution_delimeter=text_replace_end,
                       enforce_metadata=False)
@@ -146,17 +398,76 @@ class NotebookCleaner(object):
                           'lines*\n\n---')
         kwargs['text_stub'] = replace_md
         pre = ClearSolutions(**kwargs)
-        self.ntbk = pre.preprocess(self.ntbk, {})[0]
-        self.preprocessors.append(pre)
-        return self
+        return self._add_preprocessor(pre, step)
+
+    def compact(self, max_cell_bytes=None, max_bytes=None, dedupe=True,
+                drop_redundant=True, max_image_size=None):
+        """Shrink cell outputs so the notebook is smaller and loads faster.
 
-    def save(self, path_save):
+        Sizes are measured as the number of characters in the JSON of the
+        outputs. When a budget is exceeded, the largest outputs are shrunk
+        first: streams are truncated in the middle, and other outputs are
+        replaced by a short note saying how large they were.
+
+        Parameters
+        ----------
+        max_cell_bytes : int | None
+            The maximum size of the outputs of each cell. If None, there is
+            no limit.
+        max_bytes : int | None
+            The maximum size of all of the outputs in the notebook. If None,
+            there is no limit.
+        dedupe : bool
+            Whether to replace rich outputs (e.g. plots) that are identical
+            to an earlier output with a note.
+        drop_redundant : bool
+            Whether to keep only one rich representation of each output,
+            along with its plain text. PNG is preferred, then JPEG, SVG,
+            HTML, markdown and LaTeX.
+        max_image_size : int | None
+            If given, PNG and JPEG images are downsampled so that neither
+            side is larger than this many pixels, and recompressed. Images
+            are only replaced if this makes them smaller. Requires Pillow.
+        """
+        pre = CompactOutputs(max_cell_bytes=max_cell_bytes,
+                             max_bytes=max_bytes, dedupe=dedupe,
+                             drop_redundant=drop_redundant,
+                             max_image_size=max_image_size)
+        return self._add_preprocessor(
+            pre, ('compact', dict(max_cell_bytes=max_cell_bytes,
+                                  max_bytes=max_bytes, dedupe=dedupe,
+                                  drop_redundant=drop_redundant,
+                                  max_image_size=max_image_size)))
+
+    def save(self, path_save, validate='full', json_backend='json',
+             skip_unchanged=False):
         """Save the notebook to disk.
 
+        Any preprocessors that have not been applied yet are run first.
+
         Parameters
         ----------
         path_save : string
             The path for saving the file.
+        validate : 'full' | 'sample' | 'off'
+            How thoroughly to check the notebook against the nbformat schema
+            before writing it. 'sample' only checks the notebook structure
+            and a few of its cells. Problems are logged, not raised. Streamed
+            notebooks are never validated.
+        json_backend : 'json' | 'orjson' | 'auto'
+            The library used to serialize the notebook. 'json' gives the same
+            output as `nbformat.write`. 'orjson' is much faster but indents
+            with two spaces. 'auto' uses orjson if it is installed.
+        skip_unchanged : bool
+            Whether to leave `path_save` untouched if it already holds
+            exactly what would be written, so that its modification time
+            doesn't change and tools that watch it aren't triggered.
+            Otherwise, the file is replaced atomically.
+
+        Returns
+        -------
+        written : bool
+            Whether the file was written.
         """
         dir_save = os.path.dirname(path_save)
         if self._verbose is True:
@@ -164,4 +475,209 @@ class NotebookCleaner(object):
         # if we are saving to a subdirectory make sure it exists
         if dir_save and not os.path.exists(dir_save):
             os.makedirs(dir_save)
-        nbf.write(self.ntbk, path_save)
+        if self._stream is True:
+            version = _file_version(path_save)
+            # Every step is replayed, since the source file is read again
+            preprocess_file(self._path, path_save, self.preprocessors,
+                            skip_unchanged=skip_unchanged)
+            self._pending = []
+            return _file_version(path_save) != version
+        self.apply()
+        return _write_nb(self.ntbk, path_save, validate=validate,
+                         json_backend=json_backend,
+                         skip_unchanged=skip_unchanged)
+
+    async def save_async(self, path_save, validate='full', json_backend='json',
+                         skip_unchanged=False):
+        """Save the notebook to disk without blocking the event loop.
+
+        This runs `save` in the event loop's default executor, so any
+        pending preprocessors and the write itself happen in a thread.
+        Cancelling the coroutine doesn't interrupt a save that has already
+        started in the thread.
+
+        Parameters
+        ----------
+        path_save : string
+            The path for saving the file.
+        validate : 'full' | 'sample' | 'off'
+            See `save`.
+        json_backend : 'json' | 'orjson' | 'auto'
+            See `save`.
+        skip_unchanged : bool
+            See `save`.
+
+        Returns
+        -------
+        written : bool
+            Whether the file was written.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.save, path_save, validate=validate,
+                          json_backend=json_backend,
+                          skip_unchanged=skip_unchanged))
+
+
+def _check_recipe(recipe):
+    if isinstance(recipe, NotebookCleaner):
+        recipe = recipe.recipe
+    recipe = [tuple(step) for step in recipe]
+    for step in recipe:
+        if len(step) != 2 or step[0] not in RECIPE_STEPS:
+            raise ValueError('Each recipe step must be a (name, kwargs) pair '
+                             'where name is one of {}, got {}'.format(
+                                 RECIPE_STEPS, step))
+    return recipe
+
+
+def clean_notebook_directory(path, path_save, recipe, overwrite=False,
+                             n_jobs=1, ordered=True, cache=None,
+                             validate='full'):
+    """Clean all the notebooks in a directory and save them somewhere else.
+
+    Parameters
+    ----------
+    path : str
+        A path to a directory that contains jupyter notebooks. All notebooks
+        in this folder ending in `.ipynb` will be cleaned. This may
+        optionally contain a wildcard matching ``<something>.ipynb`` in which
+        case only notebooks that match will be cleaned.
+    path_save : str
+        A path to a directory in which to save the cleaned notebooks, using
+        the same file names as the inputs. If this doesn't exist, it will
+        be created.
+    recipe : list of (str, dict) | instance of NotebookCleaner
+        The cleaning steps to apply to each notebook. See
+        `NotebookCleaner.apply_recipe`.
+    overwrite : bool
+        Whether to write into `path_save` if it already exists.
+    n_jobs : int
+        The number of notebooks to clean at the same time, each in its own
+        worker process. If -1, use one worker per CPU.
+    ordered : bool
+        Whether to return results in the same order as the input notebooks.
+        If False, results are returned in the order that they finish.
+    cache : instance of NotebookCache | None
+        A cache of previously-cleaned notebooks. Notebooks that haven't
+        changed since they were cleaned with the same recipe are copied from
+        the cache instead of being cleaned again. Recipes that create tests
+        are never cached, since they write files besides the notebook.
+    validate : 'full' | 'sample' | 'off'
+        How thoroughly to check notebooks against the nbformat schema when
+        they are read and written. See `NotebookCleaner`.
+
+    Returns
+    -------
+    summaries : list of dict
+        One entry per notebook, with the input ``path``, the ``path_save``
+        it was written to, the ``time`` in seconds it took to clean, the
+        ``error`` that was raised while cleaning it (or None), and whether
+        it was ``cached``. A notebook that raises an error is not saved, but
+        does not stop the others from being cleaned.
+    """
+    recipe = _check_recipe(recipe)
+    notebooks = _find_notebooks(path)
+    if op.exists(path_save) and overwrite is not True:
+        raise ValueError('path_save exists and overwrite is not True')
+    os.makedirs(path_save, exist_ok=True)
+
+    if any(name == 'create_tests' for name, _ in recipe):
+        cache = None
+
+    # Use cached outputs for notebooks that haven't changed
+    results = {}
+    keys = {}
+    if cache is not None:
+        for filename in notebooks:
+            start = time.perf_counter()
+            keys[filename] = cache.key(filename, recipe)
+            path_cached = cache.get(keys[filename])
+            if path_cached is None:
+                continue
+            path_out = op.join(path_save, op.basename(filename))
+            _copy_file(path_cached, path_out, skip_unchanged=True)
+            results[filename] = dict(path=filename, path_save=path_out,
+                                     error=None, cached=True,
+                                     time=time.perf_counter() - start)
+
+    to_clean = [filename for filename in notebooks
+                if filename not in results]
+    clean = partial(_clean_and_save, path_save=path_save, recipe=recipe,
+                    validate=validate)
+    for summary in _parallel_map(clean, to_clean, n_jobs=n_jobs,
+                                 ordered=ordered):
+        if cache is not None and summary['error'] is None:
+            cache.put(keys[summary['path']], summary['path_save'])
+        results[summary['path']] = summary
+
+    if ordered is True:
+        return [results[filename] for filename in notebooks]
+    return list(results.values())
+
+
+def clean_variants(ntbk, variants, base=None, path_save=None,
+                   validate='full'):
+    """Make several cleaned versions of one notebook.
+
+    The notebook is read, and the `base` steps applied, only once. Each
+    variant is then a `NotebookCleaner.fork` of the result, so the cells
+    that a variant doesn't change are shared rather than copied.
+
+    Parameters
+    ----------
+    ntbk : str | instance of NotebookNode
+        The input notebook. A `NotebookNode` is left untouched.
+    variants : dict
+        Maps the name of each variant to the cleaning steps that make it,
+        as a list of (str, dict) or an instance of NotebookCleaner. See
+        `NotebookCleaner.apply_recipe`.
+    base : list of (str, dict) | instance of NotebookCleaner | None
+        Cleaning steps that are shared by all of the variants, applied
+        before their own steps.
+    path_save : str | None
+        If given, each variant is saved to this path, with ``{name}``
+        replaced by the name of the variant, e.g.
+        ``'build/{name}/homework.ipynb'``.
+    validate : 'full' | 'sample' | 'off'
+        How thoroughly to check the notebook against the nbformat schema
+        when it is read and when variants are written. See
+        `NotebookCleaner`.
+
+    Returns
+    -------
+    cleaners : dict
+        Maps the name of each variant to its instance of NotebookCleaner.
+        Their `recipe` includes the `base` steps.
+    """
+    if path_save is not None and '{name}' not in path_save:
+        raise ValueError('path_save must contain "{{name}}", got {}'.format(
+            path_save))
+    variants = {name: _check_recipe(recipe)
+                for name, recipe in variants.items()}
+    cleaner = NotebookCleaner(ntbk, lazy=True, validate=validate)
+    if base is not None:
+        cleaner.apply_recipe(base)
+    cleaners = {}
+    for name, recipe in variants.items():
+        cleaners[name] = cleaner.fork().apply_recipe(recipe)
+        if path_save is not None:
+            cleaners[name].save(path_save.format(name=name),
+                                validate=validate)
+        else:
+            cleaners[name].apply()
+    return cleaners
+
+
+def _clean_and_save(filename, path_save, recipe, validate='full'):
+    """Clean one notebook and save it, returning a summary of the run."""
+    path_out = op.join(path_save, op.basename(filename))
+    summary = dict(path=filename, path_save=path_out, error=None,
+                   cached=False)
+    start = time.perf_counter()
+    try:
+        ntbk = NotebookCleaner(filename, lazy=True, validate=validate)
+        ntbk.apply_recipe(recipe).save(path_out, validate=validate)
+    except Exception as err:
+        summary['error'] = '{}: {}'.format(type(err).__name__, err)
+    summary['time'] = time.perf_counter() - start
+    return summary
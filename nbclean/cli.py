@@ -0,0 +1,173 @@
+"""The ``nbclean`` command line interface."""
+import argparse
+import json
+import os
+import os.path as op
+import sys
+import time
+from functools import partial
+from glob import glob
+
+from .clean import NotebookCleaner, _check_recipe, _clean_and_save
+from .utils import VALIDATE_MODES, _check_n_jobs, _parallel_map
+
+
+def load_recipe(path):
+    """Load a cleaning recipe from a JSON file.
+
+    The file holds a list of steps. Each step is either an object with a
+    single key, the name of a `NotebookCleaner` method, mapping to its
+    keyword arguments, or a ``[name, kwargs]`` pair as in
+    `NotebookCleaner.recipe`. Dashes in names are read as underscores. For
+    example::
+
+        [
+          {"clear": {"kind": "output", "tag": "hide_output"}},
+          {"remove-cells": {"tag": "remove"}},
+          {"replace-text": {"text_replace_begin": "### SOLUTION BEGIN",
+                            "text_replace_end": "### SOLUTION END"}}
+        ]
+
+    Parameters
+    ----------
+    path : str
+        The path to the recipe file.
+
+    Returns
+    -------
+    recipe : list of (str, dict)
+        The recipe, which can be passed to `NotebookCleaner.apply_recipe`.
+    """
+    with open(path, 'r', encoding='utf-8') as ff:
+        steps = json.load(ff)
+    if isinstance(steps, dict):
+        steps = steps.get('steps', [])
+    recipe = []
+    for step in steps:
+        if isinstance(step, dict):
+            if len(step) != 1:
+                raise ValueError('Each recipe step must have exactly one '
+                                 'key, got {}'.format(step))
+            step = list(step.items())[0]
+        name, kwargs = step
+        recipe.append((name.replace('-', '_'), dict(kwargs or {})))
+    return _check_recipe(recipe)
+
+
+def _expand(inputs):
+    """Return the notebooks matched by files, folders, or glob patterns."""
+    notebooks = []
+    for pattern in inputs:
+        if op.isdir(pattern):
+            pattern = op.join(pattern, '*.ipynb')
+        matches = sorted(glob(pattern, recursive=True))
+        if len(matches) == 0:
+            raise ValueError('No notebooks match {}'.format(pattern))
+        notebooks.extend(match for match in matches
+                         if match not in notebooks)
+    return notebooks
+
+
+def _check_file(filename, path_save, recipe, validate='full'):
+    """Apply a recipe without saving anything, returning a summary."""
+    path_out = op.join(path_save, op.basename(filename))
+    summary = dict(path=filename, path_save=path_out, error=None,
+                   cached=False)
+    # Keep tests in memory rather than writing them
+    recipe = [(name, dict(kwargs, output='memory'))
+              if name == 'create_tests' else (name, kwargs)
+              for name, kwargs in recipe]
+    start = time.perf_counter()
+    try:
+        ntbk = NotebookCleaner(filename, lazy=True, validate=validate)
+        ntbk.apply_recipe(recipe).apply()
+    except Exception as err:
+        summary['error'] = '{}: {}'.format(type(err).__name__, err)
+    summary['time'] = time.perf_counter() - start
+    return summary
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='nbclean',
+        description='Apply a cleaning recipe to Jupyter notebooks.')
+    parser.add_argument('recipe', help='A JSON file with the cleaning steps.')
+    parser.add_argument('inputs', nargs='+',
+                        help='Notebooks, folders of notebooks, or glob '
+                             'patterns (quote them to use ``**``).')
+    parser.add_argument('-o', '--output', required=True,
+                        help='The folder to save cleaned notebooks to.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of notebooks to clean at the same '
+                             'time. -1 uses one worker per CPU.')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace existing notebooks in the output '
+                             'folder.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Apply the recipe, but don\'t write anything.')
+    parser.add_argument('--validate', choices=VALIDATE_MODES, default='full',
+                        help='How thoroughly to validate notebooks.')
+    parser.add_argument('--timing', metavar='PATH',
+                        help='Write the time taken and errors for each '
+                             'notebook as JSON to PATH, or to stdout if '
+                             'PATH is "-".')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Don\'t show progress.')
+    return parser
+
+
+def main(argv=None):
+    """Run the ``nbclean`` command and return its exit code."""
+    args = _parser().parse_args(argv)
+    try:
+        _check_n_jobs(args.jobs)
+        recipe = load_recipe(args.recipe)
+        notebooks = _expand(args.inputs)
+    except (OSError, ValueError) as err:
+        print('nbclean: error: {}'.format(err), file=sys.stderr)
+        return 2
+
+    paths_out = {}
+    for filename in notebooks:
+        path_out = op.join(args.output, op.basename(filename))
+        if path_out in paths_out:
+            print('nbclean: error: {} and {} would both be saved to {}'.format(
+                paths_out[path_out], filename, path_out), file=sys.stderr)
+            return 2
+        if (op.exists(path_out) and not args.overwrite and
+                not args.dry_run):
+            print('nbclean: error: {} exists, use --overwrite to replace '
+                  'it'.format(path_out), file=sys.stderr)
+            return 2
+        paths_out[path_out] = filename
+
+    if args.dry_run:
+        clean = partial(_check_file, path_save=args.output, recipe=recipe,
+                        validate=args.validate)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        clean = partial(_clean_and_save, path_save=args.output, recipe=recipe,
+                        validate=args.validate)
+    start = time.perf_counter()
+    summaries = list(_parallel_map(clean, notebooks, n_jobs=args.jobs,
+                                   progress=not args.quiet))
+    total = time.perf_counter() - start
+
+    errors = [summary for summary in summaries if summary['error']]
+    for summary in errors:
+        print('{}: {}'.format(summary['path'], summary['error']),
+              file=sys.stderr)
+    if not args.quiet:
+        print('{} {} notebooks in {:.2f}s ({} errors)'.format(
+            'Checked' if args.dry_run else 'Cleaned', len(summaries), total,
+            len(errors)), file=sys.stderr)
+    if args.timing is not None:
+        timing = json.dumps(dict(time=total, jobs=args.jobs,
+                                 dry_run=args.dry_run, notebooks=summaries),
+                            indent=1)
+        if args.timing == '-':
+            print(timing)
+        else:
+            with open(args.timing, 'w', encoding='utf-8') as ff:
+                ff.write(timing + '\n')
+    return 1 if len(errors) > 0 else 0
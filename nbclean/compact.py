@@ -0,0 +1,120 @@
+"""Helpers to shrink the outputs of notebook cells."""
+import base64
+import hashlib
+import json
+from io import BytesIO
+
+from nbformat.v4 import new_output
+
+# Rich representations in order of preference. Only the first one present
+# in an output is kept, along with its text/plain fallback.
+_RICH_MIMES = ['image/png', 'image/jpeg', 'image/svg+xml', 'text/html',
+               'text/markdown', 'text/latex']
+_IMAGE_FORMATS = {'image/png': 'PNG', 'image/jpeg': 'JPEG'}
+
+
+def _nbytes(obj):
+    return len(json.dumps(obj, ensure_ascii=False))
+
+
+def _note(text):
+    """Return an output that stands in for one that was removed."""
+    return new_output('display_data', data={'text/plain': text})
+
+
+def _blob_key(output):
+    """Return a hash of the data of a rich output, or None for other outputs."""
+    if 'data' not in output:
+        return None
+    data = json.dumps(output['data'], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _drop_redundant(data):
+    """Keep only the preferred rich representation in a mime bundle."""
+    rich = [mime for mime in _RICH_MIMES if mime in data]
+    for mime in rich[1:]:
+        data.pop(mime)
+
+
+def _check_pillow():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        raise ImportError('max_image_size requires the Pillow package to be '
+                          'installed')
+
+
+def _shrink_image(encoded, mime, max_size):
+    """Downsample a base64 image to `max_size` pixels and recompress it.
+
+    The original is returned if the new image isn't any smaller.
+    """
+    from PIL import Image
+    image = Image.open(BytesIO(base64.b64decode(encoded)))
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    if _IMAGE_FORMATS[mime] == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buf = BytesIO()
+    image.save(buf, format=_IMAGE_FORMATS[mime], optimize=True)
+    shrunk = base64.b64encode(buf.getvalue()).decode('ascii') + '\n'
+    return shrunk if len(shrunk) < len(encoded) else encoded
+
+
+def _shrink_images(data, max_size):
+    for mime in _IMAGE_FORMATS:
+        if mime in data:
+            data[mime] = _shrink_image(data[mime], mime, max_size)
+
+
+def _truncate_stream(output, n_keep):
+    """Keep the first and last `n_keep` / 2 characters of a stream."""
+    text = output['text']
+    head = text[:n_keep // 2]
+    tail = text[len(text) - (n_keep - len(head)):] if n_keep > len(head) else ''
+    marker = '\n[... {} characters truncated ...]\n'.format(
+        len(text) - len(head) - len(tail))
+    return new_output('stream', name=output['name'], text=head + marker + tail)
+
+
+def _fit_outputs(refs, budget):
+    """Shrink outputs until their total size is within `budget`.
+
+    The largest outputs are shrunk first. Streams are truncated, and any
+    other output is replaced by a short note. Outputs are replaced rather
+    than modified.
+
+    Parameters
+    ----------
+    refs : list of (list, int)
+        The list that holds each output, and its position in the list.
+    budget : int
+        The maximum total size of the outputs, in bytes of JSON.
+
+    Returns
+    -------
+    size : int
+        The total size of the outputs afterwards. This can still be over
+        budget if it is smaller than the notes that replace outputs.
+    """
+    sizes = [_nbytes(outputs[ii]) for outputs, ii in refs]
+    total = sum(sizes)
+    final = set()
+    while total > budget and len(final) < len(refs):
+        jj = max((jj for jj in range(len(refs)) if jj not in final),
+                 key=sizes.__getitem__)
+        outputs, ii = refs[jj]
+        output = outputs[ii]
+        excess = total - budget
+        n_keep = len(output.get('text', '')) - excess - 50
+        if output.get('output_type') == 'stream' and n_keep > 0:
+            outputs[ii] = _truncate_stream(output, n_keep)
+        else:
+            outputs[ii] = _note('[Output removed: {} bytes]'.format(
+                sizes[jj]))
+            final.add(jj)
+        size = _nbytes(outputs[ii])
+        total += size - sizes[jj]
+        sizes[jj] = size
+    return total
@@ -0,0 +1,349 @@
+"""A columnar, memory-mapped store of the cells of many notebooks."""
+import json
+import mmap
+import os
+import os.path as op
+import re
+import shutil
+from array import array
+
+import numpy as np
+import nbformat as nbf
+
+from .compact import _nbytes
+from .index import _as_list
+from .utils import (_check_nb_file, _find_notebooks, _get_json_backend,
+                    _write_nb)
+
+CELL_TYPES = ['code', 'markdown', 'raw']
+_VERSION = 1
+# Columns with one value per cell, and their types
+_CELL_COLUMNS = dict(notebook='int32', cell_type='int8', n_outputs='int32',
+                     n_stderr='int32', output_bytes='int64',
+                     execution_count='int32')
+# Separates sources in the source blob, so text searches can't match
+# across two cells
+_SEP = b'\x00'
+
+
+class NotebookCorpus(object):
+    """Query the cells of many notebooks without reading their JSON.
+
+    A corpus is a folder, made by `build_corpus`, that holds one column per
+    cell attribute as a NumPy array, plus the sources and the full JSON of
+    every cell in two blobs. Everything is memory-mapped, so opening a
+    corpus is instant and queries only read the columns they use.
+
+    Queries return boolean masks with one value per cell, which can be
+    combined with ``&``, ``|`` and ``~`` and used to index the columns. For
+    example, the number of stderr outputs in cells tagged ``hide_stderr``
+    is ``corpus.n_stderr[corpus.matches(tag='hide_stderr')].sum()``.
+
+    Parameters
+    ----------
+    path : str
+        The folder of the corpus.
+    json_backend : 'json' | 'orjson' | 'auto'
+        The library used to parse cells. See `NotebookCleaner`.
+
+    Attributes
+    ----------
+    notebooks : list of str
+        The path of each notebook, in the order they were added.
+    notebook : array of int
+        The position in `notebooks` of the notebook each cell belongs to.
+        The cells of each notebook are stored together, in order.
+    cell_type : array of int
+        The type of each cell, as a position in `CELL_TYPES`.
+    n_outputs : array of int
+        The number of outputs of each cell.
+    n_stderr : array of int
+        The number of stderr stream outputs of each cell.
+    output_bytes : array of int
+        The size of the outputs of each cell, in characters of JSON.
+    execution_count : array of int
+        The execution count of each cell, or -1 if there is none.
+    """
+    def __init__(self, path, json_backend='json'):
+        self.path = path
+        with open(op.join(path, 'corpus.json'), 'r', encoding='utf-8') as ff:
+            meta = json.load(ff)
+        if meta['version'] != _VERSION:
+            raise ValueError('Unsupported corpus version {}'.format(
+                meta['version']))
+        self.notebooks = meta['notebooks']
+        self.tags = meta['tags']
+        self._nb_meta = meta['metadata']
+        for name in _CELL_COLUMNS:
+            setattr(self, name, self._load(name))
+        for name in ['cell_offsets', 'source_offsets', 'notebook_offsets',
+                     'tag_cells', 'tag_ids']:
+            setattr(self, '_' + name, self._load(name))
+        self._cells = _map(op.join(path, 'cells.bin'))
+        self._sources = _map(op.join(path, 'sources.bin'))
+        self._tag_index = {tag: ii for ii, tag in enumerate(self.tags)}
+        self._loads = _get_json_backend(json_backend)[0]
+
+    def _load(self, name):
+        return np.load(op.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.cell_type)
+
+    def __repr__(self):
+        s = "<NotebookCorpus> {}\n---".format(self.path)
+        s += "\nNotebooks: {} | Cells: {} | Tags: {}".format(
+            len(self.notebooks), len(self), len(self.tags))
+        return s
+
+    def source(self, index):
+        """Return the source of a cell."""
+        start, stop = self._source_offsets[index:index + 2]
+        # Leave out the separator after the source
+        return self._sources[start:stop - len(_SEP)].decode('utf-8')
+
+    def cell(self, index):
+        """Return a cell as a `NotebookNode`."""
+        start, stop = self._cell_offsets[index:index + 2]
+        return nbf.from_dict(self._loads(self._cells[start:stop]))
+
+    def has_tag(self, tag):
+        """Return a mask of the cells with any of the given tags."""
+        ids = [self._tag_index[tag] for tag in _as_list(tag)
+               if tag in self._tag_index]
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self._tag_cells[np.isin(self._tag_ids, ids)]] = True
+        return mask
+
+    def contains(self, search_text=None, regex=None):
+        """Return a mask of the cells whose source matches.
+
+        Cells match if their source contains any of the strings in
+        `search_text` or matches any of the regular expressions in `regex`,
+        as with `CellMatcher`. The strings are searched for in the sources
+        of all cells in one pass. Regular expressions could match across
+        cells or treat ``^`` differently there, so they are searched for in
+        each source on its own, only in cells that aren't matched already.
+        """
+        texts = _as_list(search_text)
+        # Only strings without the separator are sure to stay in one cell
+        regexes = [re.escape(text) for text in texts if _SEP.decode() in text]
+        regexes += _as_list(regex)
+        texts = [text for text in texts if _SEP.decode() not in text]
+        mask = np.zeros(len(self), dtype=bool)
+        if len(self) == 0:
+            return mask
+        if len(texts) > 0:
+            pattern = re.compile(b'|'.join(re.escape(text.encode('utf-8'))
+                                           for text in texts))
+            starts = np.fromiter(
+                (match.start() for match in pattern.finditer(self._sources)),
+                dtype='int64')
+            # Positions in the blob are turned into cells by their offsets
+            cells = np.searchsorted(self._source_offsets, starts,
+                                    side='right') - 1
+            mask[cells[cells < len(self)]] = True
+        if len(regexes) > 0:
+            pattern = re.compile('|'.join('(?:{})'.format(regex)
+                                          for regex in regexes))
+            for ii in np.flatnonzero(~mask):
+                mask[ii] = pattern.search(self.source(ii)) is not None
+        return mask
+
+    def is_empty(self):
+        """Return a mask of the cells with an empty source."""
+        return np.diff(self._source_offsets) == len(_SEP)
+
+    def is_type(self, cell_type):
+        """Return a mask of the cells of any of the given types."""
+        return np.isin(self.cell_type, [CELL_TYPES.index(kind)
+                                        for kind in _as_list(cell_type)])
+
+    def matches(self, tag=None, search_text=None, regex=None):
+        """Return a mask of the cells that `remove_cells` would select.
+
+        As in `NotebookCleaner.remove_cells`, cells are matched on their
+        tags if any are given, and otherwise on their source.
+        """
+        if len(_as_list(tag)) > 0:
+            return self.has_tag(tag)
+        return self.contains(search_text, regex)
+
+    def cells_of(self, notebook):
+        """Return the positions of the cells of a notebook."""
+        return np.arange(self._notebook_offsets[notebook],
+                         self._notebook_offsets[notebook + 1])
+
+    def to_notebook(self, notebook, keep=None, clear_outputs=None):
+        """Rebuild a notebook from the corpus.
+
+        Parameters
+        ----------
+        notebook : int
+            The position of the notebook in `notebooks`.
+        keep : array of bool | None
+            A mask of the cells to keep, e.g.
+            ``~corpus.matches(tag="remove")``.
+            If None, keep all cells.
+        clear_outputs : array of bool | None
+            A mask of the cells whose outputs are cleared, as by
+            ``clear(kind='output')``.
+
+        Returns
+        -------
+        ntbk : instance of NotebookNode
+            The notebook.
+        """
+        ntbk = nbf.from_dict(self._nb_meta[notebook])
+        cells = self.cells_of(notebook)
+        if keep is not None:
+            cells = cells[keep[cells]]
+        ntbk['cells'] = [self.cell(ii) for ii in cells]
+        if clear_outputs is not None:
+            for ii, cell in zip(cells, ntbk['cells']):
+                if clear_outputs[ii] and cell['cell_type'] == 'code':
+                    cell['outputs'] = []
+        return ntbk
+
+    def export(self, path_save, keep=None, clear_outputs=None,
+               notebooks=None, validate='full'):
+        """Write notebooks from the corpus back to ``.ipynb`` files.
+
+        Parameters
+        ----------
+        path_save : str
+            The folder to write the notebooks to, with their original file
+            names. It is created if it doesn't exist.
+        keep : array of bool | None
+            See `to_notebook`.
+        clear_outputs : array of bool | None
+            See `to_notebook`.
+        notebooks : list of int | None
+            The positions of the notebooks to write. If None, write all of
+            them.
+        validate : 'full' | 'sample' | 'off'
+            How thoroughly to check each notebook against the nbformat
+            schema before writing it. See `NotebookCleaner`.
+
+        Returns
+        -------
+        paths : list of str
+            The paths of the written notebooks.
+        """
+        os.makedirs(path_save, exist_ok=True)
+        if notebooks is None:
+            notebooks = range(len(self.notebooks))
+        paths = []
+        for notebook in notebooks:
+            path_out = op.join(path_save, op.basename(
+                self.notebooks[notebook]))
+            _write_nb(self.to_notebook(notebook, keep, clear_outputs),
+                      path_out, validate=validate)
+            paths.append(path_out)
+        return paths
+
+
+def build_corpus(path, path_corpus, overwrite=False, validate='full',
+                 json_backend='json'):
+    """Compile a folder of notebooks into a `NotebookCorpus`.
+
+    Notebooks are read one at a time, and their cells are appended to the
+    corpus files as they go, so the whole archive is never in memory.
+
+    Parameters
+    ----------
+    path : str | list of str
+        A path to a directory that contains jupyter notebooks, optionally
+        with a wildcard matching ``<something>.ipynb``, or a list of
+        notebook paths.
+    path_corpus : str
+        The folder to write the corpus to.
+    overwrite : bool
+        Whether to replace `path_corpus` if it already exists.
+    validate : 'full' | 'sample' | 'off'
+        How thoroughly to check notebooks against the nbformat schema when
+        they are read. See `NotebookCleaner`.
+    json_backend : 'json' | 'orjson' | 'auto'
+        The library used to parse notebooks. See `NotebookCleaner`.
+
+    Returns
+    -------
+    corpus : instance of NotebookCorpus
+        The new corpus.
+    """
+    notebooks = _find_notebooks(path) if isinstance(path, str) else list(path)
+    if op.exists(path_corpus):
+        if overwrite is not True:
+            raise ValueError('path_corpus exists and overwrite is not True')
+        shutil.rmtree(path_corpus)
+    os.makedirs(path_corpus)
+
+    columns = {name: array('q') for name in _CELL_COLUMNS}
+    offsets = dict(cell_offsets=array('q', [0]),
+                   source_offsets=array('q', [0]),
+                   notebook_offsets=array('q', [0]))
+    tag_cells, tag_ids = array('q'), array('q')
+    tags = {}
+    nb_meta = []
+    n_cells = 0
+    path_cells = op.join(path_corpus, 'cells.bin')
+    path_sources = op.join(path_corpus, 'sources.bin')
+    with open(path_cells, 'wb') as f_cells, \
+            open(path_sources, 'wb') as f_sources:
+        for ii, filename in enumerate(notebooks):
+            ntbk = _check_nb_file(filename, validate=validate,
+                                  json_backend=json_backend)
+            nb_meta.append({key: val for key, val in ntbk.items()
+                            if key != 'cells'})
+            for cell in ntbk['cells']:
+                outputs = cell.get('outputs', [])
+                columns['notebook'].append(ii)
+                columns['cell_type'].append(
+                    CELL_TYPES.index(cell['cell_type']))
+                columns['n_outputs'].append(len(outputs))
+                columns['n_stderr'].append(sum(
+                    output.get('name') == 'stderr' for output in outputs))
+                columns['output_bytes'].append(
+                    _nbytes(outputs) if len(outputs) > 0 else 0)
+                count = cell.get('execution_count')
+                columns['execution_count'].append(
+                    -1 if count is None else count)
+                for tag in cell['metadata'].get('tags', []):
+                    tag_cells.append(n_cells)
+                    tag_ids.append(tags.setdefault(tag, len(tags)))
+
+                source = cell['source'].encode('utf-8')
+                f_sources.write(source + _SEP)
+                offsets['source_offsets'].append(
+                    offsets['source_offsets'][-1] + len(source) + len(_SEP))
+                data = json.dumps(cell, ensure_ascii=False,
+                                  separators=(',', ':')).encode('utf-8')
+                f_cells.write(data)
+                offsets['cell_offsets'].append(
+                    offsets['cell_offsets'][-1] + len(data))
+                n_cells += 1
+            offsets['notebook_offsets'].append(n_cells)
+
+    for name, values in list(columns.items()) + list(offsets.items()):
+        _save(path_corpus, name, np.array(values, dtype=_CELL_COLUMNS.get(
+            name, 'int64')))
+    _save(path_corpus, 'tag_cells', np.array(tag_cells, dtype='int64'))
+    _save(path_corpus, 'tag_ids', np.array(tag_ids, dtype='int32'))
+    meta = dict(version=_VERSION, notebooks=notebooks, tags=list(tags),
+                metadata=nb_meta)
+    with open(op.join(path_corpus, 'corpus.json'), 'w',
+              encoding='utf-8') as ff:
+        json.dump(meta, ff)
+    return NotebookCorpus(path_corpus, json_backend=json_backend)
+
+
+def _save(path_corpus, name, values):
+    np.save(op.join(path_corpus, name + '.npy'), values)
+
+
+def _map(path_blob):
+    """Memory-map a blob, read-only."""
+    with open(path_blob, 'rb') as ff:
+        if op.getsize(path_blob) == 0:
+            return b''
+        return mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
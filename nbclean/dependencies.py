@@ -0,0 +1,175 @@
+"""Find groups of notebook cells that can run independently of each other."""
+import ast
+import re
+
+PARALLEL_MODES = ['auto', 'tags']
+# Cells with a tag that starts with this, e.g. "group:plots", are run
+# together in the same kernel
+GROUP_TAG_PREFIX = 'group:'
+# Line magics that only configure the kernel, so they can run in every kernel
+_SETUP_MAGICS = {'matplotlib', 'config', 'load_ext', 'autoreload',
+                 'precision'}
+# Calls that can read or write any variable
+_DYNAMIC_CALLS = {'exec', 'eval', 'globals', 'locals', 'vars',
+                  'get_ipython'}
+_MAGIC = re.compile(r'^[ \t]*%(?!%)(\w+)', re.M)
+
+
+def _cell_names(source):
+    """Return the variables that a code cell defines and mentions.
+
+    Returns
+    -------
+    defines : set of str | None
+        The variables that the cell assigns, imports or deletes, or None if
+        this can't be known, e.g. because the cell uses shell commands, cell
+        magics or ``exec``.
+    mentions : set of str | None
+        All of the variables that the cell defines or uses.
+    setup : bool
+        Whether the cell only imports modules and configures the kernel,
+        so it is safe to run in every kernel.
+    """
+    for match in _MAGIC.finditer(source):
+        if match.group(1) not in _SETUP_MAGICS:
+            return None, None, False
+    try:
+        tree = ast.parse(_MAGIC.sub('pass  #', source))
+    except SyntaxError:
+        # Shell commands, cell magics, help, or just invalid code
+        return None, None, False
+    setup = len(tree.body) > 0 and all(
+        isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass))
+        for node in tree.body)
+
+    defines, mentions = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id in _DYNAMIC_CALLS:
+                return None, None, False
+            mentions.add(node.id)
+            if not isinstance(node.ctx, ast.Load):
+                defines.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                               ast.ClassDef)):
+            defines.add(node.name)
+        elif isinstance(node, ast.alias):
+            defines.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            defines.update(node.names)
+    return defines, mentions | defines, setup
+
+
+def _group_tags(cell):
+    return [tag[len(GROUP_TAG_PREFIX):]
+            for tag in cell['metadata'].get('tags', [])
+            if tag.startswith(GROUP_TAG_PREFIX)]
+
+
+def cell_groups(ntbk, mode='auto'):
+    """Split the code cells of a notebook into groups that don't interact.
+
+    With ``mode='auto'``, two cells are in the same group if they both
+    mention a variable or module that one of the cells in the notebook
+    defines or imports, e.g. one cell loads ``data`` and the other plots it,
+    or one calls ``random.seed`` and the other ``random.random``. Cells
+    whose variables can't be worked out (shell commands, cell magics,
+    ``exec``, ...) and notebooks in other languages than Python put every
+    cell in one group. Cells that only import modules or configure the
+    kernel (e.g. ``%matplotlib inline``) are setup cells. Only variables
+    are tracked, so cells that share state in other ways, such as one
+    writing a file that another reads, should be given the same
+    ``group:<name>`` tag.
+
+    With ``mode='tags'``, cells with the same ``group:<name>`` tag are in
+    the same group, and the variables of tagged cells aren't checked, so
+    that e.g. two groups can both use ``data`` when each defines its own.
+    Other cells are grouped as with ``mode='auto'``, and are also put in
+    the group of any tagged cell that mentions one of their variables.
+
+    Parameters
+    ----------
+    ntbk : instance of NotebookNode
+        The notebook.
+    mode : 'auto' | 'tags'
+        How to find the groups.
+
+    Returns
+    -------
+    setup : list of int
+        The positions of cells that should run in every kernel, before the
+        cells of its groups that come after them.
+    groups : list of list of int
+        The positions of the cells in each group, in order. Each group can
+        run in its own kernel.
+    """
+    if mode not in PARALLEL_MODES:
+        raise ValueError('mode must be one of {}, got {}'.format(
+            PARALLEL_MODES, mode))
+    positions = [ii for ii, cell in enumerate(ntbk['cells'])
+                 if cell['cell_type'] == 'code']
+    language = ntbk['metadata'].get('kernelspec', {}).get('language',
+                                                          'python')
+    parents = {ii: ii for ii in positions}
+
+    def find(ii):
+        while parents[ii] != ii:
+            parents[ii] = parents[parents[ii]]
+            ii = parents[ii]
+        return ii
+
+    def union(ii, jj):
+        parents[find(jj)] = find(ii)
+
+    setup = []
+    defined = set()
+    # The cells that mention each variable, tag, or can't be analyzed
+    mentions = {}
+    # With mode='tags', the variables of tagged cells, which only link them
+    # to untagged cells
+    tagged = {}
+    for ii in positions:
+        cell = ntbk['cells'][ii]
+        keys = [('tag', tag) for tag in _group_tags(cell)]
+        trusted = mode == 'tags' and len(keys) > 0
+        if language != 'python':
+            if not trusted:
+                keys.append(('all', None))
+            names = []
+        else:
+            defines, names, is_setup = _cell_names(cell['source'])
+            if is_setup and len(keys) == 0:
+                # Imports run in every kernel, but cells that use the
+                # modules still share their state
+                defined.update(defines)
+                setup.append(ii)
+                continue
+            if names is None:
+                if not trusted:
+                    keys.append(('all', None))
+                names = []
+            else:
+                defined.update(defines)
+        for name in names:
+            (tagged if trusted else mentions).setdefault(
+                ('name', name), []).append(ii)
+        for key in keys:
+            mentions.setdefault(key, []).append(ii)
+
+    setup_cells = set(setup)
+    not_setup = [ii for ii in positions if ii not in setup_cells]
+    if ('all', None) in mentions:
+        mentions[('all', None)] = not_setup
+    for (key, name), cells in mentions.items():
+        # Only variables and modules that a cell sets are shared, not e.g.
+        # builtins
+        if key == 'name' and name not in defined:
+            continue
+        cells = cells + tagged.get((key, name), [])
+        for ii in cells[1:]:
+            union(cells[0], ii)
+
+    groups = {}
+    for ii in not_setup:
+        groups.setdefault(find(ii), []).append(ii)
+    return setup, sorted(groups.values())
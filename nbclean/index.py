@@ -0,0 +1,114 @@
+"""Look up notebook cells by tag or by the text they contain."""
+import re
+from collections import defaultdict
+
+
+def _as_list(value):
+    if value is None or value == 'None':
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+class CellIndex(object):
+    """An index of the tags and sources of the cells in a notebook.
+
+    Building the index walks the cells once. Any number of selections can
+    then be made from it without visiting every cell again, as long as the
+    cells, their tags, and their sources don't change.
+
+    Parameters
+    ----------
+    cells : list
+        The cells of a notebook.
+    """
+    def __init__(self, cells):
+        self.tags = defaultdict(list)
+        self.sources = []
+        self.empty = []
+        self._cell_tags = []
+        for ii, cell in enumerate(cells):
+            cell_tags = tuple(cell['metadata'].get('tags', []))
+            for tag in cell_tags:
+                self.tags[tag].append(ii)
+            self._cell_tags.append(cell_tags)
+            self.sources.append(cell['source'])
+            if len(cell['source']) == 0:
+                self.empty.append(ii)
+        self._searches = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def is_current(self, cells):
+        """Return whether the index still matches the tags and sources of
+        `cells`, e.g. after they may have been edited by hand."""
+        # Unchanged sources are the same objects, so they compare instantly
+        return len(cells) == len(self.sources) and all(
+            cell['source'] == source and
+            tuple(cell['metadata'].get('tags', [])) == cell_tags
+            for cell, source, cell_tags in zip(cells, self.sources,
+                                               self._cell_tags))
+
+    def search(self, pattern):
+        """Return the positions of cells whose source matches a regex."""
+        if pattern not in self._searches:
+            self._searches[pattern] = [
+                ii for ii, source in enumerate(self.sources)
+                if pattern.search(source) is not None]
+        return self._searches[pattern]
+
+
+class CellMatcher(object):
+    """Match cells against several tags, strings, or regexes at once.
+
+    If any tags are given, cells are matched only on their tags. Otherwise
+    a cell matches if its source contains any of `search_text` or matches
+    any of `regex`. All of the strings and regexes are compiled into a single
+    pattern, so each cell source is only scanned once.
+
+    Parameters
+    ----------
+    tag : str | list of str | None
+        Match cells with any of these tags.
+    search_text : str | list of str | None
+        Match cells whose source contains any of these strings.
+    regex : str | list of str | None
+        Match cells whose source matches any of these regular expressions.
+    """
+    def __init__(self, tag=None, search_text=None, regex=None):
+        self.tags = frozenset(_as_list(tag))
+        patterns = [re.escape(text) for text in _as_list(search_text)]
+        patterns += _as_list(regex)
+        self.pattern = None
+        if len(patterns) > 0:
+            self.pattern = re.compile('|'.join(
+                '(?:{})'.format(pattern) for pattern in patterns))
+
+    @property
+    def active(self):
+        """Whether any tags, strings, or regexes were given."""
+        return len(self.tags) > 0 or self.pattern is not None
+
+    def matches(self, cell):
+        """Return whether a cell matches. Every cell matches if not `active`."""
+        if len(self.tags) > 0:
+            return not self.tags.isdisjoint(cell['metadata'].get('tags', []))
+        elif self.pattern is not None:
+            return self.pattern.search(cell['source']) is not None
+        return True
+
+    def select(self, index):
+        """Return the positions of matching cells in a `CellIndex`.
+
+        Returns None if the matcher isn't `active`, i.e. all cells match.
+        """
+        if len(self.tags) > 0:
+            positions = set()
+            for tag in self.tags:
+                positions.update(index.tags.get(tag, []))
+            return sorted(positions)
+        elif self.pattern is not None:
+            return index.search(self.pattern)
+        return None
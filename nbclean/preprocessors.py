@@ -1,49 +1,196 @@
 import hashlib
+import json
 import os
+from contextlib import nullcontext
+from copy import copy, deepcopy
+from functools import lru_cache
+
+from traitlets import Unicode, Bool, Dict, List, Union
+from traitlets.config import Configurable
+
+from .compact import (_blob_key, _check_pillow, _drop_redundant,
+                      _fit_outputs, _note, _nbytes, _shrink_images)
+from .index import CellMatcher
+from .profiling import _Timer, _footprint, _record_cell
+from .solutions import CODE_STUBS, SolutionScanner, _is_solution
+from .utils import _atomic_write
+
+OKTEST_OUTPUTS = ['files', 'bundle', 'memory']
+
+
+def preprocess_cells(nb, steps, resources=None, shared_cells=None,
+                     cell_index=None, stats=None):
+    """Run several preprocessors over the cells of a notebook in one pass.
+
+    Each cell is passed through every step in order before moving on to the
+    next cell, which gives the same result as running each step over the
+    whole notebook one after another. Steps that change the notebook in
+    `end` in a way that later steps depend on set `ends_pass`, and the
+    steps after them run in another pass.
+
+    Parameters
+    ----------
+    nb : instance of NotebookNode
+        The notebook to process. It is modified in place.
+    steps : list
+        Preprocessors that implement `begin`, `preprocess_cell` and `end`.
+        `preprocess_cell` may return `None` in place of the cell to remove it.
+    resources : dict | None
+        Resources shared by all of the steps.
+    shared_cells : dict | None
+        Cells, keyed by their `id`, that also belong to another notebook.
+        These are copied right before a step modifies them, so that the
+        other notebook is left untouched.
+    cell_index : instance of CellIndex | None
+        An index of the notebook's cells. If given and there is only one
+        step, only the cells that the step selects from the index are
+        visited.
+    stats : list of dict | None
+        If given, one dictionary per step (see `profiling._new_stats`) that
+        is updated with the time each step takes, the number of cells it
+        visits, modifies and removes, and the output bytes it removes.
+
+    Returns
+    -------
+    nb : instance of NotebookNode
+        The processed notebook.
+    resources : dict
+        The resources dictionary.
+    """
+    resources = {} if resources is None else resources
+    shared_cells = {} if shared_cells is None else shared_cells
+    stats = [None] * len(steps) if stats is None else stats
+    for ii, step in enumerate(steps[:-1]):
+        if getattr(step, 'ends_pass', False):
+            nb, resources = preprocess_cells(
+                nb, steps[:ii + 1], resources, shared_cells,
+                stats=stats[:ii + 1])
+            return preprocess_cells(nb, steps[ii + 1:], resources,
+                                    shared_cells, stats=stats[ii + 1:])
+    for step, step_stats in zip(steps, stats):
+        with _maybe_timer(step_stats):
+            step.begin(nb, resources)
+
+    positions = None
+    if cell_index is not None and len(steps) == 1:
+        positions = steps[0].select(cell_index)
+    if positions is not None:
+        cells = list(nb['cells'])
+        for ii in positions:
+            cells[ii], resources = _preprocess_cell(
+                steps[0], cells[ii], resources, ii, shared_cells, stats[0])
+        nb['cells'] = [cell for cell in cells if cell is not None]
+    else:
+        new_cells = []
+        for ii, cell in enumerate(nb['cells']):
+            for step, step_stats in zip(steps, stats):
+                cell, resources = _preprocess_cell(
+                    step, cell, resources, ii, shared_cells, step_stats)
+                if cell is None:
+                    break
+            else:
+                new_cells.append(cell)
+        nb['cells'] = new_cells
+
+    for step, step_stats in zip(steps, stats):
+        with _maybe_timer(step_stats):
+            step.end(nb, resources)
+    return nb, resources
+
+
+def _maybe_timer(stats):
+    return nullcontext() if stats is None else _Timer(stats)
+
+
+def _preprocess_cell(step, cell, resources, index, shared_cells, stats):
+    if id(cell) in shared_cells and step.modifies_cell(cell):
+        cell = deepcopy(cell)
+    if stats is None:
+        return step.preprocess_cell(cell, resources, index)
+    before = _footprint(cell)
+    with _Timer(stats):
+        cell, resources = step.preprocess_cell(cell, resources, index)
+    _record_cell(stats, before, cell)
+    return cell, resources
+
 
-from traitlets import Unicode, Bool
-from nbgrader.preprocessors import NbGraderPreprocessor
+class CellPreprocessor(object):
+    """A mixin for preprocessors that work on one cell at a time.
+
+    Subclasses implement `preprocess_cell`, and optionally `begin` and `end`
+    for any work that needs the whole notebook. `modifies_cell` should
+    return False for cells that `preprocess_cell` leaves untouched, so that
+    they don't need to be copied. `streamable` is False for steps that
+    need to see the notebook metadata before its cells.
+
+    `select` may return the positions of the only cells that the step needs
+    to visit, given a `CellIndex`, or None to visit all of them.
+    `changes_index` is False for steps that never change cell sources or
+    remove cells, so an index remains valid after they run. `ends_pass` is
+    True for steps whose `end` changes cells, so that steps after them must
+    not be run in the same pass over the cells.
+    """
+
+    streamable = True
+    changes_index = True
+    ends_pass = False
+
+    def modifies_cell(self, cell):
+        return True
+
+    def select(self, cell_index):
+        return None
+
+    def begin(self, nb, resources):
+        pass
+
+    def end(self, nb, resources):
+        pass
+
+    def preprocess(self, nb, resources):
+        return preprocess_cells(nb, [self], resources)
 
 
-class RemoveCells(NbGraderPreprocessor):
+class RemoveCells(CellPreprocessor, Configurable):
     """A helper class to remove cells from a notebook.
 
     This should not be used directly, instead, use the
     NotebookCleaner class.
     """
 
-    tag = Unicode("None")
-    search_text = Unicode("None")
+    tag = Union([Unicode(), List(Unicode())], default_value="None")
+    search_text = Union([Unicode(), List(Unicode())], default_value="None")
+    regex = Union([Unicode(), List(Unicode())], default_value="None")
     empty = Bool(False)
 
-    def preprocess(self, nb, resources):
-        if self.tag == 'None' and self.empty is False and self.search_text == 'None':
-            raise ValueError("One of `tag`, `empty`, or `search_text` must be used.")
-        new_cells = []
-        for ii, cell in enumerate(nb['cells']):
-            is_empty = len(cell['source']) == 0
-            if self.tag != 'None':
-                if self.tag in cell['metadata'].get('tags', []):
-                    # Skip appending the cell if the tag matches
-                    if self.empty:
-                        if is_empty:
-                            continue
-                    else:
-                        continue
-            elif self.search_text != 'None':
-                if self.search_text in cell['source']:
-                    # Skip appending the cell if the tag matches
-                    if self.empty:
-                        if is_empty:
-                            continue
-                    else:
-                        continue
-            elif self.empty and is_empty:
-                continue
-            # If we didn't trigger anything above, append the cell to keep it
-            new_cells.append(cell)
-        nb['cells'] = new_cells
-        return nb, resources
+    def begin(self, nb, resources):
+        self._matcher = CellMatcher(self.tag, self.search_text, self.regex)
+        if not self._matcher.active and self.empty is False:
+            raise ValueError("One of `tag`, `empty`, `search_text`, or "
+                             "`regex` must be used.")
+
+    def modifies_cell(self, cell):
+        # Cells are only ever dropped, never changed
+        return False
+
+    def select(self, cell_index):
+        positions = self._matcher.select(cell_index)
+        if positions is None:
+            return cell_index.empty
+        elif self.empty:
+            return sorted(set(positions).intersection(cell_index.empty))
+        return positions
+
+    def preprocess_cell(self, cell, resources, index):
+        is_empty = len(cell['source']) == 0
+        if self._matcher.active:
+            # Skip appending the cell if the tag or text matches
+            if self._matcher.matches(cell) and (is_empty or not self.empty):
+                return None, resources
+        elif self.empty and is_empty:
+            return None, resources
+        # If we didn't trigger anything above, keep the cell
+        return cell, resources
 
     def __repr__(self):
         s = "<RemoveCells> Tag: {}".format(self.tag)
@@ -52,9 +199,14 @@ class RemoveCells(NbGraderPreprocessor):
         return s
 
 
-class ConvertCells:
+class ConvertCells(CellPreprocessor):
     """A helper class to convert cells in a notebook to oktests.
 
+    Tests are collected while the cells are processed and written together
+    once all cells have been seen. Cells with the same source share one
+    test, and test files that already exist with the same contents are not
+    written again.
+
     This should not be used directly, instead, use the
     NotebookCleaner class.
     """
@@ -74,7 +226,7 @@ test = {
 }
 '''
 
-    def __init__(self, tag, oktest_path, base_dir):
+    def __init__(self, tag, oktest_path, base_dir, output='files'):
         self.tag = tag
         # path at which to store oktests, this will be created as a subdirectory
         # of `base_dir`
@@ -84,41 +236,110 @@ test = {
                                " to `base_dir`, got '%s' instead." % oktest_path)
         # path at which the notebook will be stored
         self.base_dir = base_dir
+        if output not in OKTEST_OUTPUTS:
+            raise ValueError('output must be one of {}, got {}'.format(
+                OKTEST_OUTPUTS, output))
+        self.output = output
+        self.tests = {}
+        self.manifest = []
+
+    def begin(self, nb, resources):
+        self.tests = {}
+
+    def modifies_cell(self, cell):
+        return (self.tag in cell['metadata'].get('tags', []) and
+                cell['cell_type'] == 'code')
+
+    def select(self, cell_index):
+        return cell_index.tags.get(self.tag, [])
+
+    def preprocess_cell(self, cell, resources, index):
+        if self.modifies_cell(cell):
+            # convert cell to oktest
+            name, test = _oktest(cell['source'], self.template)
+            oktest = os.path.join(self.oktest_path, name)
+            self.tests[oktest] = test
+
+            cell['source'] = _check_source(oktest)
+            # clear outputs and execution count
+            cell['outputs'] = []
+            cell['execution_count'] = None
+        return cell, resources
+
+    def end(self, nb, resources):
+        written = {}
+        if self.output == 'files':
+            written = _write_tests(self.base_dir, self.tests)
+        elif self.output == 'bundle' and len(self.tests) > 0:
+            path_bundle = os.path.join(self.oktest_path, 'tests.json')
+            written = _write_tests(self.base_dir, {
+                path_bundle: json.dumps(self.tests, indent=1, sort_keys=True)})
+            # Every test is written, or not, with the bundle
+            written = {oktest: written[path_bundle] for oktest in self.tests}
+        cells = {}
+        if not resources.get('stream', False):
+            cells = _test_cells(nb['cells'], self.tests)
+        self.manifest = [
+            dict(path=oktest, cells=cells.get(oktest),
+                 written=written.get(oktest, False))
+            for oktest in self.tests]
+        resources['oktests'] = self.tests
+        resources['oktest_manifest'] = self.manifest
 
-    def preprocess(self, nb, resources):
-        os.makedirs(os.path.join(self.base_dir, self.oktest_path),
-                    exist_ok=True)
+    def __repr__(self):
+        s = "<ConvertCells> Tag: {}".format(self.tag)
+        return s
 
-        new_cells = []
-        for cell in nb['cells']:
-            cell_tags = cell['metadata'].get('tags', [])
-            if self.tag in cell_tags and cell['cell_type'] == 'code':
-                # convert cell to oktest
-                source = cell['source']
 
-                h = hashlib.md5(source.encode('utf-8')).hexdigest()[:7]
-                oktest = os.path.join(self.oktest_path, 'q-%s.py' % h)
+def _check_source(oktest):
+    """Return the source of a cell that runs an oktest."""
+    return 'check("%s")' % oktest
 
-                with open(os.path.join(self.base_dir, oktest), 'w') as f:
-                    lines = ["      >>> " + l for l in source.split("\n") if l]
-                    f.write(self.template % '\n'.join(lines))
 
-                cell['source'] = 'check("%s")' % oktest
-                # clear outputs and execution count
-                cell['outputs'] = []
-                cell['execution_count'] = None
+def _test_cells(cells, tests):
+    """Return the positions of the cells that run each of `tests`."""
+    checks = {_check_source(oktest): oktest for oktest in tests}
+    positions = {oktest: [] for oktest in tests}
+    for ii, cell in enumerate(cells):
+        if cell['cell_type'] == 'code' and cell['source'] in checks:
+            positions[checks[cell['source']]].append(ii)
+    return positions
 
-            new_cells.append(cell)
 
-        nb['cells'] = new_cells
-        return nb, resources
+@lru_cache(maxsize=1 << 14)
+def _oktest(source, template):
+    """Return the file name and contents of the oktest for a cell source."""
+    h = hashlib.md5(source.encode('utf-8')).hexdigest()[:7]
+    lines = ["      >>> " + l for l in source.split("\n") if l]
+    return 'q-%s.py' % h, template % '\n'.join(lines)
 
-    def __repr__(self):
-        s = "<ConvertCells> Tag: {}".format(self.tag)
-        return s
+
+def _write_tests(base_dir, tests):
+    """Write test files below `base_dir`, skipping any that are unchanged.
+
+    Returns a dictionary with whether each file was written.
+    """
+    written = {}
+    for dir_test in set(os.path.dirname(path) for path in tests):
+        os.makedirs(os.path.join(base_dir, dir_test), exist_ok=True)
+    for path, contents in tests.items():
+        path_full = os.path.join(base_dir, path)
+        data = contents.encode('utf-8')
+        try:
+            if os.path.getsize(path_full) == len(data):
+                with open(path_full, 'rb') as ff:
+                    if ff.read() == data:
+                        written[path] = False
+                        continue
+        except OSError:
+            pass
+        with _atomic_write(path_full) as ff:
+            ff.write(contents)
+        written[path] = True
+    return written
 
 
-class ClearCells(NbGraderPreprocessor):
+class ClearCells(CellPreprocessor, Configurable):
     """A helper class to remove cells from a notebook.
 
     This should not be used directly, instead, use the
@@ -130,60 +351,212 @@ class ClearCells(NbGraderPreprocessor):
     output_text = Bool(False)
     content = Bool(False)
     stderr = Bool(True)
-    tag = Unicode('None')
-    search_text = Unicode("None")
+    tag = Union([Unicode(), List(Unicode())], default_value="None")
+    search_text = Union([Unicode(), List(Unicode())], default_value="None")
+    regex = Union([Unicode(), List(Unicode())], default_value="None")
 
-    def preprocess(self, nb, resources):
-        for cell in nb['cells']:
-            # Check to see whether we process this cell
-            if self.tag != 'None':
-                tags = cell['metadata'].get('tags', [])
-                if self.tag not in tags:
-                    continue
-            elif self.search_text != 'None':
-                if self.search_text not in cell['source']:
-                    continue
+    @property
+    def changes_index(self):
+        return self.content
 
-            # Clear all cell output
-            if self.output is True:
-                if 'outputs' in cell.keys():
-                    cell['outputs'] = []
-
-            # Clear cell text output
-            if self.output_text is True:
-                if 'outputs' in cell.keys():
-                    for output in cell['outputs']:
-                        data = output.get('data', {})
-                        for key in list(data.keys()):
-                            if 'text/' in key:
-                                data.pop(key)
-
-            # Clear cell image output
-            if self.output_image is True:
-                if 'outputs' in cell.keys():
-                    for output in cell['outputs']:
-                        data = output.get('data', {})
-                        for key in list(data.keys()):
-                            if 'image/' in key:
-                                data.pop(key)
-
-            # Clear cell content
-            if self.content is True:
-                cell['source'] = ''
-
-            # Clear stdout
-            if self.stderr is True:
-                new_outputs = []
-                if 'outputs' not in cell.keys():
-                    continue
-                for output in cell['outputs']:
-                    name = output.get('name', None)
-                    if name != 'stderr':
-                        new_outputs.append(output)
-                cell['outputs'] = new_outputs
+    def begin(self, nb, resources):
+        self._matcher = CellMatcher(self.tag, self.search_text, self.regex)
+
+    def modifies_cell(self, cell):
+        # Check to see whether we process this cell
+        return self._matcher.matches(cell)
+
+    def select(self, cell_index):
+        return self._matcher.select(cell_index)
 
-        return nb, resources
+    def preprocess_cell(self, cell, resources, index):
+        if not self.modifies_cell(cell):
+            return cell, resources
+
+        # Clear all cell output
+        if self.output is True:
+            if 'outputs' in cell.keys():
+                cell['outputs'] = []
+
+        # Clear cell text output
+        if self.output_text is True:
+            if 'outputs' in cell.keys():
+                for output in cell['outputs']:
+                    data = output.get('data', {})
+                    for key in list(data.keys()):
+                        if 'text/' in key:
+                            data.pop(key)
+
+        # Clear cell image output
+        if self.output_image is True:
+            if 'outputs' in cell.keys():
+                for output in cell['outputs']:
+                    data = output.get('data', {})
+                    for key in list(data.keys()):
+                        if 'image/' in key:
+                            data.pop(key)
+
+        # Clear cell content
+        if self.content is True:
+            cell['source'] = ''
+
+        # Clear stdout
+        if self.stderr is True:
+            new_outputs = []
+            if 'outputs' not in cell.keys():
+                return cell, resources
+            for output in cell['outputs']:
+                name = output.get('name', None)
+                if name != 'stderr':
+                    new_outputs.append(output)
+            cell['outputs'] = new_outputs
+
+        return cell, resources
 
     def __repr__(self):
         s = "<ClearCells> Tag: {}".format(self.tag)
         return s
+
+
+class CompactOutputs(CellPreprocessor):
+    """A helper class to shrink cell outputs to fit a byte budget.
+
+    This should not be used directly, instead, use the
+    NotebookCleaner class.
+    """
+
+    changes_index = False
+
+    def __init__(self, max_cell_bytes=None, max_bytes=None, dedupe=True,
+                 drop_redundant=True, max_image_size=None):
+        self.max_cell_bytes = max_cell_bytes
+        self.max_bytes = max_bytes
+        self.dedupe = dedupe
+        self.drop_redundant = drop_redundant
+        self.max_image_size = max_image_size
+        if max_image_size is not None:
+            _check_pillow()
+
+    @property
+    def streamable(self):
+        # A notebook budget needs to see all of the outputs at once
+        return self.max_bytes is None
+
+    @property
+    def ends_pass(self):
+        # The budget is applied in `end`, before any later steps
+        return self.max_bytes is not None
+
+    def begin(self, nb, resources):
+        self._seen = set()
+
+    def modifies_cell(self, cell):
+        return len(cell.get('outputs', [])) > 0
+
+    def preprocess_cell(self, cell, resources, index):
+        if not self.modifies_cell(cell):
+            return cell, resources
+        outputs = cell['outputs']
+        for ii, output in enumerate(outputs):
+            if 'data' not in output:
+                continue
+            if self.drop_redundant is True:
+                _drop_redundant(output['data'])
+            if self.max_image_size is not None:
+                _shrink_images(output['data'], self.max_image_size)
+            if self.dedupe is True:
+                key = _blob_key(output)
+                if key not in self._seen:
+                    self._seen.add(key)
+                    continue
+                note = _note('[Output removed: identical to an earlier '
+                             'output]')
+                if _nbytes(note) < _nbytes(output):
+                    outputs[ii] = note
+        if self.max_cell_bytes is not None:
+            _fit_outputs([(outputs, ii) for ii in range(len(outputs))],
+                         self.max_cell_bytes)
+        return cell, resources
+
+    def end(self, nb, resources):
+        if self.max_bytes is None:
+            return
+        refs = []
+        for ii, cell in enumerate(nb['cells']):
+            if self.modifies_cell(cell):
+                # The cell may also belong to another notebook, so only
+                # replace its list of outputs
+                cell = nb['cells'][ii] = copy(cell)
+                cell['outputs'] = list(cell['outputs'])
+                refs.extend((cell['outputs'], jj)
+                            for jj in range(len(cell['outputs'])))
+        _fit_outputs(refs, self.max_bytes)
+
+    def __repr__(self):
+        s = "<CompactOutputs> Cell budget: {} | Notebook budget: {}".format(
+            self.max_cell_bytes, self.max_bytes)
+        return s
+
+
+class ClearSolutions(CellPreprocessor, Configurable):
+    """A helper class to replace solutions with stubs for students to fill.
+
+    Solution regions are marked by any of several pairs of delimiters,
+    which are all found in a single scan of each cell. Otherwise this works
+    like nbgrader's ``ClearSolutions``.
+
+    This should not be used directly, instead, use the
+    NotebookCleaner class.
+    """
+
+    streamable = False
+
+    code_stub = Dict(CODE_STUBS)
+    text_stub = Unicode("YOUR ANSWER HERE")
+    begin_solution_delimeter = Union([Unicode(), List(Unicode())],
+                                     default_value="BEGIN SOLUTION")
+    end_solution_delimeter = Union([Unicode(), List(Unicode())],
+                                   default_value="END SOLUTION")
+    enforce_metadata = Bool(True)
+
+    def __init__(self, **kwargs):
+        super(ClearSolutions, self).__init__(**kwargs)
+        self._scanner = SolutionScanner(self.begin_solution_delimeter,
+                                        self.end_solution_delimeter)
+
+    def begin(self, nb, resources):
+        language = nb.metadata.get("kernelspec", {}).get("language", "python")
+        if language not in self.code_stub:
+            raise ValueError(
+                "language '{}' has not been specified in "
+                "ClearSolutions.code_stub".format(language))
+        resources["language"] = language
+
+    def modifies_cell(self, cell):
+        return (self._scanner.pattern.search(cell['source']) is not None or
+                _is_solution(cell))
+
+    def preprocess_cell(self, cell, resources, index):
+        if cell['cell_type'] == 'code':
+            stub = self.code_stub[resources['language']]
+        else:
+            stub = self.text_stub
+        cell['source'], replaced = self._scanner.replace(cell['source'], stub)
+        is_solution = _is_solution(cell)
+        if replaced and not is_solution and self.enforce_metadata:
+            raise RuntimeError(
+                "Solution region detected in a non-solution cell; please "
+                "make sure all solution regions are within solution cells.")
+        # Keep the rest of a cell if only part of it was a solution
+        if is_solution and not replaced:
+            cell['source'] = stub
+        return cell, resources
+
+    def end(self, nb, resources):
+        if 'celltoolbar' in nb.metadata:
+            del nb.metadata['celltoolbar']
+
+    def __repr__(self):
+        s = "<ClearSolutions> Delimiters: {}".format(
+            list(zip(self._scanner.begin, self._scanner.end)))
+        return s
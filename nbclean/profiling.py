@@ -0,0 +1,63 @@
+"""Helpers to record what each preprocessor does to a notebook."""
+import time
+import tracemalloc
+
+from .compact import _nbytes
+
+
+def _new_stats(name):
+    """Return an empty record of statistics for one preprocessor."""
+    return dict(name=name, time=0., cells_visited=0, cells_modified=0,
+                cells_removed=0, output_bytes_removed=0,
+                memory_delta=0 if tracemalloc.is_tracing() else None)
+
+
+def _output_nbytes(cell):
+    return _nbytes(cell.get('outputs', []))
+
+
+def _footprint(cell):
+    """Return a summary of a cell that changes whenever the cell does."""
+    return (cell.get('source'), _output_nbytes(cell),
+            cell.get('execution_count'), len(cell.get('metadata', {})))
+
+
+def _traced_memory():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+
+class _Timer(object):
+    """Add the wall time and memory used by a block of code to `stats`."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self._memory = _traced_memory()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats['time'] += time.perf_counter() - self._start
+        memory = _traced_memory()
+        if memory is not None and self._memory is not None:
+            self.stats['memory_delta'] += memory - self._memory
+
+
+def _record_cell(stats, before, cell):
+    """Update `stats` for a cell that was visited by a preprocessor.
+
+    `before` is the `_footprint` of the cell before it was processed, and
+    `cell` is the processed cell, or None if it was removed.
+    """
+    stats['cells_visited'] += 1
+    if cell is None:
+        stats['cells_removed'] += 1
+        stats['output_bytes_removed'] += before[1]
+        return
+    after = _footprint(cell)
+    if after != before:
+        stats['cells_modified'] += 1
+        stats['output_bytes_removed'] += before[1] - after[1]
@@ -1,14 +1,30 @@
+import asyncio
+import json
+import math
 import nbformat as nbf
 import os
 import os.path as op
-from nbgrader.preprocessors import LimitOutput, Execute
-from .utils import _check_nb_file
+import time
+from functools import partial
+from multiprocessing.util import Finalize
+from copy import deepcopy
+from .cache import _kernel_environment
+from .dependencies import PARALLEL_MODES, cell_groups
+from .preprocessors import CompactOutputs
+from .profiling import _Timer, _footprint, _new_stats, _record_cell
+from .utils import (_atomic_write, _check_n_jobs, _check_nb_file, _copy_file,
+                    _find_notebooks, _parallel_map, _time_limit, _write_nb)
 from glob import glob
-from tqdm import tqdm
 
 
 def run_notebook_directory(path, path_save=None, max_output_lines=1000,
-                           overwrite=False):
+                           overwrite=False, n_jobs=1, timeout=None,
+                           ordered=True, cache=None, warm_kernels=False,
+                           store=None, cell_timeout=30, cpu_limit=None,
+                           cell_cpu_limit=None, memory_limit=None,
+                           fail_fast=False, history=None,
+                           skip_unchanged=False, max_output_bytes=None,
+                           cell_cache=None):
     """Run all the notebooks in a directory and save them somewhere else.
 
     Parameters
@@ -26,44 +42,354 @@ def run_notebook_directory(path, path_save=None, max_output_lines=1000,
         The maximum number of lines allowed in notebook outputs.
     overwrite : bool
         Whether to overwrite the output directory if it exists.
+    n_jobs : int
+        The number of notebooks to run at the same time. Each notebook is
+        run in its own worker process. If -1, use one worker per CPU.
+    timeout : float | None
+        The maximum time, in seconds, that a single notebook may take to run.
+        A notebook that takes longer fails with a `TimeoutError`. If None,
+        there is no limit.
+    ordered : bool
+        Whether to return results in the same order as the input notebooks.
+        If False, results are returned in the order that they finish.
+    cache : instance of NotebookCache | None
+        A cache of previously-run notebooks. Notebooks that haven't changed
+        since they were cached, and whose kernels and Python environment
+        are the same, are taken from the cache instead of being run again.
+    warm_kernels : bool
+        Whether to keep kernels running between notebooks. Each worker
+        starts a kernel up front and reuses it for every notebook it runs,
+        which saves the kernel start-up time and the cost of re-importing
+        modules. Between notebooks the namespace and execution count of
+        Python kernels are reset; other kernels, and kernels whose notebook
+        failed to run, are restarted.
+    store : instance of OutputStore | None
+        If given, large outputs are moved into this store before notebooks
+        are saved, leaving references in the saved notebooks, which are
+        tracked by the store. Use `OutputStore.rehydrate` to restore them.
+        Requires `path_save`.
+    cell_timeout, cpu_limit, cell_cpu_limit, memory_limit : float | None
+        Limits on the time, CPU time and memory used to run each notebook
+        and each of its cells. See `run_notebook`. Like `timeout`, a
+        notebook that goes over a limit which kills its kernel fails.
+    fail_fast : bool
+        Whether to stop at the first error. If True, a cell that raises an
+        error stops its notebook with a `CellExecutionError`, and the first
+        notebook that fails raises its error and cancels the others. If
+        False, errors in cells are recorded in their outputs, and notebooks
+        that fail are reported and skipped while the others carry on.
+    history : str | None
+        A JSON file in which to record how long each notebook takes to run.
+        If given, notebooks are started in order of how long they are
+        expected to take, shortest first, so that results come in steadily
+        and one slow notebook doesn't hold up many fast ones. Notebooks
+        without a recorded time are expected to take the median time.
+    skip_unchanged : bool
+        Whether to leave saved notebooks untouched if they already hold the
+        same cells and outputs, so their modification times don't change.
+        The times at which cells ran, which nbclient records in the cell
+        metadata, are ignored. With `overwrite`, only outputs of notebooks
+        that are no longer in `path` are removed up front. The number of
+        notebooks that were written and skipped is printed at the end.
+    max_output_bytes : int | None
+        The maximum size of all of the outputs of each notebook. See
+        `run_notebook`.
+    cell_cache : instance of CellCache | None
+        A cache of cell outputs. Notebooks whose code cells are all in the
+        cache aren't run at all. Unlike with `run_notebook` and a kernel
+        passed as `km`, other notebooks are always run from the start,
+        since their kernel has to run every cell to rebuild its state, and
+        their outputs are added to the cache. Hits and misses are only
+        counted in `cell_cache` if `n_jobs` is 1.
 
     Returns
     -------
     notebooks : list
-        A list of the `NotebookNode` instances, one for each notebook.
+        If `path_save` is None, a list of the `NotebookNode` instances, one
+        for each notebook. Otherwise, each notebook is written to `path_save`
+        as soon as it finishes running and a list of the saved paths is
+        returned instead. Notebooks that failed to run are None, and their
+        errors are printed.
     """
-    if not op.exists(path):
-        raise ValueError("You've specified an input path that doesn't exist")
-    to_glob = op.join(path, '*.ipynb') if '.ipynb' not in path else path
-    notebooks = glob(to_glob)
+    notebooks = _find_notebooks(path)
+    if store is not None and path_save is None:
+        raise ValueError('path_save must be given to use a store')
+    limits = dict(cell_timeout=cell_timeout, cpu_limit=cpu_limit,
+                  cell_cpu_limit=cell_cpu_limit, memory_limit=memory_limit,
+                  fail_fast=fail_fast, max_output_bytes=max_output_bytes)
+
+    # Prepare the output folder before running so we can stream results to it
+    keep = None
+    if skip_unchanged is True and path_save is not None:
+        keep = [_exe_path(filename, path_save) for filename in notebooks]
+    _prepare_path_save(path_save, overwrite, len(notebooks), keep=keep)
+    n_written = n_failed = 0
+
+    # Use cached outputs for notebooks that haven't changed
+    results = {}
+    keys = {}
+    if cache is not None:
+        env = dict(_kernel_environment(), max_output_lines=max_output_lines,
+                   store=None if store is None else store.min_size,
+                   **limits)
+        for filename in notebooks:
+            keys[filename] = cache.key(filename, env)
+            path_cached = cache.get(keys[filename])
+            if path_cached is None:
+                continue
+            path_out = _exe_path(filename, path_save)
+            if path_out is None:
+                results[filename] = nbf.read(path_cached, nbf.NO_CONVERT)
+            else:
+                if _copy_file(path_cached, path_out,
+                              skip_unchanged=skip_unchanged):
+                    n_written += 1
+                results[filename] = path_out
+                if store is not None:
+                    store.track(path_out)
 
     # Execute notebooks
-    outputs = []
-    for notebook in tqdm(notebooks):
-        outputs.append(run_notebook(notebook,
-                                    max_output_lines=max_output_lines))
+    to_run = [filename for filename in notebooks if filename not in results]
+    times = {}
+    if history is not None:
+        times = _read_history(history)
+        to_run = _shortest_first(to_run, times)
+    run = partial(_run_and_save, path_save=path_save,
+                  max_output_lines=max_output_lines, timeout=timeout,
+                  warm_kernel=warm_kernels, store=store, limits=limits,
+                  skip_unchanged=skip_unchanged, cell_cache=cell_cache)
+    initializer = _start_warm_kernel if warm_kernels else None
+    try:
+        for summary in _parallel_map(run, to_run, n_jobs=n_jobs,
+                                     ordered=ordered,
+                                     initializer=initializer):
+            filename, output = summary['path'], summary['output']
+            key = op.abspath(filename)
+            # Weigh the latest run the same as all of the earlier ones
+            times[key] = (summary['time'] if key not in times
+                          else (times[key] + summary['time']) / 2)
+            if summary['error'] is not None:
+                print('Failed to run {}: {}'.format(filename,
+                                                    summary['error']))
+                n_failed += 1
+                results[filename] = None
+                continue
+            n_written += summary['written'] is True
+            if cache is not None:
+                cache.put(keys[filename], output)
+                path_cached = cache._entry(keys[filename])
+                if store is not None and op.exists(path_cached):
+                    # Cached copies also hold on to their blobs
+                    store.track(path_cached)
+            results[filename] = output
+    finally:
+        _shutdown_warm_kernels()
+        if history is not None:
+            _write_history(history, times)
 
-    # Now save them
     if path_save is not None:
-        print('Saving {} notebooks to: {}'.format(len(notebooks), path_save))
-        if not op.exists(path_save):
-            os.makedirs(path_save)
-        elif overwrite is True:
-            print('Overwriting output directory')
-            for ifile in glob(path_save + '*-exe.ipynb'):
+        print('Wrote {} notebooks, skipped {} that were unchanged'.format(
+            n_written, len(notebooks) - n_written - n_failed))
+    if n_failed > 0:
+        print('{} of {} notebooks failed to run'.format(n_failed,
+                                                        len(notebooks)))
+    if ordered is True:
+        return [results[filename] for filename in notebooks]
+    return list(results.values())
+
+
+def _read_history(path_history):
+    if not op.exists(path_history):
+        return {}
+    with open(path_history, 'r', encoding='utf-8') as ff:
+        return json.load(ff)
+
+
+def _write_history(path_history, times):
+    with _atomic_write(path_history) as ff:
+        json.dump(times, ff, indent=1, sort_keys=True)
+
+
+def _shortest_first(notebooks, times):
+    """Sort notebooks by their expected run time, shortest first."""
+    known = sorted(times[op.abspath(filename)] for filename in notebooks
+                   if op.abspath(filename) in times)
+    median = known[len(known) // 2] if len(known) > 0 else 0
+    return sorted(notebooks, key=lambda filename: times.get(
+        op.abspath(filename), median))
+
+
+def _prepare_path_save(path_save, overwrite, n_notebooks, keep=None):
+    """Create `path_save`, or clear its outputs except for those in `keep`."""
+    if path_save is None:
+        return
+    print('Saving {} notebooks to: {}'.format(n_notebooks, path_save))
+    if not op.exists(path_save):
+        os.makedirs(path_save)
+    elif overwrite is True:
+        print('Overwriting output directory')
+        keep = set() if keep is None else set(keep)
+        for ifile in glob(op.join(path_save, '*-exe.ipynb')):
+            if ifile not in keep:
                 os.remove(ifile)
-        else:
-            raise ValueError('path_save exists and overwrite is not True')
+    else:
+        raise ValueError('path_save exists and overwrite is not True')
+
+
+def _exe_path(filename, path_save):
+    if path_save is None:
+        return None
+    left, right = op.splitext(op.basename(filename))
+    return op.join(path_save, left + '-exe' + right)
+
+
+def _run_and_save(filename, path_save=None, max_output_lines=1000,
+                  timeout=None, warm_kernel=False, store=None, limits=None,
+                  skip_unchanged=False, cell_cache=None):
+    """Run one notebook, saving it to `path_save` if given.
+
+    Returns a summary with the input ``path``, the ``output`` notebook or
+    the path it was saved to, the ``time`` it took to run, whether it was
+    ``written``, and the ``error`` that stopped it (or None). Errors are
+    raised instead if ``limits['fail_fast']`` is True.
+    """
+    limits = {} if limits is None else limits
+    summary = dict(path=filename, output=None, written=False, error=None)
+    start = time.perf_counter()
+    try:
+        notebook = _run_one(filename, max_output_lines, timeout, warm_kernel,
+                            limits, cell_cache)
+    except Exception as err:
+        if limits.get('fail_fast', False):
+            raise
+        summary['error'] = '{}: {}'.format(type(err).__name__, err)
+        summary['time'] = time.perf_counter() - start
+        return summary
+    summary['time'] = time.perf_counter() - start
+    if path_save is None:
+        summary['output'] = notebook
+        return summary
+
+    path_out = summary['output'] = _exe_path(filename, path_save)
+    if store is not None:
+        notebook, keys = store.externalize(notebook)
+    if not (skip_unchanged and _same_results(notebook, path_out)):
+        summary['written'] = _write_nb(notebook, path_out)
+    if store is not None:
+        store.track(path_out, keys)
+    return summary
+
+
+def _run_one(filename, max_output_lines, timeout, warm_kernel, limits,
+             cell_cache=None):
+    if warm_kernel is not True:
+        with _time_limit(timeout):
+            return run_notebook(filename, max_output_lines=max_output_lines,
+                                cell_cache=cell_cache, **limits)
+    ntbk = _check_nb_file(filename)
+    kernel = _get_warm_kernel(ntbk)
+    try:
+        with _time_limit(timeout):
+            notebook = run_notebook(ntbk, max_output_lines=max_output_lines,
+                                    copy=False, km=kernel.km,
+                                    cell_cache=cell_cache, **limits)
+    except BaseException:
+        kernel.restart()
+        raise
+    finally:
+        if cell_cache is not None:
+            # The kernel is reset, so it can't resume from any cell
+            cell_cache._kernels.pop(kernel.km, None)
+    kernel.reset()
+    return notebook
+
+
+def _same_results(ntbk, path_nb):
+    """Return whether a saved notebook has the same contents as `ntbk`,
+    other than the times at which its cells were run."""
+    if not op.isfile(path_nb):
+        return False
+    return _timeless(ntbk) == _timeless(nbf.read(path_nb, nbf.NO_CONVERT))
+
+
+def _timeless(ntbk):
+    cells = [dict(cell, metadata={key: val
+                                  for key, val in cell['metadata'].items()
+                                  if key != 'execution'})
+             for cell in ntbk['cells']]
+    return dict(ntbk, cells=cells)
+
+
+class _WarmKernel(object):
+    """A kernel that is kept running to execute several notebooks."""
+
+    def __init__(self, kernel_name):
+        from jupyter_client.manager import AsyncKernelManager
+        self.kernel_name = kernel_name
+        self.km = AsyncKernelManager(kernel_name=kernel_name)
 
-        for filename, notebook in zip(notebooks, outputs):
-            this_name = op.basename(filename)
-            left, right = this_name.split('.')
-            left += '-exe'
-            this_name = '.'.join([left, right])
-            nbf.write(notebook, op.join(path_save, this_name))
+    def start(self):
+        """Start the kernel by running an empty notebook in it."""
+        ntbk = nbf.v4.new_notebook()
+        ntbk.metadata['kernelspec'] = dict(name=self.kernel_name)
+        run_notebook(ntbk, max_output_lines=None, copy=False, km=self.km)
 
+    def reset(self):
+        """Clear the kernel's namespace so it can run another notebook."""
+        if self.km.kernel_spec.language != 'python':
+            return self.restart()
+        ntbk = nbf.v4.new_notebook()
+        ntbk.metadata['kernelspec'] = dict(name=self.kernel_name)
+        # Also restart the execution count, which goes up by one after this
+        ntbk.cells.append(nbf.v4.new_code_cell(
+            'get_ipython().reset(new_session=True)\n'
+            'get_ipython().execution_count = 0'))
+        try:
+            run_notebook(ntbk, max_output_lines=None, copy=False, km=self.km)
+        except Exception:
+            self.restart()
 
-def run_notebook(ntbk, max_output_lines=1000):
+    def restart(self):
+        """Replace the kernel with a new one."""
+        self.shutdown()
+        self.km = type(self.km)(kernel_name=self.kernel_name)
+
+    def shutdown(self):
+        from jupyter_core.utils import run_sync
+        if self.km.has_kernel:
+            run_sync(self.km.shutdown_kernel)(now=True)
+
+
+# Warm kernels of this process, by kernel name
+_WARM_KERNELS = {}
+
+
+def _get_warm_kernel(ntbk):
+    kernel_name = ntbk['metadata'].get('kernelspec', {}).get('name',
+                                                             'python3')
+    if kernel_name not in _WARM_KERNELS:
+        if len(_WARM_KERNELS) == 0:
+            # Worker processes don't run atexit handlers, but do run these
+            Finalize(None, _shutdown_warm_kernels, exitpriority=10)
+        _WARM_KERNELS[kernel_name] = _WarmKernel(kernel_name)
+    return _WARM_KERNELS[kernel_name]
+
+
+def _start_warm_kernel():
+    """Start a default kernel before any notebooks are run."""
+    _get_warm_kernel(nbf.v4.new_notebook()).start()
+
+
+def _shutdown_warm_kernels():
+    for kernel in _WARM_KERNELS.values():
+        kernel.shutdown()
+    _WARM_KERNELS.clear()
+
+
+def run_notebook(ntbk, max_output_lines=1000, copy=True, callback=None,
+                 km=None, cell_cache=None, parallel=None, n_kernels=4,
+                 cell_timeout=30, cpu_limit=None, cell_cpu_limit=None,
+                 memory_limit=None, fail_fast=False, max_output_bytes=None):
     """Run the cells in a notebook and limit the output length.
 
     Parameters
@@ -72,13 +398,441 @@ def run_notebook(ntbk, max_output_lines=1000):
         The input notebook.
     max_output_lines : int | None
         The maximum number of lines allowed in notebook outputs.
+    copy : bool
+        Whether to run a copy of a `NotebookNode` input. If False, the input
+        notebook is modified in place. Notebooks read from a path are never
+        copied.
+    callback : callable | None
+        A function that is called with statistics about each preprocessor
+        (executing the notebook, then limiting its output) once it has run.
+        See `NotebookCleaner` for the statistics that are recorded. Output
+        bytes that are added count as negative bytes removed.
+    km : instance of KernelManager | None
+        A kernel manager to run the notebook with. Its kernel is started if
+        needed and is left running afterwards, so it can be reused. If
+        None, a new kernel is started and shut down for this notebook.
+    cell_cache : instance of CellCache | None
+        A cache of cell outputs. If every code cell is in the cache, the
+        notebook isn't run at all. Otherwise, cached outputs are used up to
+        the first changed cell, and the rest of the notebook is run. A new
+        kernel has to run the cells before it again to rebuild their state,
+        but a kernel from `km` that has already run those cells resumes
+        from the changed cell, as when re-running cells in Jupyter. Set
+        ``"nbclean": {"cell_cache": false}`` in the notebook metadata to
+        always run a notebook, e.g. if its outputs aren't deterministic.
+    parallel : 'auto' | 'tags' | None
+        If given, cells that don't depend on each other are run at the same
+        time in separate kernels, and their outputs are merged back in cell
+        order with execution counts as if they had run one after another.
+        'auto' finds independent groups of cells from the variables that
+        they define and use, and 'tags' from ``group:<name>`` cell tags and
+        the variables of untagged cells. See
+        `nbclean.dependencies.cell_groups` for the details, and for when
+        cells need to be tagged. Cells that only import modules are run in
+        every kernel. This can't be used with `km` or `cell_cache`.
+    n_kernels : int
+        The maximum number of kernels to use if `parallel` is given. If -1,
+        use one kernel per CPU.
+    cell_timeout : float | None
+        The maximum time, in seconds, that a single cell may take to run.
+        A cell that takes longer is interrupted and gets an error output.
+        If None, there is no limit.
+    cpu_limit : float | None
+        The maximum CPU time, in seconds, that the kernel may use to run the
+        notebook. The kernel is killed if it uses more, which raises a
+        `DeadKernelError`. If None, there is no limit.
+    cell_cpu_limit : float | None
+        The maximum CPU time, in seconds, that the kernel may use to run
+        any one cell, enforced in the same way as `cpu_limit`.
+    memory_limit : int | None
+        The maximum memory, in bytes, that the kernel process may use.
+        Allocations beyond it fail, e.g. with a `MemoryError` in Python. If
+        None, there is no limit. CPU and memory limits are only supported
+        on Linux.
+    fail_fast : bool
+        Whether to stop at the first cell that raises an error, and raise a
+        `CellExecutionError`. If False, errors are recorded in the cell
+        outputs and the rest of the notebook is still run.
+    max_output_bytes : int | None
+        The maximum size, in characters of JSON, of all of the outputs of
+        the notebook once it has run. The largest outputs are shrunk first,
+        as by `NotebookCleaner.compact`. If None, there is no limit.
     """
-    ntbk = _check_nb_file(ntbk)
+    from nbgrader.preprocessors import LimitOutput
+    if parallel is not None:
+        if km is not None or cell_cache is not None:
+            raise ValueError('parallel cannot be used with km or cell_cache')
+        if parallel not in PARALLEL_MODES:
+            raise ValueError('parallel must be one of {} or None, got '
+                             '{}'.format(PARALLEL_MODES, parallel))
+        n_kernels = _check_n_jobs(n_kernels)
+    ntbk = _check_nb_file(ntbk, copy=copy)
+    if not ntbk['metadata'].get('nbclean', {}).get('cell_cache', True):
+        cell_cache = None
 
-    preprocessors = [Execute()]
+    execute = _new_execute(cell_timeout, fail_fast, cpu_limit,
+                           cell_cpu_limit, memory_limit)
+    preprocessors = [execute]
     if max_output_lines is not None:
         preprocessors.append(LimitOutput(max_lines=max_output_lines,
                                          max_traceback=max_output_lines))
-    for prep in preprocessors:
-        ntbk, _ = prep.preprocess(ntbk, {})
+    if max_output_bytes is not None:
+        preprocessors.append(CompactOutputs(max_bytes=max_output_bytes,
+                                            dedupe=False,
+                                            drop_redundant=False))
+    try:
+        for prep in preprocessors:
+            if callback is None:
+                ntbk = _preprocess(prep, ntbk, km, cell_cache, parallel,
+                                   n_kernels)
+                continue
+            stats = _new_stats(type(prep).__name__)
+            before = [_footprint(cell) for cell in ntbk['cells']]
+            with _Timer(stats):
+                ntbk = _preprocess(prep, ntbk, km, cell_cache, parallel,
+                                   n_kernels)
+            for cell_before, cell in zip(before, ntbk['cells']):
+                _record_cell(stats, cell_before, cell)
+            callback(stats)
+    finally:
+        if km is not None and isinstance(execute.on_cell_execute,
+                                         _KernelLimits):
+            # The kernel may run other notebooks
+            execute.on_cell_execute.release()
+    return ntbk
+
+
+def _new_execute(cell_timeout=30, fail_fast=False, cpu_limit=None,
+                 cell_cpu_limit=None, memory_limit=None):
+    """Return an Execute preprocessor that enforces resource limits."""
+    from nbgrader.preprocessors import Execute
+    prep = Execute(timeout=cell_timeout, allow_errors=not fail_fast)
+    if any(limit is not None
+           for limit in [cpu_limit, cell_cpu_limit, memory_limit]):
+        prep.on_cell_execute = _KernelLimits(prep, cpu_limit, cell_cpu_limit,
+                                             memory_limit)
+    return prep
+
+
+class _KernelLimits(object):
+    """Cap the CPU time and memory of the kernel that a client runs.
+
+    This is called by nbclient right before each code cell is run, and
+    sets the resource limits of the kernel process from outside of it.
+    """
+    def __init__(self, client, cpu=None, cell_cpu=None, memory=None):
+        import resource
+        if not hasattr(resource, 'prlimit') or not op.exists('/proc/self'):
+            raise ValueError('CPU and memory limits are only supported on '
+                             'Linux')
+        self.client = client
+        self.cpu = cpu
+        self.cell_cpu = cell_cpu
+        self.memory = memory
+        self._pid = None
+        self._cpu_start = None
+
+    def bind(self, client):
+        """Return the same limits for another client."""
+        return type(self)(client, self.cpu, self.cell_cpu, self.memory)
+
+    def _kernel_pid(self):
+        provisioner = getattr(self.client.km, 'provisioner', None)
+        return getattr(provisioner, 'pid', None)
+
+    def __call__(self, **kwargs):
+        import resource
+        pid = self._kernel_pid()
+        if pid is None:
+            return
+        if pid != self._pid:
+            # The first cell run by this kernel for this notebook
+            self._pid = pid
+            self._cpu_start = _cpu_time(pid)
+            if self.memory is not None:
+                resource.prlimit(pid, resource.RLIMIT_AS,
+                                 (self.memory, self.memory))
+        limits = []
+        if self.cpu is not None:
+            limits.append(self._cpu_start + self.cpu)
+        if self.cell_cpu is not None:
+            limits.append(_cpu_time(pid) + self.cell_cpu)
+        if len(limits) > 0:
+            # The kernel gets SIGXCPU, which kills it, past the soft limit
+            _, hard = resource.prlimit(pid, resource.RLIMIT_CPU)
+            resource.prlimit(pid, resource.RLIMIT_CPU,
+                             (math.ceil(min(limits)), hard))
+
+    def release(self):
+        """Remove the CPU limit, so the kernel can be reused."""
+        import resource
+        if self.cpu is None and self.cell_cpu is None:
+            return
+        pid = self._kernel_pid()
+        if pid is None or pid != self._pid:
+            return
+        try:
+            _, hard = resource.prlimit(pid, resource.RLIMIT_CPU)
+            resource.prlimit(pid, resource.RLIMIT_CPU, (hard, hard))
+        except ProcessLookupError:
+            # The kernel was killed, e.g. by going over the limit
+            pass
+
+
+def _cpu_time(pid):
+    """Return the CPU time, in seconds, that a process has used."""
+    with open('/proc/{}/stat'.format(pid), 'r') as ff:
+        # The command name, in brackets, may contain spaces
+        fields = ff.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _preprocess(prep, ntbk, km=None, cell_cache=None, parallel=None,
+                n_kernels=4):
+    from nbgrader.preprocessors import Execute
+    if parallel is not None and isinstance(prep, Execute):
+        return _execute_parallel(prep, ntbk, parallel, n_kernels)
+    if cell_cache is not None and isinstance(prep, Execute):
+        return _execute_cached(prep, ntbk, km, cell_cache)
+    if km is None or not isinstance(prep, Execute):
+        return prep.preprocess(ntbk, {})[0]
+    try:
+        return prep.preprocess(ntbk, {}, km=km)[0]
+    finally:
+        # The kernel outlives this client, so close its connections
+        if prep.kc is not None:
+            prep.kc.stop_channels()
+
+
+def _execute_cached(prep, ntbk, km, cell_cache):
+    """Run a notebook, reusing the outputs of unchanged cells."""
+    positions = [ii for ii, cell in enumerate(ntbk['cells'])
+                 if cell['cell_type'] == 'code']
+    code_cells = [ntbk['cells'][ii] for ii in positions]
+    keys = cell_cache.keys(ntbk)
+    n_cached = 0
+    for cell, key in zip(code_cells, keys):
+        entry = cell_cache.get(key)
+        if entry is None:
+            break
+        cell['outputs'] = [nbf.from_dict(output)
+                           for output in entry['outputs']]
+        cell['execution_count'] = entry['execution_count']
+        n_cached += 1
+    if n_cached == len(code_cells):
+        if len(code_cells) > 0 and entry['language_info'] is not None:
+            ntbk['metadata']['language_info'] = nbf.from_dict(
+                entry['language_info'])
+        return ntbk
+
+    # Resume from the first changed cell if the kernel ran all cells before
+    # it, otherwise run everything to rebuild the kernel's state
+    start = 0
+    if km is not None and km.has_kernel:
+        if cell_cache._kernels.get(km, [])[:n_cached] == keys[:n_cached]:
+            start = n_cached
+    first = positions[start] if start else 0
+    rest = nbf.NotebookNode(ntbk, cells=ntbk['cells'][first:])
+    _preprocess(prep, rest, km)
+
+    language_info = ntbk['metadata'].get('language_info')
+    for cell, key in zip(code_cells[start:], keys[start:]):
+        cell_cache.put(key, cell, language_info)
+    if km is not None:
+        cell_cache._kernels[km] = keys
     return ntbk
+
+
+def _execute_parallel(prep, ntbk, mode, n_kernels):
+    """Run independent groups of cells in separate kernels at once."""
+    from jupyter_core.utils import run_sync
+    setup, groups = cell_groups(ntbk, mode)
+    n_kernels = min(n_kernels, len(groups))
+    if n_kernels <= 1:
+        return _preprocess(prep, ntbk)
+
+    # Hand out the largest groups first, each to the kernel with the fewest
+    # cells so far
+    kernels = [[] for _ in range(n_kernels)]
+    for group in sorted(groups, key=len, reverse=True):
+        min(kernels, key=len).extend(group)
+    cells = ntbk['cells']
+    notebooks = []
+    for kk, positions in enumerate(kernels):
+        # Setup cells run everywhere, but only the first kernel's outputs
+        # are kept
+        sub_cells = [cells[ii] if kk == 0 or ii not in setup
+                     else deepcopy(cells[ii])
+                     for ii in sorted(positions + setup)]
+        notebooks.append(nbf.NotebookNode(ntbk, cells=sub_cells))
+    run_sync(_execute_all)(prep, notebooks)
+
+    # Number cells as if they had run one after another
+    count = 0
+    for cell in cells:
+        if cell.get('execution_count') is None:
+            continue
+        count += 1
+        cell['execution_count'] = count
+        for output in cell['outputs']:
+            if output['output_type'] == 'execute_result':
+                output['execution_count'] = count
+    return ntbk
+
+
+async def _execute_all(prep, notebooks):
+    """Run several notebooks at once, each with a copy of `prep`."""
+    from nbclient import NotebookClient
+    tasks = []
+    for ntbk in notebooks:
+        client = type(prep)(timeout=prep.timeout,
+                            allow_errors=prep.allow_errors)
+        if isinstance(prep.on_cell_execute, _KernelLimits):
+            client.on_cell_execute = prep.on_cell_execute.bind(client)
+        NotebookClient.__init__(client, ntbk)
+        tasks.append(asyncio.ensure_future(client.async_execute()))
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            if not task.done():
+                await _cancel(task)
+        raise
+
+
+async def run_notebook_directory_async(path, path_save=None,
+                                       max_output_lines=1000, overwrite=False,
+                                       concurrency=1, timeout=None):
+    """Run all the notebooks in a directory without blocking the event loop.
+
+    This is the asyncio version of `run_notebook_directory`. Notebooks are
+    run concurrently in the current event loop, each in its own kernel.
+    Cancelling the returned coroutine cancels every notebook that is still
+    running and shuts down its kernel.
+
+    Parameters
+    ----------
+    path : str
+        A path to a directory that contains jupyter notebooks, optionally
+        with a wildcard matching ``<something>.ipynb``.
+    path_save : str | None
+        A path to a directory to save the notebooks. If this doesn't exist,
+        it will be created. If `None`, notebooks will not be saved.
+    max_output_lines : int | None
+        The maximum number of lines allowed in notebook outputs.
+    overwrite : bool
+        Whether to overwrite the output directory if it exists.
+    concurrency : int
+        The maximum number of notebooks to run at the same time. If -1, use
+        the number of CPUs.
+    timeout : float | None
+        The maximum time, in seconds, that a single notebook may take to run,
+        not counting the time to save it. A `TimeoutError` is raised if it
+        takes longer, and the other notebooks are cancelled. If None, there
+        is no limit.
+
+    Returns
+    -------
+    notebooks : list
+        If `path_save` is None, a list of the `NotebookNode` instances, one
+        for each notebook. Otherwise a list of the saved paths. Either way,
+        results are in the same order as the input notebooks.
+    """
+    concurrency = _check_n_jobs(concurrency)
+    notebooks = _find_notebooks(path)
+    _prepare_path_save(path_save, overwrite, len(notebooks))
+
+    limit = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(_run_and_save_async(
+        filename, limit, path_save, max_output_lines, timeout))
+        for filename in notebooks]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Don't leave other notebooks running if one fails or we're cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _run_and_save_async(filename, limit, path_save=None,
+                              max_output_lines=1000, timeout=None):
+    """Run one notebook once `limit` allows, saving it if asked."""
+    async with limit:
+        notebook = await run_notebook_async(
+            filename, max_output_lines=max_output_lines, timeout=timeout)
+    if path_save is None:
+        return notebook
+    path_out = _exe_path(filename, path_save)
+    await asyncio.get_running_loop().run_in_executor(
+        None, _write_nb, notebook, path_out)
+    return path_out
+
+
+async def run_notebook_async(ntbk, max_output_lines=1000, copy=True,
+                             timeout=None, km=None):
+    """Run the cells in a notebook without blocking the event loop.
+
+    This is the asyncio version of `run_notebook`. The kernel is driven
+    with nbclient's asynchronous API, and notebook files are read in a
+    thread. Cancelling the coroutine stops running cells and shuts down the
+    kernel, unless `km` was given.
+
+    Parameters
+    ----------
+    ntbk : string | instance of NotebookNode
+        The input notebook.
+    max_output_lines : int | None
+        The maximum number of lines allowed in notebook outputs.
+    copy : bool
+        Whether to run a copy of a `NotebookNode` input. If False, the input
+        notebook is modified in place. Notebooks read from a path are never
+        copied.
+    timeout : float | None
+        The maximum time, in seconds, that the notebook may take to run. A
+        `TimeoutError` is raised if it takes longer. If None, there is no
+        limit.
+    km : instance of AsyncKernelManager | None
+        A kernel manager to run the notebook with. Its kernel is started if
+        needed and is left running afterwards. If None, a new kernel is
+        started and shut down for this notebook.
+    """
+    from nbclient import NotebookClient
+    from nbgrader.preprocessors import LimitOutput, Execute
+    if isinstance(ntbk, str):
+        ntbk = await asyncio.get_running_loop().run_in_executor(
+            None, _check_nb_file, ntbk)
+    else:
+        ntbk = _check_nb_file(ntbk, copy=copy)
+
+    prep = Execute()
+    # The same setup that `ExecutePreprocessor.preprocess` does
+    NotebookClient.__init__(prep, ntbk, km)
+    execution = asyncio.ensure_future(prep.async_execute())
+    try:
+        done, _ = await asyncio.wait([execution], timeout=timeout)
+        if len(done) == 0:
+            raise TimeoutError('Timed out after {} seconds'.format(timeout))
+        execution.result()
+    finally:
+        if not execution.done():
+            await _cancel(execution)
+        if km is not None and prep.kc is not None:
+            prep.kc.stop_channels()
+
+    if max_output_lines is not None:
+        ntbk = LimitOutput(max_lines=max_output_lines,
+                           max_traceback=max_output_lines).preprocess(
+                               ntbk, {})[0]
+    return ntbk
+
+
+async def _cancel(task):
+    """Cancel a task and wait for it to clean up."""
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        # nbclient reports a cancelled cell as a dead kernel
+        pass
@@ -0,0 +1,121 @@
+"""Find and replace solution regions in cell sources."""
+import re
+
+from .index import _as_list
+
+# The code that replaces solutions, for each kernel language
+CODE_STUBS = dict(python="# YOUR CODE HERE\nraise NotImplementedError()",
+                  R="# YOUR CODE HERE\nfail()",
+                  matlab="% YOUR CODE HERE\nerror('No Answer Given!')",
+                  octave="% YOUR CODE HERE\nerror('No Answer Given!')",
+                  sas="/* YOUR CODE HERE */\n %notImplemented;",
+                  java="// YOUR CODE HERE")
+
+
+def _is_solution(cell):
+    """Return whether nbgrader metadata marks a cell as a solution."""
+    return cell['metadata'].get('nbgrader', {}).get('solution', False)
+
+
+class SolutionScanner(object):
+    """Replace solution regions marked by any of several delimiter pairs.
+
+    A region starts on a line that contains a begin delimiter and ends on
+    the next line that contains the matching end delimiter. Both lines and
+    everything between them are replaced by a stub, indented like the
+    begin line. Lines with an end delimiter outside of a region are
+    removed. This follows nbgrader's ``ClearSolutions``, but all of the
+    delimiters are compiled into a single pattern, so each source is
+    scanned once and only the lines with a delimiter are looked at.
+
+    Parameters
+    ----------
+    begin : str | list of str
+        The delimiters that start a solution region.
+    end : str | list of str
+        The delimiters that end a solution region, one for each of `begin`.
+    """
+    def __init__(self, begin, end):
+        begin, end = _as_list(begin), _as_list(end)
+        if len(begin) == 0 or len(begin) != len(end):
+            raise ValueError('Expected the same number of begin and end '
+                             'delimiters, got {} and {}'.format(begin, end))
+        self.begin = begin
+        self.end = end
+        # A begin delimiter may be shared by several pairs, the first wins
+        self._ends = {}
+        for text_begin, text_end in zip(begin, end):
+            self._ends.setdefault(text_begin, text_end)
+        self.pattern = _compile(begin + end)
+        self._begin = _compile(begin)
+
+    def __repr__(self):
+        s = "<SolutionScanner> Delimiters: {}".format(
+            list(zip(self.begin, self.end)))
+        return s
+
+    def replace(self, source, stub):
+        """Replace the solution regions in a cell source.
+
+        Parameters
+        ----------
+        source : str
+            The cell source.
+        stub : str
+            The text to put in place of each region.
+
+        Returns
+        -------
+        source : str
+            The new source.
+        replaced : bool
+            Whether any solution region was found.
+        """
+        match = self.pattern.search(source)
+        if match is None:
+            return source, False
+
+        # Lines are collected as chunks of one or more whole lines, joined
+        # by newlines at the end
+        lines = []
+        stub_lines = stub.split('\n')
+        keep_from = 0
+        end = None
+        replaced = False
+        while match is not None:
+            line_start = source.rfind('\n', 0, match.start()) + 1
+            line_end = source.find('\n', match.end())
+            if line_end == -1:
+                line_end = len(source)
+            line = source[line_start:line_end]
+            begin = self._begin.search(line)
+            if begin is not None:
+                if end is not None:
+                    raise RuntimeError(
+                        "encountered nested begin solution statements")
+                if line_start > keep_from:
+                    lines.append(source[keep_from:line_start - 1])
+                indent = re.match(r'\s*', line).group(0)
+                lines.extend(indent + stub_line for stub_line in stub_lines)
+                end = self._ends[begin.group()]
+                replaced = True
+                keep_from = line_end + 1
+            elif end is None or end in line:
+                if end is None and line_start > keep_from:
+                    lines.append(source[keep_from:line_start - 1])
+                end = None
+                keep_from = line_end + 1
+            # Carry on from the next line
+            match = self.pattern.search(source, line_end)
+
+        if end is not None:
+            raise RuntimeError("no end solution statement found")
+        if keep_from <= len(source):
+            lines.append(source[keep_from:])
+        return '\n'.join(lines), replaced
+
+
+def _compile(delimiters):
+    # Try longer delimiters first, so one that contains another wins
+    delimiters = sorted(set(delimiters), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(text) for text in delimiters))
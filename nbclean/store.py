@@ -0,0 +1,219 @@
+"""A content-addressed store for large notebook outputs."""
+import hashlib
+import json
+import os
+import os.path as op
+
+import nbformat as nbf
+
+from .utils import _atomic_write, _check_nb_file
+
+# Output metadata key that maps mime types to the keys of their blobs
+_REFS_KEY = 'nbclean_blobs'
+
+
+class OutputStore(object):
+    """Keep large outputs on disk once, and leave references in notebooks.
+
+    Output data (e.g. plots or tables) that is larger than `min_size` is
+    moved out of a notebook by `externalize` and stored as a blob named
+    after the hash of its contents, so identical outputs in many notebooks
+    are only stored once. The notebook keeps a reference to each blob in
+    the metadata of the output, and `rehydrate` puts the data back.
+
+    Notebook files that reference blobs are recorded with `track`. Each
+    blob's reference count is the number of recorded notebooks that still
+    exist and reference it, and `gc` removes blobs that aren't referenced.
+
+    Parameters
+    ----------
+    path : str
+        The folder in which to store blobs. It is created if it doesn't
+        exist.
+    min_size : int
+        Only output data with at least this many characters is stored.
+    """
+    def __init__(self, path, min_size=1024):
+        self.path = path
+        self.min_size = min_size
+        os.makedirs(op.join(path, 'blobs'), exist_ok=True)
+        os.makedirs(op.join(path, 'refs'), exist_ok=True)
+
+    def __repr__(self):
+        s = "<OutputStore> {}\n---".format(self.path)
+        s += ("\nBlobs: {blobs} | Size: {size} bytes | "
+              "Notebooks: {notebooks}").format(**self.stats())
+        return s
+
+    def _blob(self, key):
+        return op.join(self.path, 'blobs', key[:2], key[2:])
+
+    def _ref(self, path_nb):
+        name = hashlib.sha256(path_nb.encode('utf-8')).hexdigest()
+        return op.join(self.path, 'refs', name + '.json')
+
+    def put(self, value):
+        """Store an output value and return its key."""
+        data = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        key = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        path_blob = self._blob(key)
+        # Blobs are named after their contents, so existing ones are current
+        if not op.exists(path_blob):
+            os.makedirs(op.dirname(path_blob), exist_ok=True)
+            with _atomic_write(path_blob) as ff:
+                ff.write(data)
+        return key
+
+    def get(self, key):
+        """Return the output value stored under `key`."""
+        with open(self._blob(key), 'r', encoding='utf-8') as ff:
+            return json.load(ff)
+
+    def externalize(self, ntbk, copy=False):
+        """Move large output data into the store.
+
+        Parameters
+        ----------
+        ntbk : instance of NotebookNode
+            The notebook. Each data value of at least `min_size` characters
+            in a display or result output is replaced by an empty value, and
+            its key is recorded in the output's metadata.
+        copy : bool
+            Whether to change a copy of the notebook instead of the input.
+
+        Returns
+        -------
+        ntbk : instance of NotebookNode
+            The notebook with references to the store.
+        keys : list of str
+            The keys of the blobs that the notebook references.
+        """
+        ntbk = _check_nb_file(ntbk, copy=copy)
+        keys = set()
+        for cell in ntbk['cells']:
+            for output in cell.get('outputs', []):
+                data = output.get('data', {})
+                for mime, value in data.items():
+                    if isinstance(value, str):
+                        size = len(value)
+                    else:
+                        size = len(json.dumps(value, ensure_ascii=False))
+                    if size < self.min_size:
+                        continue
+                    key = self.put(value)
+                    refs = output.setdefault('metadata', {}).setdefault(
+                        _REFS_KEY, {})
+                    refs[mime] = key
+                    data[mime] = '' if isinstance(value, str) else {}
+                    keys.add(key)
+        return ntbk, sorted(keys)
+
+    def rehydrate(self, ntbk, copy=True):
+        """Replace references to the store with the stored output data.
+
+        Parameters
+        ----------
+        ntbk : str | instance of NotebookNode
+            The notebook, or a path to it.
+        copy : bool
+            Whether to change a copy of a `NotebookNode` input.
+
+        Returns
+        -------
+        ntbk : instance of NotebookNode
+            The notebook with all of its outputs.
+        """
+        ntbk = _check_nb_file(ntbk, copy=copy)
+        for cell in ntbk['cells']:
+            for output in cell.get('outputs', []):
+                refs = output.get('metadata', {}).pop(_REFS_KEY, {})
+                for mime, key in refs.items():
+                    output['data'][mime] = self.get(key)
+        return ntbk
+
+    def references(self, ntbk):
+        """Return the keys of the blobs that a notebook references."""
+        if isinstance(ntbk, str):
+            ntbk = nbf.read(ntbk, nbf.NO_CONVERT)
+        keys = set()
+        for cell in ntbk['cells']:
+            for output in cell.get('outputs', []):
+                keys.update(output.get('metadata', {}).get(_REFS_KEY,
+                                                           {}).values())
+        return sorted(keys)
+
+    def track(self, path_nb, keys=None):
+        """Record that a notebook file references blobs in the store.
+
+        Parameters
+        ----------
+        path_nb : str
+            The path to the notebook. Its references are released once it
+            no longer exists, or when it is tracked again.
+        keys : list of str | None
+            The keys that it references. If None, they are read from the
+            file.
+        """
+        path_nb = op.abspath(path_nb)
+        if keys is None:
+            keys = self.references(path_nb)
+        with _atomic_write(self._ref(path_nb)) as ff:
+            json.dump(dict(path=path_nb, keys=list(keys)), ff)
+
+    def _tracked(self):
+        """Return the keys referenced by each tracked notebook that exists."""
+        tracked = {}
+        dir_refs = op.join(self.path, 'refs')
+        for name in os.listdir(dir_refs):
+            if not name.endswith('.json'):
+                continue
+            path_ref = op.join(dir_refs, name)
+            with open(path_ref, 'r', encoding='utf-8') as ff:
+                ref = json.load(ff)
+            if op.exists(ref['path']):
+                tracked[ref['path']] = ref['keys']
+            else:
+                os.remove(path_ref)
+        return tracked
+
+    def refcount(self, key):
+        """Return the number of tracked notebooks that reference `key`."""
+        return sum(key in keys for keys in self._tracked().values())
+
+    def _blobs(self):
+        dir_blobs = op.join(self.path, 'blobs')
+        for prefix in os.listdir(dir_blobs):
+            for name in os.listdir(op.join(dir_blobs, prefix)):
+                if not name.endswith('.tmp'):
+                    yield prefix + name
+
+    def gc(self):
+        """Remove blobs that no tracked notebook references.
+
+        This should not run while notebooks are being externalized, since
+        their blobs are only referenced once they are tracked.
+
+        Returns
+        -------
+        removed : dict
+            The number of ``blobs`` and ``bytes`` that were removed.
+        """
+        live = set()
+        for keys in self._tracked().values():
+            live.update(keys)
+        removed = dict(blobs=0, bytes=0)
+        for key in list(self._blobs()):
+            if key in live:
+                continue
+            path_blob = self._blob(key)
+            removed['bytes'] += op.getsize(path_blob)
+            os.remove(path_blob)
+            removed['blobs'] += 1
+        return removed
+
+    def stats(self):
+        """Return a dictionary of store statistics."""
+        keys = list(self._blobs())
+        return dict(blobs=len(keys),
+                    size=sum(op.getsize(self._blob(key)) for key in keys),
+                    notebooks=len(self._tracked()))
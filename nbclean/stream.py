@@ -0,0 +1,185 @@
+"""Process notebook files one cell at a time, without loading them fully."""
+import json
+
+from nbformat import from_dict
+from nbformat.notebooknode import NotebookNode
+from nbformat.v4.rwbase import rejoin_lines, strip_transient
+
+from .utils import _atomic_write, _dumps, _split_cell
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _JSONStream(object):
+    """Incrementally decode JSON values from a file object."""
+
+    def __init__(self, fileobj, chunk_size):
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read_more(self):
+        if self._eof:
+            return False
+        # Drop what we've consumed, and grow reads with the buffer so that
+        # very large values are decoded in a handful of attempts
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        chunk = self._file.read(max(self._chunk_size, len(self._buf)))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf += chunk
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, or '' at the end."""
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Invalid notebook JSON: expected {!r} at '
+                             'position {}'.format(char, self._pos))
+        self._pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may have been cut short
+            if end == len(self._buf) and self._read_more():
+                continue
+            self._pos = end
+            return obj
+
+
+class NotebookStreamReader(object):
+    """Read the cells of a notebook file one at a time.
+
+    Iterating over the reader yields each cell as a `NotebookNode`. Once all
+    cells have been read, the remaining top-level fields of the notebook
+    (e.g. ``metadata``) are available in the `other` attribute.
+
+    Parameters
+    ----------
+    fileobj : file
+        A notebook file opened for reading text.
+    chunk_size : int
+        The number of characters to read from the file at a time.
+    """
+
+    def __init__(self, fileobj, chunk_size=1 << 16):
+        self._stream = _JSONStream(fileobj, chunk_size)
+        self.other = {}
+
+    def __iter__(self):
+        stream = self._stream
+        stream.expect('{')
+        while stream.peek() != '}':
+            key = stream.value()
+            stream.expect(':')
+            if key == 'cells':
+                stream.expect('[')
+                while stream.peek() != ']':
+                    cell = from_dict(stream.value())
+                    rejoin_lines(NotebookNode(cells=[cell]))
+                    cell['metadata'].pop('trusted', None)
+                    yield cell
+                    if stream.peek() == ',':
+                        stream.expect(',')
+                stream.expect(']')
+            else:
+                self.other[key] = from_dict(stream.value())
+            if stream.peek() == ',':
+                stream.expect(',')
+        stream.expect('}')
+
+
+def preprocess_file(path, path_save, steps, resources=None,
+                    chunk_size=1 << 16, skip_unchanged=False):
+    """Run cell preprocessors over a notebook file in roughly constant memory.
+
+    Cells are read, processed and written one at a time, so only one cell
+    needs to be in memory at once. The output is formatted in the same way
+    as `nbformat.write`, but is not validated.
+
+    Parameters
+    ----------
+    path : str
+        The input notebook file.
+    path_save : str
+        Where to write the processed notebook. This may be the same as
+        `path`, since the output is written to a temporary file first.
+    steps : list
+        Preprocessors that implement `preprocess_cell`. Steps that need to
+        see the whole notebook (e.g. `ClearSolutions`) can't be used.
+    resources : dict | None
+        Resources shared by all of the steps. ``resources['stream']`` is
+        set to True, so that steps can tell that the notebook passed to
+        `end` has none of the cells.
+    chunk_size : int
+        The number of characters to read from the file at a time.
+    skip_unchanged : bool
+        Whether to leave `path_save` untouched if it already holds the same
+        notebook, so its modification time doesn't change.
+
+    Returns
+    -------
+    resources : dict
+        The resources dictionary.
+    """
+    for step in steps:
+        if not getattr(step, 'streamable', False):
+            raise ValueError('{} cannot be applied while streaming a '
+                             'notebook'.format(step))
+    resources = {} if resources is None else resources
+    resources['stream'] = True
+
+    with open(path, 'r', encoding='utf-8') as fin, \
+            _atomic_write(path_save, skip_unchanged) as fout:
+        reader = NotebookStreamReader(fin, chunk_size=chunk_size)
+
+        # The metadata normally comes after the cells, so steps only see an
+        # empty notebook when they begin
+        nb = NotebookNode(cells=[], metadata=NotebookNode())
+        for step in steps:
+            step.begin(nb, resources)
+
+        fout.write('{\n "cells": [')
+        n_cells = 0
+        for ii, cell in enumerate(reader):
+            for step in steps:
+                cell, resources = step.preprocess_cell(cell, resources, ii)
+                if cell is None:
+                    break
+            else:
+                text = _dumps(_split_cell(cell)).replace('\n', '\n  ')
+                fout.write('{}\n  {}'.format(',' if n_cells else '', text))
+                n_cells += 1
+        fout.write('\n ]' if n_cells else ']')
+
+        other = from_dict(reader.other)
+        other.setdefault('metadata', NotebookNode())
+        nb = NotebookNode(cells=[], **other)
+        for step in steps:
+            step.end(nb, resources)
+        strip_transient(nb)
+        nb.pop('cells')
+        fout.write(',' + _dumps(nb)[1:] + '\n' if len(nb) else '\n}\n')
+    return resources
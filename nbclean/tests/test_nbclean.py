@@ -1,6 +1,12 @@
 import nbclean as nbc
+import asyncio
+import base64
+import io
+import json
+import nbformat as nbf
 import pytest
 import os
+import re
 
 # We'll use the test notebook in `examples`
 path = os.path.dirname(__file__)
@@ -63,5 +69,904 @@ def test_nbclean():
     assert any('stderr' == output.get('name', '') for output in cell['outputs'])
     assert len(cell['source']) != 0
 
+
+def test_replace_text_delimiters():
+    nb = nbf.v4.new_notebook()
+    nb.cells = [
+        nbf.v4.new_code_cell('a = 1\n### SOLUTION BEGIN\nb = 2\n'
+                             '### SOLUTION END\nc = 3'),
+        nbf.v4.new_code_cell('def f():\n    # BEGIN SOLUTION\n    return 1\n'
+                             '    # END SOLUTION'),
+        nbf.v4.new_markdown_cell('Answer:\n<!-- BEGIN -->\n42\n<!-- END -->'),
+        nbf.v4.new_code_cell('d = 4')]
+    nb.cells[3].metadata['nbgrader'] = dict(solution=True)
+    cleaner = nbc.NotebookCleaner(nb)
+    cleaner.replace_text(
+        ['### SOLUTION BEGIN', '# BEGIN SOLUTION', '<!-- BEGIN -->'],
+        ['### SOLUTION END', '# END SOLUTION', '<!-- END -->'],
+        replace_md='Your answer')
+    stub = nbc.solutions.CODE_STUBS['python']
+    indented = '\n'.join('    ' + line for line in stub.split('\n'))
+    assert [cell['source'] for cell in cleaner.ntbk.cells] == [
+        'a = 1\n' + stub + '\nc = 3', 'def f():\n' + indented,
+        'Answer:\nYour answer', stub]
+
+    with pytest.raises(ValueError, match='same number'):
+        nbc.NotebookCleaner(nb).replace_text(['a', 'b'], 'c')
+    for source in ['### SOLUTION BEGIN\n### SOLUTION BEGIN',
+                   '### SOLUTION BEGIN\n# END SOLUTION']:
+        nb.cells = [nbf.v4.new_code_cell(source)]
+        with pytest.raises(RuntimeError):
+            nbc.NotebookCleaner(nb).replace_text(
+                ['### SOLUTION BEGIN', '# BEGIN SOLUTION'],
+                ['### SOLUTION END', '# END SOLUTION']).apply()
+
+
+def test_variants(tmpdir):
+    base = [('remove_cells', dict(tag='remove'))]
+    variants = {'a': [('clear', dict(kind='output', tag='hide_output'))],
+                'b': [('replace_text', {}),
+                      ('clear', dict(kind='content', tag='hide_content'))]}
+    path_save = str(tmpdir.join('{name}', 'test_notebook.ipynb'))
+    cleaners = nbc.clean_variants(path_notebook, variants, base=base,
+                                  path_save=path_save)
+    for name, recipe in variants.items():
+        expected = nbc.NotebookCleaner(path_notebook).apply_recipe(
+            base + recipe)
+        assert cleaners[name].recipe == expected.recipe
+        assert cleaners[name].ntbk == expected.ntbk
+        saved = nbf.read(path_save.format(name=name), nbf.NO_CONVERT)
+        assert saved.cells == expected.ntbk.cells
+
+    # Cells that neither variant changes are shared
+    cells_a, cells_b = cleaners['a'].ntbk.cells, cleaners['b'].ntbk.cells
+    n_shared = sum(aa is bb for aa, bb in zip(cells_a, cells_b))
+    assert 0 < n_shared < len(cells_a)
+
+    # Changing a fork, or the notebook it came from, leaves the other alone
+    fork = cleaners['a'].fork()
+    fork.clear(kind='content', tag='hide_content')
+    assert cleaners['a'].ntbk == nbc.NotebookCleaner(
+        path_notebook).apply_recipe(base + variants['a']).ntbk
+    cleaners['a'].clear(kind='output')
+    assert any(len(cell.get('outputs', [])) > 0 for cell in fork.ntbk.cells)
+    with pytest.raises(ValueError, match='name'):
+        nbc.clean_variants(path_notebook, variants, path_save='out.ipynb')
+
+
+def _clean(ntbk, base_dir):
+    ntbk.clear(kind='output', tag='hide_output')
+    ntbk.clear(kind='content', tag='hide_content')
+    ntbk.clear(kind=['stderr'], tag='hide_stderr')
+    ntbk.remove_cells(tag='remove')
+    ntbk.remove_cells(tag='remove_if_empty', empty=True)
+    ntbk.remove_cells(search_text=HIDE_TEXT)
+    ntbk.replace_text(text_replace_begin, text_replace_end)
+    ntbk.create_tests('hide_stderr', 'tests', base_dir)
+    return ntbk
+
+
+def test_watch(tmpdir):
+    path_in = tmpdir.mkdir('in')
+    for ii in range(2):
+        nbf.write(nbf.read(path_notebook, nbf.NO_CONVERT),
+                  str(path_in.join('nb{}.ipynb'.format(ii))))
+    recipe = [('remove_cells', dict(tag='remove'))]
+    watcher = nbc.NotebookWatcher(str(path_in), str(tmpdir.join('out')),
+                                  recipe, debounce=.2, interval=.05)
+
+    # Notebooks without an up to date output are built straight away
+    watcher.watch(timeout=.1)
+    assert [os.path.basename(ii['path']) for ii in watcher.summaries] == [
+        'nb0.ipynb', 'nb1.ipynb']
+    assert all(ii['error'] is None for ii in watcher.summaries)
+    assert watcher.poll() == []
+
+    # Only changed notebooks are rebuilt, once they stop changing
+    nb = nbf.read(path_notebook, nbf.NO_CONVERT)
+    nb.cells.append(nbf.v4.new_markdown_cell('New'))
+    nbf.write(nb, str(path_in.join('nb1.ipynb')))
+    assert watcher.poll() == []
+    watcher.watch(timeout=.5)
+    assert len(watcher.summaries) == 3
+    assert watcher.summaries[-1]['path'].endswith('nb1.ipynb')
+    out = nbf.read(watcher.summaries[-1]['path_save'], nbf.NO_CONVERT)
+    assert out.cells[-1]['source'] == 'New'
+
+    watcher = nbc.watch_notebook_directory(
+        str(path_in), str(tmpdir.join('out2')), recipe, interval=.05,
+        max_output_lines=10, validate='off', timeout=.1)
+    assert (watcher.max_output_lines, watcher.validate) == (10, 'off')
+    assert len(watcher.summaries) == 2
+
+
+def test_cli(tmpdir, capsys):
+    from nbclean.cli import main
+
+    path_recipe = str(tmpdir.join('recipe.json'))
+    with open(path_recipe, 'w') as ff:
+        json.dump([{'clear': {'kind': 'output', 'tag': 'hide_output'}},
+                   {'remove-cells': {'tag': 'remove'}},
+                   ['replace_text', {}]], ff)
+    path_out = str(tmpdir.join('out'))
+    args = [path_recipe, path_notebook, '-o', path_out, '-q']
+
+    assert main(args + ['--dry-run']) == 0
+    assert not os.path.exists(path_out)
+    assert main(args + ['-j', '2', '--timing', '-']) == 0
+    timing = json.loads(capsys.readouterr().out)
+    assert timing['jobs'] == 2
+    assert timing['notebooks'][0]['error'] is None
+    expected = nbc.NotebookCleaner(path_notebook)
+    expected.clear(kind='output', tag='hide_output')
+    expected.remove_cells(tag='remove')
+    expected.replace_text()
+    saved = nbf.read(timing['notebooks'][0]['path_save'], nbf.NO_CONVERT)
+    assert saved.cells == expected.ntbk.cells
+
+    # Existing outputs are only replaced with --overwrite
+    assert main(args) == 2
+    assert main(args + ['--overwrite']) == 0
+    assert main([path_recipe, str(tmpdir.join('nothing*.ipynb')),
+                 '-o', path_out]) == 2
+
+
+def test_import_is_light():
+    import subprocess
+    import sys
+    script = ('import sys, nbclean; '
+              'print([name for name in ["nbgrader", "jupyter_client", "tqdm"]'
+              ' if name in sys.modules])')
+    out = subprocess.run([sys.executable, '-c', script], check=True,
+                         capture_output=True, text=True).stdout
+    assert out.strip() == '[]'
+
+
+def test_lazy(tmpdir):
+    eager = _clean(nbc.NotebookCleaner(path_notebook), str(tmpdir))
+    lazy = _clean(nbc.NotebookCleaner(path_notebook, lazy=True), str(tmpdir))
+    assert 'Not yet applied: 8' in repr(lazy)
+    assert lazy.ntbk != eager.ntbk
+    lazy.apply()
+    assert lazy.ntbk == eager.ntbk
+    assert 'Not yet applied' not in repr(lazy)
+
+    # Pending steps are applied when saving
+    lazy = _clean(nbc.NotebookCleaner(path_notebook, lazy=True), str(tmpdir))
+    lazy.save(str(tmpdir.join('lazy.ipynb')))
+    eager.save(str(tmpdir.join('eager.ipynb')))
+    assert (tmpdir.join('lazy.ipynb').read() ==
+            tmpdir.join('eager.ipynb').read())
+
+    # Steps that fail aren't kept in the recipe or left pending
+    nb = nbf.read(path_notebook, nbf.NO_CONVERT)
+    nb.metadata['kernelspec'] = {'language': 'fortran'}
+    for lazy in [False, True]:
+        cleaner = nbc.NotebookCleaner(nb, lazy=lazy)
+        with pytest.raises(ValueError, match='must be used'):
+            cleaner.remove_cells()
+        with pytest.raises(re.error):
+            cleaner.remove_cells(regex='(')
+        assert cleaner.recipe == [] and cleaner.preprocessors == []
+        assert cleaner._pending == []
+    cleaner = nbc.NotebookCleaner(nb)
+    with pytest.raises(ValueError, match='fortran'):
+        cleaner.replace_text()
+    assert cleaner.recipe == [] and 'preprocessors: 0' in repr(cleaner)
+
+
+def test_create_tests(tmpdir):
+    base_dir = str(tmpdir)
+    ntbk = nbc.NotebookCleaner(path_notebook)
+    ntbk.create_tests('hide_stderr', 'tests', base_dir)
+    manifest = ntbk.test_manifest
+    assert len(manifest) == 1
+    assert all(test['written'] for test in manifest)
+    path_test = tmpdir.join(manifest[0]['path'])
+    assert path_test.read() == ntbk.tests[manifest[0]['path']]
+    assert ntbk.ntbk.cells[manifest[0]['cells'][0]]['source'] == (
+        'check("{}")'.format(manifest[0]['path']))
+
+    # Unchanged tests aren't written again
+    mtime = path_test.mtime()
+    path_test.setmtime(mtime - 10)
+    ntbk = nbc.NotebookCleaner(path_notebook)
+    ntbk.create_tests('hide_stderr', 'tests', base_dir)
+    assert not any(test['written'] for test in ntbk.test_manifest)
+    assert path_test.mtime() == mtime - 10
+
+    # Tests can be bundled into one file or kept in memory
+    ntbk = nbc.NotebookCleaner(path_notebook)
+    ntbk.create_tests('hide_stderr', 'bundled', base_dir, output='bundle')
+    bundle = json.loads(tmpdir.join('bundled', 'tests.json').read())
+    assert bundle == ntbk.tests
+    assert all(test['written'] for test in ntbk.test_manifest)
+    ntbk = nbc.NotebookCleaner(path_notebook)
+    ntbk.create_tests('hide_stderr', 'bundled', base_dir, output='bundle')
+    assert not any(test['written'] for test in ntbk.test_manifest)
+
+    # Cells are given by their position in the cleaned notebook
+    manifests = []
+    for lazy in [False, True]:
+        ntbk = nbc.NotebookCleaner(path_notebook, lazy=lazy)
+        ntbk.remove_cells(search_text=HIDE_TEXT)
+        ntbk.create_tests('hide_stderr', 'tests', base_dir)
+        ntbk.remove_cells(tag='remove').apply()
+        manifests.append(ntbk.test_manifest)
+        for test in ntbk.test_manifest:
+            for ii in test['cells']:
+                assert ntbk.ntbk.cells[ii]['source'] == (
+                    'check("{}")'.format(test['path']))
+    assert manifests[0] == manifests[1]
+    ntbk = nbc.NotebookCleaner(path_notebook)
+    ntbk.create_tests('hide_stderr', 'memory', base_dir, output='memory')
+    assert len(ntbk.tests) == 1
+    assert not tmpdir.join('memory').exists()
+    with pytest.raises(ValueError):
+        ntbk.create_tests('hide_stderr', 'tests', base_dir, output='zip')
+
+
+def test_compact():
+    png = base64.b64encode(b'not a png' * 100).decode('ascii')
+    data = {'image/png': png, 'image/svg+xml': '<svg/>' * 100,
+            'text/html': '<p>plot</p>', 'text/plain': '<Figure>'}
+    nb = nbf.v4.new_notebook()
+    for ii in range(2):
+        nb.cells.append(nbf.v4.new_code_cell('plot()', outputs=[
+            nbf.v4.new_output('display_data', data=dict(data))]))
+    nb.cells.append(nbf.v4.new_code_cell('print()', outputs=[
+        nbf.v4.new_output('stream', name='stdout', text='x' * 10000)]))
+
+    compact = nbc.NotebookCleaner(nb, profile=True).compact(
+        max_cell_bytes=2000)
+    assert compact.stats[0]['output_bytes_removed'] > 0
+    outputs = [cell['outputs'][0] for cell in compact.ntbk.cells]
+    assert sorted(outputs[0]['data']) == ['image/png', 'text/plain']
+    assert 'identical' in outputs[1]['data']['text/plain']
+    text = outputs[2]['text']
+    assert text.startswith('xxx') and text.endswith('xxx')
+    assert 'truncated' in text
+    assert len(json.dumps(outputs[2])) <= 2000
+    # The input notebook is untouched
+    assert len(nb.cells[0]['outputs'][0]['data']) == 4
+    assert len(nb.cells[2]['outputs'][0]['text']) == 10000
+
+    compact = nbc.NotebookCleaner(nb).compact(max_bytes=1000, dedupe=False)
+    sizes = [len(json.dumps(cell['outputs'])) for cell in compact.ntbk.cells]
+    assert sum(sizes) <= 1000
+    assert nb.cells[1]['outputs'][0]['data']['image/png'] == png
+    with pytest.raises(ValueError):
+        nbc.NotebookCleaner(path_notebook, stream=True).compact(max_bytes=10)
+
+    # Later steps see the outputs after the budget, also when fused
+    nb = nbf.v4.new_notebook()
+    for ii in range(3):
+        nb.cells.append(nbf.v4.new_code_cell('print()', outputs=[
+            nbf.v4.new_output('stream', name='stdout', text='x' * 2000)]))
+    nb.cells[0].metadata['tags'] = ['hide']
+    results = []
+    for lazy in [False, True]:
+        cleaner = nbc.NotebookCleaner(nb, lazy=lazy)
+        cleaner.compact(max_bytes=2500, dedupe=False)
+        cleaner.clear(kind='output', tag='hide').apply()
+        results.append([len(json.dumps(cell['outputs']))
+                        for cell in cleaner.ntbk.cells])
+    assert results[0] == results[1]
+
+
+def test_compact_images():
+    Image = pytest.importorskip('PIL.Image')
+    buf = io.BytesIO()
+    Image.new('RGB', (800, 600), 'red').save(buf, format='PNG')
+    png = base64.b64encode(buf.getvalue()).decode('ascii')
+    nb = nbf.v4.new_notebook()
+    nb.cells.append(nbf.v4.new_code_cell('plot()', outputs=[
+        nbf.v4.new_output('display_data', data={'image/png': png})]))
+    compact = nbc.NotebookCleaner(nb).compact(max_image_size=100)
+    shrunk = compact.ntbk.cells[0]['outputs'][0]['data']['image/png']
+    image = Image.open(io.BytesIO(base64.b64decode(shrunk)))
+    assert image.size == (100, 75)
+
+
+def test_profile(tmpdir):
+    import tracemalloc
+
+    for lazy in [False, True]:
+        records = []
+        ntbk = _clean(nbc.NotebookCleaner(path_notebook, lazy=lazy,
+                                          callback=records.append),
+                      str(tmpdir))
+        ntbk.apply()
+        assert records == ntbk.stats
+        assert [ii['name'] for ii in ntbk.stats] == [
+            name for name, _ in ntbk.recipe]
+        stats = dict((ii['name'] + str(jj), ii)
+                     for jj, ii in enumerate(ntbk.stats))
+        assert stats['clear0']['cells_modified'] == 1
+        assert stats['clear0']['output_bytes_removed'] > 0
+        assert stats['remove_cells3']['cells_removed'] == 1
+        assert stats['remove_cells5']['cells_removed'] == 1
+        assert all(ii['memory_delta'] is None for ii in ntbk.stats)
+        assert all(ii['time'] >= 0 for ii in ntbk.stats)
+        assert 'visited' in repr(ntbk)
+        if lazy:
+            # Every step sees every cell that reaches it in a fused pass
+            assert stats['clear0']['cells_visited'] == 22
+
+    assert nbc.NotebookCleaner(path_notebook).clear(kind='output').stats == []
+
+    tracemalloc.start()
+    try:
+        ntbk = nbc.NotebookCleaner(path_notebook, profile=True)
+        ntbk.clear(kind='output')
+    finally:
+        tracemalloc.stop()
+    assert ntbk.stats[0]['memory_delta'] is not None
+
+
+def test_multiple_patterns():
+    from nbclean.index import CellIndex, CellMatcher
+
+    # Several tags, strings, or regexes can be matched in one step
+    single = nbc.NotebookCleaner(path_notebook)
+    single.remove_cells(tag='remove').remove_cells(tag='hide_output')
+    single.remove_cells(search_text=HIDE_TEXT)
+    single.remove_cells(search_text='should be removed')
+    single.clear(kind='output', search_text='plt.')
+    multi = nbc.NotebookCleaner(path_notebook)
+    multi.remove_cells(tag=['remove', 'hide_output'])
+    multi.remove_cells(search_text=[HIDE_TEXT], regex=r'should\s+be removed')
+    multi.clear(kind='output', regex=[r'plt\.'])
+    assert multi.ntbk == single.ntbk
+
+    # Fused and indexed passes give the same result
+    lazy = nbc.NotebookCleaner(path_notebook, lazy=True)
+    lazy.apply_recipe(multi).apply()
+    assert lazy.ntbk == multi.ntbk
+
+    cells = nbf.read(path_notebook, nbf.NO_CONVERT).cells
+    index = CellIndex(cells)
+    assert len(index) == len(cells)
+    matcher = CellMatcher(tag=['remove', 'hide_content', 'foo'])
+    assert matcher.select(index) == [ii for ii, cell in enumerate(cells)
+                                     if matcher.matches(cell)] == [11, 13]
+    matcher = CellMatcher(search_text=['# HIDDEN', '('], regex='^## ')
+    assert matcher.select(index) == [ii for ii, cell in enumerate(cells)
+                                     if matcher.matches(cell)]
+    assert CellMatcher().select(index) is None
+
+    # Editing the notebook by hand between steps is picked up
+    edited = nbc.NotebookCleaner(path_notebook)
+    edited.clear(kind='output', tag='hide_output')
+    edited.ntbk.cells[0].metadata['tags'] = ['drop']
+    edited.ntbk.cells.insert(0, nbf.v4.new_markdown_cell('Drop me'))
+    edited.remove_cells(tag='drop').remove_cells(search_text='Drop me')
+    assert len(edited.ntbk.cells) == len(cells) - 1
+    assert edited.ntbk.cells[0] == cells[1]
+
+
+def test_copy(tmpdir):
+    original = nbf.read(path_notebook, nbf.NO_CONVERT)
+    ntbk = nbf.read(path_notebook, nbf.NO_CONVERT)
+    eager = _clean(nbc.NotebookCleaner(path_notebook), str(tmpdir))
+
+    # Only the cells that a step modifies are copied
+    cleaned = _clean(nbc.NotebookCleaner(ntbk), str(tmpdir))
+    assert ntbk == original
+    assert cleaned.ntbk == eager.ntbk
+    n_shared = sum(any(cell is orig for orig in ntbk.cells)
+                   for cell in cleaned.ntbk.cells)
+    assert 0 < n_shared < len(cleaned.ntbk.cells)
+    for cell in cleaned.ntbk.cells:
+        if 'hide_content' in cell['metadata'].get('tags', []):
+            assert all(cell is not orig for orig in ntbk.cells)
+
+    # Modify the input notebook in place
+    cleaned = nbc.NotebookCleaner(ntbk, copy=False)
+    cleaned.clear(kind='content', tag='hide_content')
+    assert cleaned.ntbk is ntbk
+    assert ntbk != original
+
+
+def test_save(tmpdir):
+    ntbk = _clean(nbc.NotebookCleaner(path_notebook), str(tmpdir))
+    nbf.write(ntbk.ntbk, str(tmpdir.join('nbformat.ipynb')))
+    expected = tmpdir.join('nbformat.ipynb').read()
+    for validate in ['full', 'sample', 'off']:
+        ntbk.save(str(tmpdir.join('out.ipynb')), validate=validate)
+        assert tmpdir.join('out.ipynb').read() == expected
+
+    # Files that wouldn't change aren't rewritten
+    path_out = str(tmpdir.join('out.ipynb'))
+    mtime = os.stat(path_out).st_mtime_ns
+    assert not ntbk.save(path_out, skip_unchanged=True)
+    assert os.stat(path_out).st_mtime_ns == mtime
+    ntbk.remove_cells(tag='hide_output')
+    assert ntbk.save(path_out, skip_unchanged=True)
+    streamed = nbc.NotebookCleaner(path_out, stream=True)
+    assert not streamed.save(path_out, skip_unchanged=True)
+    assert nbf.read(path_out, nbf.NO_CONVERT) == ntbk.ntbk
+
+    for kwargs in [dict(validate='foo'), dict(json_backend='foo')]:
+        with pytest.raises(ValueError):
+            ntbk.save(str(tmpdir.join('out.ipynb')), **kwargs)
+        with pytest.raises(ValueError):
+            nbc.NotebookCleaner(path_notebook, **kwargs)
+
+    for json_backend in ['json', 'auto']:
+        ntbk = nbc.NotebookCleaner(path_notebook, validate='sample',
+                                   json_backend=json_backend)
+        assert ntbk.ntbk == nbf.read(path_notebook, nbf.NO_CONVERT)
+
+    # Notebooks that nbformat writes with NaN values can be read back
+    nb = nbf.v4.new_notebook()
+    nb.cells.append(nbf.v4.new_code_cell('x', outputs=[nbf.v4.new_output(
+        'execute_result', data={'application/json': {'x': float('nan')}},
+        execution_count=1)]))
+    path_nan = tmpdir.mkdir('nan').join('nan.ipynb')
+    nbf.write(nb, str(path_nan))
+    assert 'NaN' in path_nan.read()
+    corpus = nbc.build_corpus(str(path_nan), str(tmpdir.join('corpus')))
+    for cell in [nbc.NotebookCleaner(str(path_nan)).ntbk.cells[0],
+                 corpus.cell(0)]:
+        data = cell['outputs'][0]['data']['application/json']
+        assert data['x'] != data['x']
+
+
+def test_save_orjson(tmpdir):
+    pytest.importorskip('orjson')
+    ntbk = _clean(nbc.NotebookCleaner(path_notebook, json_backend='orjson'),
+                  str(tmpdir))
+    ntbk.save(str(tmpdir.join('out.ipynb')), json_backend='orjson')
+    assert nbf.read(str(tmpdir.join('out.ipynb')), nbf.NO_CONVERT) == ntbk.ntbk
+
+
+def test_stream(tmpdir):
+    from nbclean.preprocessors import ClearCells, RemoveCells
+    from nbclean.stream import preprocess_file
+
+    def _stream_clean(ntbk):
+        ntbk.clear(kind='output', tag='hide_output')
+        ntbk.clear(kind=['content', 'output_image'], tag='hide_content')
+        ntbk.remove_cells(tag='remove')
+        ntbk.remove_cells(search_text=HIDE_TEXT)
+        ntbk.create_tests('hide_stderr', 'tests', str(tmpdir))
+        return ntbk
+
+    cleaned = _stream_clean(nbc.NotebookCleaner(path_notebook))
+    cleaned.save(str(tmpdir.join('eager.ipynb')))
+    streamed = _stream_clean(nbc.NotebookCleaner(path_notebook, stream=True))
+    assert streamed.ntbk is None
+    streamed.save(str(tmpdir.join('stream.ipynb')))
+    assert (tmpdir.join('stream.ipynb').read() ==
+            tmpdir.join('eager.ipynb').read())
+    # Streamed cells aren't kept, so their positions aren't known
+    assert ([test['path'] for test in streamed.test_manifest] ==
+            [test['path'] for test in cleaned.test_manifest])
+    assert [test['cells'] for test in streamed.test_manifest] == [None]
+    # Saving again replays every step
+    assert 'Not yet applied' not in repr(streamed)
+    streamed.save(str(tmpdir.join('stream2.ipynb')))
+    assert (tmpdir.join('stream2.ipynb').read() ==
+            tmpdir.join('eager.ipynb').read())
+    assert [test['cells'] for test in streamed.test_manifest] == [None]
+
+    # Values that span many reads are decoded correctly
+    steps = [ClearCells(output=False, output_image=True),
+             RemoveCells(empty=True)]
+    preprocess_file(path_notebook, str(tmpdir.join('small.ipynb')), steps,
+                    chunk_size=7)
+    eager = nbc.NotebookCleaner(path_notebook)
+    eager.clear(kind=['output_image', 'stderr']).remove_cells(empty=True)
+    assert nbf.read(str(tmpdir.join('small.ipynb')),
+                    nbf.NO_CONVERT) == eager.ntbk
+
+    with pytest.raises(ValueError):
+        streamed.replace_text()
+    with pytest.raises(ValueError):
+        streamed.apply()
+    with pytest.raises(TypeError):
+        nbc.NotebookCleaner(eager.ntbk, stream=True)
+
+
+def test_clean_notebook_directory(tmpdir):
+    path_in = tmpdir.mkdir('in')
+    for name in ['a.ipynb', 'b.ipynb']:
+        path_in.join(name).write(open(path_notebook).read())
+    path_in.join('broken.ipynb').write('not a notebook')
+
+    eager = _clean(nbc.NotebookCleaner(path_notebook), str(tmpdir))
+    assert [step[0] for step in eager.recipe] == [
+        'clear', 'clear', 'clear', 'remove_cells', 'remove_cells',
+        'remove_cells', 'replace_text', 'create_tests']
+    eager.save(str(tmpdir.join('eager.ipynb')))
+
+    path_out = tmpdir.join('out')
+    summaries = nbc.clean_notebook_directory(str(path_in), str(path_out),
+                                             eager, n_jobs=2)
+    assert [os.path.basename(ii['path']) for ii in summaries] == [
+        'a.ipynb', 'b.ipynb', 'broken.ipynb']
+    assert all(ii['time'] > 0 for ii in summaries)
+    assert summaries[0]['error'] is None
+    assert summaries[2]['error'] is not None
+    assert not path_out.join('broken.ipynb').exists()
+    for name in ['a.ipynb', 'b.ipynb']:
+        assert path_out.join(name).read() == tmpdir.join('eager.ipynb').read()
+
+    with pytest.raises(ValueError):
+        nbc.clean_notebook_directory(str(path_in), str(path_out), eager)
+    with pytest.raises(ValueError):
+        nbc.clean_notebook_directory(str(path_in), str(path_out),
+                                     [('foo', {})], overwrite=True)
+
+
+def test_cache(tmpdir):
+    path_in = tmpdir.mkdir('in')
+    for name in ['a.ipynb', 'b.ipynb']:
+        path_in.join(name).write(open(path_notebook).read())
+    path_in.join('broken.ipynb').write('not a notebook')
+    recipe = [('clear', dict(kind='output', tag='hide_output')),
+              ('remove_cells', dict(tag='remove'))]
+
+    cache = nbc.NotebookCache(str(tmpdir.join('cache')))
+    path_out = str(tmpdir.join('out'))
+    summaries = nbc.clean_notebook_directory(str(path_in), path_out, recipe,
+                                             cache=cache)
+    assert not any(ii['cached'] for ii in summaries)
+    expected = tmpdir.join('out', 'a.ipynb').read()
+    summaries = nbc.clean_notebook_directory(str(path_in), path_out, recipe,
+                                             overwrite=True, cache=cache)
+    assert [ii['cached'] for ii in summaries] == [True, True, False]
+    assert tmpdir.join('out', 'b.ipynb').read() == expected
+    # Cached copies replace outputs in one step, and only if they changed
+    mtime = os.stat(str(tmpdir.join('out', 'a.ipynb'))).st_mtime_ns
+    tmpdir.join('out', 'b.ipynb').write('stale')
+    nbc.clean_notebook_directory(str(path_in), path_out, recipe,
+                                 overwrite=True, cache=cache)
+    assert os.stat(str(tmpdir.join('out', 'a.ipynb'))).st_mtime_ns == mtime
+    assert tmpdir.join('out', 'b.ipynb').read() == expected
+    assert sorted(os.listdir(path_out)) == ['a.ipynb', 'b.ipynb']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (4, 5, 1)
+    assert 'Hits: 4' in repr(cache)
+
+    # A different recipe is a different entry
+    summaries = nbc.clean_notebook_directory(str(path_in), path_out,
+                                             recipe[:1], overwrite=True,
+                                             cache=cache)
+    assert not any(ii['cached'] for ii in summaries)
+    assert cache.stats()['entries'] == 2
+
+    # Least-recently used entries are evicted first
+    cache = nbc.NotebookCache(str(tmpdir.join('cache')),
+                              max_size=cache.stats()['size'])
+    key = cache.key(str(path_in.join('a.ipynb')), recipe)
+    path_entry = cache.get(key)
+    os.utime(path_entry, (0, 0))
+    cache.put('new', path_entry)
+    assert cache.get(key) is None
+    assert cache.stats()['evictions'] == 1
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+
+
+def test_run_notebook_directory(tmpdir):
+    path_in = tmpdir.mkdir('in')
+    for ii in range(2):
+        nb = nbf.v4.new_notebook()
+        nb.cells.append(nbf.v4.new_code_cell('print({})'.format(ii)))
+        nbf.write(nb, str(path_in.join('nb{}.ipynb'.format(ii))))
+
+    # Notebooks are streamed to disk and their paths returned
+    path_out = str(tmpdir.join('out'))
+    saved = nbc.run_notebook_directory(str(path_in), path_out, n_jobs=2,
+                                       ordered=True)
+    assert [os.path.basename(ii) for ii in saved] == ['nb0-exe.ipynb',
+                                                      'nb1-exe.ipynb']
+    for ii, path_nb in enumerate(saved):
+        outputs = nbf.read(path_nb, nbf.NO_CONVERT).cells[0]['outputs']
+        assert outputs[0]['text'] == '{}\n'.format(ii)
+    mtimes = [os.stat(ii).st_mtime_ns for ii in saved]
+    nbc.run_notebook_directory(str(path_in), path_out, overwrite=True,
+                               skip_unchanged=True)
+    assert [os.stat(ii).st_mtime_ns for ii in saved] == mtimes
+
+    records = []
+    nbc.run_notebook(str(path_in.join('nb0.ipynb')), callback=records.append)
+    assert [ii['name'] for ii in records] == ['Execute', 'LimitOutput']
+    assert records[0]['cells_modified'] == 1
+    assert records[0]['output_bytes_removed'] < 0
+
+    # Unchanged notebooks are taken from the cache
+    cache = nbc.NotebookCache(str(tmpdir.join('cache')))
+    outputs = nbc.run_notebook_directory(str(path_in), cache=cache)
+    assert cache.stats()['entries'] == 2
+    cached = nbc.run_notebook_directory(str(path_in), cache=cache)
+    assert cache.stats()['hits'] == 2
+    assert cached == outputs
+
+    # Kernels can be reused, with a clean namespace for each notebook
+    path_nb = str(path_in.join('nb2.ipynb'))
+    nb = nbf.v4.new_notebook()
+    nb.cells.append(nbf.v4.new_code_cell("print('ii' in dir())\nii = 2"))
+    nbf.write(nb, path_nb)
+    warm = nbc.run_notebook_directory(str(path_in), warm_kernels=True)
+    for nb_warm, nb_cold in zip(warm, outputs):
+        for key in ['outputs', 'execution_count']:
+            assert nb_warm.cells[0][key] == nb_cold.cells[0][key]
+    assert warm[2].cells[0]['outputs'][0]['text'] == 'False\n'
+    assert warm[2].cells[0]['execution_count'] == 1
+    os.remove(path_nb)
+
+    with pytest.raises(ValueError):
+        nbc.run_notebook_directory(str(path_in), n_jobs=0)
+    with pytest.raises(TimeoutError):
+        nbc.run_notebook_directory(str(path_in), n_jobs=2, timeout=.01,
+                                   fail_fast=True)
+    with pytest.raises(TimeoutError):
+        nbc.run_notebook_directory(str(path_in), timeout=.01,
+                                   warm_kernels=True, fail_fast=True)
+    # Otherwise notebooks that fail are skipped
+    assert nbc.run_notebook_directory(str(path_in), n_jobs=2,
+                                      timeout=.01) == [None, None]
+
+
+def test_limits(tmpdir):
+    from nbclient.exceptions import CellExecutionError
+    path_in = tmpdir.mkdir('in')
+    sources = [['import time\ntime.sleep(5)', 'print(1)'],
+               ['x = bytearray(4 * 1024 ** 3)', 'print(2)']]
+    for ii, cells in enumerate(sources):
+        nb = nbf.v4.new_notebook()
+        nb.cells.extend(nbf.v4.new_code_cell(source) for source in cells)
+        nbf.write(nb, str(path_in.join('nb{}.ipynb'.format(ii))))
+
+    # Cells that go over a limit fail, and the rest of the notebook runs
+    path_history = str(tmpdir.join('history.json'))
+    out = nbc.run_notebook_directory(str(path_in), cell_timeout=1,
+                                     memory_limit=2 * 1024 ** 3,
+                                     history=path_history)
+    assert out[0].cells[0]['outputs'][0]['output_type'] == 'error'
+    assert out[1].cells[0]['outputs'][0]['ename'] == 'MemoryError'
+    for ii, nb in enumerate(out):
+        assert nb.cells[1]['outputs'][0]['text'] == '{}\n'.format(ii + 1)
+
+    # Notebooks expected to be quickest run first
+    with open(path_history) as ff:
+        times = json.load(ff)
+    assert sorted(times) == sorted(str(ii) for ii in path_in.listdir())
+    times = {key: 10. * ('nb0' in key) for key in times}
+    with open(path_history, 'w') as ff:
+        json.dump(times, ff)
+    out = nbc.run_notebook_directory(str(path_in), ordered=False,
+                                     cell_timeout=1, history=path_history,
+                                     max_output_bytes=400)
+    assert out[0].cells[0]['source'].startswith('x =')
+    for nb in out:
+        sizes = [len(json.dumps(cell['outputs'])) for cell in nb.cells]
+        assert sum(sizes) <= 400
+
+    with pytest.raises(CellExecutionError):
+        nbc.run_notebook(str(path_in.join('nb0.ipynb')), cell_timeout=1,
+                         fail_fast=True)
+
+
+def test_cell_cache(tmpdir):
+    from jupyter_client.manager import AsyncKernelManager
+    from jupyter_core.utils import run_sync
+
+    def results(nb):
+        return [(cell.get('outputs'), cell.get('execution_count'))
+                for cell in nb.cells]
+
+    cache = nbc.CellCache(str(tmpdir.join('cells')))
+    nb = nbf.v4.new_notebook()
+    nb.cells.append(nbf.v4.new_code_cell('import random\nx = random.random()'))
+    nb.cells.append(nbf.v4.new_markdown_cell('Some text'))
+    nb.cells.append(nbf.v4.new_code_cell('print(x)'))
+    first = nbc.run_notebook(nb, cell_cache=cache)
+    assert cache.misses == 1
+
+    # Unchanged code cells aren't run again, even if markdown changes
+    nb.cells[1]['source'] = 'Other text'
+    assert results(nbc.run_notebook(nb, cell_cache=cache)) == results(first)
+    assert cache.hits == 2
+
+    # A kernel that ran the earlier cells resumes from the changed cell
+    km = AsyncKernelManager()
+    try:
+        nb.cells[2]['source'] = 'print(x + 1)'
+        x = nbc.run_notebook(nb, cell_cache=cache, km=km).cells[2]['outputs']
+        nb.cells[2]['source'] = 'print(x + 2)'
+        resumed = nbc.run_notebook(nb, cell_cache=cache, km=km)
+        assert results(resumed)[0] == results(first)[0]
+        assert (float(resumed.cells[2]['outputs'][0]['text']) ==
+                float(x[0]['text']) + 1)
+    finally:
+        run_sync(km.shutdown_kernel)(now=True)
+
+    nb.metadata['nbclean'] = {'cell_cache': False}
+    assert (results(nbc.run_notebook(nb, cell_cache=cache))[2] !=
+            results(resumed)[2])
+
+    # Notebooks in a directory use the cache too
+    del nb.metadata['nbclean']
+    path_in = tmpdir.mkdir('in')
+    nbf.write(nb, str(path_in.join('nb0.ipynb')))
+    nb.cells[2]['source'] = 'print(x + 3)'
+    nbf.write(nb, str(path_in.join('nb1.ipynb')))
+    xs = [float(first.cells[2]['outputs'][0]['text'])]
+    for ii, kwargs in enumerate([dict(n_jobs=2), dict(warm_kernels=True)]):
+        out = nbc.run_notebook_directory(str(path_in), cell_cache=cache,
+                                         **kwargs)
+        assert results(out[0]) == results(resumed)
+        # Changed notebooks are run in full, with a new value of x
+        xs.append(float(out[1].cells[2]['outputs'][0]['text']) - 3 - ii)
+        assert xs[-1] not in xs[:-1]
+        nb.cells[2]['source'] = 'print(x + 4)'
+        nbf.write(nb, str(path_in.join('nb1.ipynb')))
+    cached = nbc.run_notebook_directory(str(path_in), cell_cache=cache)
+    assert results(cached[1]) == results(out[1])
+
+
+def test_parallel_cells():
+    from nbclean.dependencies import cell_groups
+
+    nb = nbf.v4.new_notebook()
+    for source in ['%precision 3\nimport os', 'a = __import__("os").getpid()',
+                   'b = __import__("os").getpid()', 'print(a)', 'b', 'c = 1']:
+        nb.cells.append(nbf.v4.new_code_cell(source))
+    nb.cells.insert(4, nbf.v4.new_markdown_cell('Text'))
+    assert cell_groups(nb) == ([0], [[1, 3], [2, 5], [6]])
+    nb.cells[6].metadata['tags'] = ['group:b']
+    nb.cells[2].metadata['tags'] = ['group:b']
+    assert cell_groups(nb) == ([0], [[1, 3], [2, 5, 6]])
+    assert cell_groups(nb, 'tags') == ([0], [[1, 3], [2, 5, 6]])
+    nb.cells[1].metadata['tags'] = ['group:a']
+    assert cell_groups(nb, 'tags') == ([0], [[1, 3], [2, 5, 6]])
+    del nb.cells[1].metadata['tags']
+    nb.cells.append(nbf.v4.new_code_cell('!ls'))
+    assert cell_groups(nb) == ([0], [[1, 2, 3, 5, 6, 7]])
+    nb.cells.pop()
+
+    # Each group runs in its own kernel, but counts are as if run in order
+    out = nbc.run_notebook(nb, parallel='auto')
+    assert [cell.get('execution_count') for cell in out.cells] == [
+        1, 2, 3, 4, None, 5, 6]
+    pid_a = int(out.cells[3]['outputs'][0]['text'])
+    pid_b = int(out.cells[5]['outputs'][0]['data']['text/plain'])
+    assert pid_a != pid_b
+    assert out.cells[5]['outputs'][0]['execution_count'] == 5
+    with pytest.raises(ValueError):
+        nbc.run_notebook(nb, parallel='foo')
+
+    # Cells that share a module's state run in the same kernel
+    nb = nbf.v4.new_notebook()
+    for source in ['import random', 'random.seed(0)', 'random.random()',
+                   'random.random()', 'c = 1']:
+        nb.cells.append(nbf.v4.new_code_cell(source))
+    assert cell_groups(nb) == ([0], [[1, 2, 3], [4]])
+    parallel = nbc.run_notebook(nb, parallel='auto')
+    serial = nbc.run_notebook(nb)
+    for cell_parallel, cell_serial in zip(parallel.cells, serial.cells):
+        assert cell_parallel['outputs'] == cell_serial['outputs']
+
+
+def test_corpus(tmpdir):
+    from nbclean.index import CellMatcher
+    path_in = tmpdir.mkdir('in')
+    for ii in range(2):
+        nbf.write(nbf.read(path_notebook, nbf.NO_CONVERT),
+                  str(path_in.join('nb{}.ipynb'.format(ii))))
+    corpus = nbc.build_corpus(str(path_in), str(tmpdir.join('corpus')))
+    with pytest.raises(ValueError):
+        nbc.build_corpus(str(path_in), str(tmpdir.join('corpus')))
+    nb = nbf.read(path_notebook, nbf.NO_CONVERT)
+    assert len(corpus) == 2 * len(nb.cells)
+    assert corpus.to_notebook(1) == nb
+    assert corpus.source(3) == nb.cells[3]['source']
+    assert corpus.n_stderr.sum() == 2 * sum(
+        output.get('name') == 'stderr'
+        for cell in nb.cells for output in cell.get('outputs', []))
+
+    # Masks select the same cells as the cleaning steps
+    remove = (corpus.matches(tag=['remove', 'foo']) |
+              corpus.matches(search_text=HIDE_TEXT) |
+              (corpus.has_tag('remove_if_empty') & corpus.is_empty()))
+    clear = corpus.matches(tag='hide_output')
+    expected = nbc.NotebookCleaner(nb)
+    expected.remove_cells(tag='remove')
+    expected.remove_cells(search_text=HIDE_TEXT)
+    expected.remove_cells(tag='remove_if_empty', empty=True)
+    expected.clear(kind='output', tag='hide_output')
+    paths = corpus.export(str(tmpdir.join('out')), keep=~remove,
+                          clear_outputs=clear, notebooks=[0])
+    assert nbf.read(paths[0], nbf.NO_CONVERT).cells == expected.ntbk.cells
+    for kwargs in [dict(regex=r'print\('), dict(regex=['x.*os', '^## ']),
+                   dict(search_text=['print(', 'import'], regex='^$')]:
+        matcher = CellMatcher(**kwargs)
+        assert corpus.matches(**kwargs).tolist() == [
+            matcher.matches(corpus.cell(ii)) for ii in range(len(corpus))]
+
+
+def test_output_store(tmpdir):
+    store = nbc.OutputStore(str(tmpdir.join('store')), min_size=100)
+    data = {'image/png': 'A' * 1000, 'text/plain': '<Figure>'}
+    nb = nbf.v4.new_notebook()
+    for ii in range(2):
+        nb.cells.append(nbf.v4.new_code_cell('plot()', outputs=[
+            nbf.v4.new_output('display_data', data=dict(data))]))
+    small, keys = store.externalize(nb, copy=True)
+    assert len(keys) == 1
+    assert small.cells[0]['outputs'][0]['data']['image/png'] == ''
+    assert small.cells[0]['outputs'][0]['data']['text/plain'] == '<Figure>'
+    assert store.rehydrate(small) == nb
+    assert store.stats()['blobs'] == 1
+
+    # Blobs are kept while a tracked notebook references them
+    path_nb = str(tmpdir.join('small.ipynb'))
+    nbf.write(small, path_nb)
+    store.track(path_nb)
+    assert store.refcount(keys[0]) == 1
+    assert store.gc()['blobs'] == 0
+    assert store.rehydrate(path_nb) == nb
+    os.remove(path_nb)
+    assert store.refcount(keys[0]) == 0
+    assert store.gc()['blobs'] == 1
+    assert store.stats()['blobs'] == 0
+
+    # Executed notebooks share blobs
+    path_in = tmpdir.mkdir('in')
+    for ii in range(2):
+        nb = nbf.v4.new_notebook()
+        nb.cells.append(nbf.v4.new_code_cell("'x' * 1000"))
+        nbf.write(nb, str(path_in.join('nb{}.ipynb'.format(ii))))
+    saved = nbc.run_notebook_directory(str(path_in), str(tmpdir.join('out')),
+                                       store=store)
+    key, = store.references(saved[0])
+    assert store.refcount(key) == 2
+    full = store.rehydrate(saved[1])
+    assert full.cells[0]['outputs'][0]['data']['text/plain'] == (
+        repr('x' * 1000))
+    with pytest.raises(ValueError):
+        nbc.run_notebook_directory(str(path_in), store=store)
+
+
+def test_async(tmpdir):
+    path_in = tmpdir.mkdir('in')
+    for ii in range(3):
+        nb = nbf.v4.new_notebook()
+        nb.cells.append(nbf.v4.new_code_cell('print({})'.format(ii)))
+        nbf.write(nb, str(path_in.join('nb{}.ipynb'.format(ii))))
+
+    path_out = str(tmpdir.join('out'))
+    saved = asyncio.run(nbc.run_notebook_directory_async(
+        str(path_in), path_out, concurrency=2))
+    for ii, path_nb in enumerate(saved):
+        outputs = nbf.read(path_nb, nbf.NO_CONVERT).cells[0]['outputs']
+        assert outputs[0]['text'] == '{}\n'.format(ii)
+
+    # Slow notebooks time out or can be cancelled
+    nb = nbf.v4.new_notebook()
+    nb.cells.append(nbf.v4.new_code_cell('import time\ntime.sleep(20)'))
+    with pytest.raises(TimeoutError):
+        asyncio.run(nbc.run_notebook_async(nb, timeout=1))
+
+    async def cancel():
+        task = asyncio.ensure_future(nbc.run_notebook_async(nb))
+        await asyncio.sleep(1)
+        task.cancel()
+        await task
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel())
+    assert len(nb.cells[0]['outputs']) == 0
+
+    path_save = str(tmpdir.join('clean', 'nb.ipynb'))
+    cleaner = nbc.NotebookCleaner(saved[0], lazy=True)
+    cleaner.clear('output')
+    asyncio.run(cleaner.save_async(path_save))
+    assert nbf.read(path_save, nbf.NO_CONVERT).cells[0]['outputs'] == []
+
+
 if __name__ == '__main__':
     test_nbclean()
@@ -1,12 +1,328 @@
+import json
 import nbformat as nbf
+import os
+import os.path as op
+import shutil
+import signal
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from nbformat.notebooknode import NotebookNode
+from nbformat.reader import get_version
 from copy import deepcopy
+from glob import glob
+from traitlets.log import get_logger
 
+VALIDATE_MODES = ['full', 'sample', 'off']
+JSON_BACKENDS = ['auto', 'json', 'orjson']
 
-def _check_nb_file(ntbk):
+# The number of cells that are validated when validate='sample'
+_N_SAMPLE_CELLS = 10
+
+# Values that nbformat splits into lists of lines when writing to disk
+_SPLIT_MIMES = ['application/javascript', 'image/svg+xml']
+_TRANSIENT_METADATA = ['orig_nbformat', 'orig_nbformat_minor', 'signature']
+
+
+def _check_nb_file(ntbk, copy=True, validate='full', json_backend='json'):
+    """Return a notebook from a path or a NotebookNode.
+
+    Notebooks read from a path are fresh objects and are never copied.
+    A `NotebookNode` is deep-copied if `copy` is True, otherwise it is
+    returned as-is and will be modified in place. `validate` and
+    `json_backend` control how notebooks are read from a path (see
+    `_validate_nb` and `_get_json_backend`).
+    """
     if isinstance(ntbk, str):
-        ntbk = nbf.read(ntbk, nbf.NO_CONVERT)
+        loads, _ = _get_json_backend(json_backend)
+        with open(ntbk, 'rb') as ff:
+            nb_dict = loads(ff.read())
+        major, minor = get_version(nb_dict)
+        if major not in nbf.versions:
+            raise nbf.NBFormatError(
+                'Unsupported nbformat version {}'.format(major))
+        ntbk = nbf.versions[major].to_notebook_json(nb_dict, minor=minor)
+        _validate_nb(ntbk, validate)
     elif not isinstance(ntbk, NotebookNode):
         raise TypeError('`ntbk` must be type string or `NotebookNode`')
-    ntbk = deepcopy(ntbk)
+    elif copy is True:
+        ntbk = deepcopy(ntbk)
     return ntbk
+
+
+def _validate_nb(ntbk, validate='full'):
+    """Validate a notebook against the nbformat schema.
+
+    Like `nbformat.read` and `nbformat.write`, problems are logged rather
+    than raised. If `validate` is 'sample', only the notebook structure and
+    a few evenly-spaced cells are checked. If 'off', nothing is checked.
+    """
+    if validate not in VALIDATE_MODES:
+        raise ValueError('validate must be one of {}, got {}'.format(
+            VALIDATE_MODES, validate))
+    if validate == 'off':
+        return
+    cells = ntbk['cells']
+    if validate == 'sample' and len(cells) > _N_SAMPLE_CELLS:
+        step = len(cells) / _N_SAMPLE_CELLS
+        ntbk = NotebookNode(ntbk, cells=[cells[int(ii * step)]
+                                         for ii in range(_N_SAMPLE_CELLS)])
+    try:
+        nbf.validate(ntbk)
+    except nbf.ValidationError as err:
+        get_logger().error("Notebook JSON is invalid: %s", err)
+
+
+def _get_json_backend(name='auto'):
+    """Return `loads` and `dumps` functions for a JSON library.
+
+    'json' is the standard library, and writes notebooks with the same
+    formatting as `nbformat.write`. 'orjson' is much faster, but indents
+    with two spaces rather than one. 'auto' uses orjson if it is installed.
+    orjson is stricter than the standard library, and can't read the
+    ``NaN`` and ``Infinity`` values or the very large integers that
+    `nbformat.write` may produce, so it is only used when asked for.
+    """
+    if name not in JSON_BACKENDS:
+        raise ValueError('json_backend must be one of {}, got {}'.format(
+            JSON_BACKENDS, name))
+    if name in ['auto', 'orjson']:
+        try:
+            import orjson
+        except ImportError:
+            if name == 'orjson':
+                raise ImportError('json_backend="orjson" requires the orjson '
+                                  'package to be installed')
+        else:
+            options = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+
+            def dumps(obj):
+                return orjson.dumps(obj, option=options).decode('utf-8')
+            return orjson.loads, dumps
+    return json.loads, _dumps
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, indent=1, separators=(',', ': '),
+                      ensure_ascii=False)
+
+
+def _split_bundle(data):
+    return {key: val.splitlines(True) if isinstance(val, str) and (
+        key.startswith('text/') or key in _SPLIT_MIMES) else val
+        for key, val in data.items()}
+
+
+def _split_cell(cell):
+    """Return a copy of a cell in its on-disk form, without changing it.
+
+    This matches what `nbformat.write` does, but only copies the parts of
+    the cell that change.
+    """
+    cell = dict(cell)
+    if 'trusted' in cell['metadata']:
+        cell['metadata'] = {key: val for key, val in cell['metadata'].items()
+                            if key != 'trusted'}
+    if isinstance(cell.get('source'), str):
+        cell['source'] = cell['source'].splitlines(True)
+    if 'attachments' in cell:
+        cell['attachments'] = {key: _split_bundle(val) for key, val
+                               in cell['attachments'].items()}
+    if cell['cell_type'] == 'code':
+        outputs = []
+        for output in cell['outputs']:
+            output = dict(output)
+            if output['output_type'] in ['execute_result', 'display_data']:
+                output['data'] = _split_bundle(output.get('data', {}))
+            elif (output['output_type'] == 'stream' and
+                  isinstance(output['text'], str)):
+                output['text'] = output['text'].splitlines(True)
+            outputs.append(output)
+        cell['outputs'] = outputs
+    return cell
+
+
+def _write_nb(ntbk, path_save, validate='full', json_backend='json',
+              skip_unchanged=False):
+    """Write a notebook to disk like `nbformat.write`, but without copying it.
+
+    The file is replaced atomically. See `_validate_nb` and
+    `_get_json_backend` for `validate` and `json_backend`. If
+    `skip_unchanged`, a file that already holds the same text is left alone.
+    Returns whether the file was written.
+    """
+    _validate_nb(ntbk, validate)
+    _, dumps = _get_json_backend(json_backend)
+    nb_disk = dict(ntbk)
+    nb_disk['metadata'] = {key: val for key, val in ntbk['metadata'].items()
+                           if key not in _TRANSIENT_METADATA}
+    nb_disk['cells'] = [_split_cell(cell) for cell in ntbk['cells']]
+    text = dumps(nb_disk) + '\n'
+    if skip_unchanged is True and _has_contents(path_save,
+                                                text.encode('utf-8')):
+        return False
+    with _atomic_write(path_save) as ff:
+        ff.write(text)
+    return True
+
+
+def _has_contents(path, data):
+    """Return whether a file exists and holds exactly `data`."""
+    # Different sizes are caught without reading the file
+    if not op.isfile(path) or op.getsize(path) != len(data):
+        return False
+    with open(path, 'rb') as ff:
+        return ff.read() == data
+
+
+def _same_file(path, other):
+    """Return whether two files have the same contents."""
+    if not op.isfile(other) or op.getsize(path) != op.getsize(other):
+        return False
+    with open(path, 'rb') as ff:
+        return _has_contents(other, ff.read())
+
+
+def _file_version(path):
+    """Return something that changes whenever `path` is replaced."""
+    if not op.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _copy_nb_shallow(ntbk):
+    """Copy a notebook, but share its cells with the original."""
+    new_ntbk = NotebookNode({key: deepcopy(val) for key, val in ntbk.items()
+                             if key != 'cells'})
+    new_ntbk['cells'] = list(ntbk['cells'])
+    return new_ntbk
+
+
+def _find_notebooks(path):
+    """Return the sorted notebook paths in a folder or matching a glob."""
+    if not op.exists(path) and '*' not in path:
+        raise ValueError("You've specified an input path that doesn't exist")
+    to_glob = op.join(path, '*.ipynb') if '.ipynb' not in path else path
+    return sorted(glob(to_glob))
+
+
+@contextmanager
+def _atomic_write(path, skip_unchanged=False):
+    """Open a temporary file that replaces `path` once closed without error.
+
+    If `skip_unchanged`, `path` is only replaced if its contents differ.
+    """
+    path_tmp = _tmp_path(path)
+    try:
+        with open(path_tmp, 'w', encoding='utf-8') as ff:
+            yield ff
+        if skip_unchanged is not True or not _same_file(path_tmp, path):
+            os.replace(path_tmp, path)
+    finally:
+        if op.exists(path_tmp):
+            os.remove(path_tmp)
+
+
+def _copy_file(path, path_out, skip_unchanged=False):
+    """Copy `path` over `path_out` without ever leaving a partial file.
+
+    Returns whether `path_out` was written. If `skip_unchanged`, it is left
+    alone when it already has the same contents as `path`.
+    """
+    if skip_unchanged is True and _same_file(path, path_out):
+        return False
+    path_tmp = _tmp_path(path_out)
+    try:
+        shutil.copyfile(path, path_tmp)
+        os.replace(path_tmp, path_out)
+    finally:
+        if op.exists(path_tmp):
+            os.remove(path_tmp)
+    return True
+
+
+def _tmp_path(path):
+    """Return a hidden temporary path next to `path`."""
+    return op.join(op.dirname(path), '.{}.{}.tmp'.format(
+        op.basename(path), uuid.uuid4().hex[:8]))
+
+
+def _check_n_jobs(n_jobs):
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if not isinstance(n_jobs, int) or n_jobs < 1:
+        raise ValueError('n_jobs must be a positive integer or -1, '
+                         'got {}'.format(n_jobs))
+    return n_jobs
+
+
+class _Timeout(BaseException):
+    """Raised by `_time_limit`. Code that catches and handles any
+    `Exception` (as kernel start-up does) can't swallow it."""
+
+
+@contextmanager
+def _time_limit(seconds):
+    """Raise a TimeoutError if the wrapped block runs longer than `seconds`.
+
+    The limit relies on SIGALRM, so it is only enforced on platforms that
+    have it and when called from the main thread of a process (which is
+    always the case inside a worker process).
+    """
+    if (seconds is None or not hasattr(signal, 'SIGALRM') or
+            threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def _handler(signum, frame):
+        raise _Timeout()
+
+    old_handler = signal.signal(signal.SIGALRM, _handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    except _Timeout:
+        raise TimeoutError('Timed out after {} seconds'.format(
+            seconds)) from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def _parallel_map(func, items, n_jobs=1, ordered=True, progress=True,
+                  initializer=None):
+    """Apply `func` to each of `items`, yielding results as they are ready.
+
+    If `n_jobs` is 1 everything runs in this process, otherwise items are
+    fanned out across a pool of `n_jobs` worker processes. `func` must be
+    picklable (e.g. a module-level function or a `functools.partial`).
+    If `ordered` is False, results are yielded in the order they complete.
+    `initializer` is called once in each worker (or in this process if
+    `n_jobs` is 1) before any items are processed.
+    """
+    from tqdm import tqdm
+    n_jobs = _check_n_jobs(n_jobs)
+    items = list(items)
+    if len(items) == 0:
+        return
+    if n_jobs == 1:
+        if initializer is not None:
+            initializer()
+        for item in tqdm(items, disable=not progress):
+            yield func(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(items)),
+                             initializer=initializer) as pool:
+        futures = [pool.submit(func, item) for item in items]
+        try:
+            done = futures if ordered else as_completed(futures)
+            for future in tqdm(done, total=len(futures),
+                               disable=not progress):
+                yield future.result()
+        finally:
+            # Don't start any more work if we exit early (e.g. on an error)
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,215 @@
+"""Rebuild cleaned notebooks whenever their sources change."""
+import os
+import os.path as op
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from .clean import _check_recipe, _clean_and_save
+from .run import run_notebook
+from .utils import _check_n_jobs, _find_notebooks, _write_nb
+
+
+class NotebookWatcher(object):
+    """Clean (and optionally run) notebooks again as soon as they change.
+
+    The source folder is polled for notebooks whose modification time or
+    size has changed. A notebook is rebuilt once it has stopped changing for
+    `debounce` seconds, so editors that save several times in a row only
+    trigger one rebuild. Notebooks whose output is missing or older than
+    the source are rebuilt when watching starts.
+
+    Parameters
+    ----------
+    path : str
+        A path to a directory that contains jupyter notebooks, optionally
+        with a wildcard matching ``<something>.ipynb``.
+    path_save : str
+        A path to a directory in which to save the cleaned notebooks, using
+        the same file names as the inputs. It is created if it doesn't
+        exist.
+    recipe : list of (str, dict) | instance of NotebookCleaner
+        The cleaning steps to apply to each notebook. See
+        `NotebookCleaner.apply_recipe`.
+    run : bool
+        Whether to run each cleaned notebook with `run_notebook` and save it
+        with its outputs.
+    n_jobs : int
+        The number of notebooks to rebuild at the same time. If more than
+        one, a pool of worker processes is kept for as long as the watcher
+        runs. If -1, use one worker per CPU.
+    debounce : float
+        How long, in seconds, a notebook must go unchanged before it is
+        rebuilt.
+    interval : float
+        How often, in seconds, to check for changes.
+    max_output_lines : int | None
+        The maximum number of lines allowed in outputs if `run` is True.
+    validate : 'full' | 'sample' | 'off'
+        How thoroughly to check notebooks against the nbformat schema. See
+        `NotebookCleaner`.
+    callback : callable | None
+        A function that is called with the summary of each rebuild. See
+        `clean_notebook_directory` for what it contains.
+    """
+    def __init__(self, path, path_save, recipe, run=False, n_jobs=1,
+                 debounce=1., interval=.5, max_output_lines=1000,
+                 validate='full', callback=None):
+        self.path = path
+        self.path_save = path_save
+        self.recipe = _check_recipe(recipe)
+        self.run = run
+        self.n_jobs = _check_n_jobs(n_jobs)
+        self.debounce = debounce
+        self.interval = interval
+        self.max_output_lines = max_output_lines
+        self.validate = validate
+        self.callback = callback
+        self.summaries = []
+        self._snapshot = None
+        self._pending = {}
+        self._pool = None
+        self._stop = threading.Event()
+        os.makedirs(path_save, exist_ok=True)
+
+    def __repr__(self):
+        s = "<NotebookWatcher> {} -> {}\n---".format(self.path,
+                                                       self.path_save)
+        s += "\nRebuilds: {} | Pending: {}".format(len(self.summaries),
+                                                  len(self._pending))
+        return s
+
+    def _scan(self):
+        snapshot = {}
+        for filename in _find_notebooks(self.path):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            snapshot[filename] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _path_out(self, filename):
+        return op.join(self.path_save, op.basename(filename))
+
+    def poll(self):
+        """Check for changes, and return the notebooks that are ready.
+
+        Returns
+        -------
+        ready : list of str
+            Notebooks that have changed and then not changed for at least
+            `debounce` seconds.
+        """
+        now = time.monotonic()
+        snapshot = self._scan()
+        if self._snapshot is None:
+            # Catch up on anything that changed while we weren't watching
+            for filename, (mtime, _) in snapshot.items():
+                path_out = self._path_out(filename)
+                if (not op.exists(path_out) or
+                        os.stat(path_out).st_mtime_ns < mtime):
+                    self._pending[filename] = now - self.debounce
+        else:
+            for filename, stat in snapshot.items():
+                if self._snapshot.get(filename) != stat:
+                    self._pending[filename] = now
+        for filename in list(self._pending):
+            if filename not in snapshot:
+                del self._pending[filename]
+        self._snapshot = snapshot
+
+        ready = sorted(filename for filename, changed in self._pending.items()
+                       if now - changed >= self.debounce)
+        for filename in ready:
+            del self._pending[filename]
+        return ready
+
+    def rebuild(self, filenames):
+        """Clean, and optionally run, notebooks and return their summaries."""
+        args = (self.path_save, self.recipe, self.validate, self.run,
+                self.max_output_lines)
+        if self.n_jobs == 1:
+            summaries = [_rebuild(filename, *args) for filename in filenames]
+        else:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+            futures = [self._pool.submit(_rebuild, filename, *args)
+                       for filename in filenames]
+            wait(futures)
+            summaries = [future.result() for future in futures]
+        for summary in summaries:
+            self.summaries.append(summary)
+            if self.callback is not None:
+                self.callback(summary)
+        return summaries
+
+    def watch(self, timeout=None):
+        """Rebuild notebooks as they change until `stop` is called.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Stop after this many seconds. If None, watch until `stop` is
+            called (e.g. from another thread) or the process is interrupted.
+        """
+        self._stop.clear()
+        start = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                ready = self.poll()
+                if len(ready) > 0:
+                    self.rebuild(ready)
+                if timeout is not None and time.monotonic() - start > timeout:
+                    break
+                self._stop.wait(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+        return self
+
+    def stop(self):
+        """Stop watching once the current rebuild, if any, is done."""
+        self._stop.set()
+
+
+def watch_notebook_directory(path, path_save, recipe, run=False, n_jobs=1,
+                             debounce=1., interval=.5, max_output_lines=1000,
+                             validate='full', timeout=None, callback=None):
+    """Keep cleaned copies of the notebooks in a directory up to date.
+
+    This blocks, rebuilding notebooks as they change, until it is
+    interrupted or `timeout` seconds have passed. See `NotebookWatcher` for
+    the parameters.
+
+    Returns
+    -------
+    watcher : instance of NotebookWatcher
+        The watcher, whose `summaries` describe every rebuild.
+    """
+    watcher = NotebookWatcher(path, path_save, recipe, run=run,
+                              n_jobs=n_jobs, debounce=debounce,
+                              interval=interval,
+                              max_output_lines=max_output_lines,
+                              validate=validate, callback=callback)
+    return watcher.watch(timeout=timeout)
+
+
+def _rebuild(filename, path_save, recipe, validate='full', run=False,
+             max_output_lines=1000):
+    """Clean one notebook, then run it if asked, returning a summary."""
+    summary = _clean_and_save(filename, path_save, recipe, validate)
+    if run is False or summary['error'] is not None:
+        return summary
+    start = time.perf_counter()
+    try:
+        ntbk = run_notebook(summary['path_save'],
+                            max_output_lines=max_output_lines)
+        _write_nb(ntbk, summary['path_save'], validate=validate)
+    except Exception as err:
+        summary['error'] = '{}: {}'.format(type(err).__name__, err)
+    summary['time'] += time.perf_counter() - start
+    return summary